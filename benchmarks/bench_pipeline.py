@@ -0,0 +1,183 @@
+"""
+Замер основных этапов загрузчика на синтетическом ящике без обращения к Яндексу.
+
+Письма генерирует mailgen, раздает их локальный FakeIMAPServer с
+заданной задержкой ответа. Замеряются сценарии:
+
+    download        download_emails через imaplib в EML-файлы
+    download_pack   то же в упакованное хранилище (PackStore)
+    mbox            convert_to_mbox по скачанной папке
+    decode          process_eml_file в одном процессе (decode_eml_files, workers=1)
+    decode_parallel process_eml_file в пуле процессов
+    merge           merge_html_files_with_separators по результатам decode
+
+Результаты можно сохранить в JSON и сравнивать между коммитами:
+
+    python benchmarks/bench_pipeline.py --messages 2000 --latency 0.02 --json results.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import imaplib
+import argparse
+import platform
+import tempfile
+import contextlib
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import yandex_mail_downloader as downloader
+from fake_imap import FakeIMAPServer
+from mailgen import generate_corpus
+
+
+def scenario_download(workdir, server, args, store=False):
+    connection = imaplib.IMAP4('127.0.0.1', server.port)
+    connection.login('bench', 'bench')
+    connection.select('INBOX', readonly=True)
+    email_uids = [email_uid.decode() for email_uid in downloader.search_uids(connection, 'ALL')]
+    folder = os.path.join(workdir, 'download')
+    os.makedirs(folder, exist_ok=True)
+    pack = downloader.PackStore(workdir) if store else None
+    saved, failed = downloader.download_emails(connection, folder, 'INBOX', email_uids, args.fetch_batch, store=pack)
+    if pack is not None:
+        pack.close()
+    connection.logout()
+    if failed:
+        raise RuntimeError(f'{failed} emails failed to download')
+
+
+def scenario_mbox(workdir, server, args):
+    downloader.convert_to_mbox(os.path.join(workdir, 'INBOX'))
+
+
+def scenario_decode(workdir, server, args, workers=1):
+    folder = os.path.join(workdir, 'INBOX')
+    output_dir = os.path.join(workdir, 'decoded')
+    for file_name, result, error in downloader.decode_eml_files(sorted(os.listdir(folder)), folder, output_dir,
+                                                                workers=workers, txt=True, html=True, files=True):
+        if error is not None:
+            raise RuntimeError(f'{file_name}: {error}')
+
+
+def scenario_merge(workdir, server, args):
+    folder = os.path.join(workdir, 'decoded')
+    output_dir = os.path.join(workdir, 'merged')
+    os.makedirs(output_dir, exist_ok=True)
+    # HTML писем в порядке UID, как при обычном запуске
+    letters = sorted((name for name in os.listdir(folder) if name.endswith('.eml.html')), key=lambda name: int(name.split('.')[0]))
+    downloader.merge_html_files_with_separators(folder, letters, output_dir, batch=args.batch, unwrap=False)
+
+
+SCENARIOS = {
+    'download': scenario_download,
+    'download_pack': lambda workdir, server, args: scenario_download(workdir, server, args, store=True),
+    'mbox': scenario_mbox,
+    'decode': scenario_decode,
+    'decode_parallel': lambda workdir, server, args: scenario_decode(workdir, server, args, workers=args.decode_workers),
+    'merge': scenario_merge,
+}
+
+
+def prepare(workdir, messages, name):
+    """Готовит входные данные сценария в чистой рабочей папке."""
+    if name.startswith('download'):
+        # Загрузка получает письма с сервера
+        return
+    folder = os.path.join(workdir, 'INBOX')
+    os.makedirs(folder)
+    for uid, content in enumerate(messages, 1):
+        with open(os.path.join(folder, f'{uid}.eml'), 'wb') as f:
+            f.write(content)
+    if name == 'merge':
+        # Слиянию нужны результаты декодирования
+        scenario_decode(workdir, None, None)
+
+
+def run_scenario(name, messages, server, args):
+    """Запускает сценарий args.repeat раз и возвращает статистику времени."""
+    timings = []
+    downloader.metrics = downloader.Metrics()
+    for _ in range(args.repeat):
+        workdir = tempfile.mkdtemp(prefix=f'bench-{name}-')
+        try:
+            # Построчный вывод загрузчика не должен попадать в замер и в результаты
+            with contextlib.redirect_stdout(io.StringIO()):
+                prepare(workdir, messages, name)
+                start = time.perf_counter()
+                SCENARIOS[name](workdir, server, args)
+                timings.append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    total_bytes = sum(len(content) for content in messages)
+    best = min(timings)
+    stages = downloader.metrics.snapshot()['stages']
+    return {
+        'seconds_best': round(best, 4),
+        'seconds_median': round(statistics.median(timings), 4),
+        'messages_per_second': round(len(messages) / best, 1),
+        'megabytes_per_second': round(total_bytes / best / 1024 / 1024, 2),
+        # Средняя длительность этапов по всем прогонам (включая подготовку)
+        'stage_ms': {stage: round(data['sum'] / data['count'] * 1000, 3) for stage, data in stages.items() if data['count']},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the download, Mbox, decode and merge stages on a synthetic mailbox')
+    parser.add_argument('--messages', type=int, default=500, help='Number of emails in the synthetic mailbox')
+    parser.add_argument('--size', type=int, default=4096, help='Approximate size of the text part in bytes')
+    parser.add_argument('--attachments', type=float, default=0.1, help='Share of emails with an attachment (0..1)')
+    parser.add_argument('--attachment-size', type=int, default=64 * 1024, help='Attachment size in bytes')
+    parser.add_argument('--html-weight', type=float, default=2.0, help='HTML part size relative to the text part (0 - no HTML)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Delay of every fake IMAP server response in seconds')
+    parser.add_argument('--fetch-batch', type=int, default=downloader.FETCH_BATCH_SIZE, help='UIDs per FETCH command')
+    parser.add_argument('--decode-workers', type=int, default=None, help='Processes for decode_parallel (default: number of CPUs)')
+    parser.add_argument('--batch', type=int, default=100, help='Letters per merged HTML file')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every scenario (the best one is reported)')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), nargs='+', default=list(SCENARIOS), help='Scenarios to run')
+    parser.add_argument('--json', nargs='?', const='-', default=None, metavar='FILE', help='Write results as JSON to FILE (or stdout)')
+    args = parser.parse_args()
+
+    # Прогресс и построчный вывод загрузчика не нужны
+    downloader.set_verbosity(downloader.QUIET)
+
+    messages = generate_corpus(args.messages, size=args.size, attachment_ratio=args.attachments,
+                               html_weight=args.html_weight, attachment_size=args.attachment_size)
+
+    results = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('json', 'scenario')},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'lxml': downloader.lxml is not None,
+                        'zstandard': downloader.zstandard is not None},
+        'corpus_bytes': sum(len(content) for content in messages),
+        'scenarios': {},
+    }
+    if args.json != '-':
+        print(f'Emails: {args.messages}, corpus: {results["corpus_bytes"] / 1024 / 1024:.1f} MiB, latency: {args.latency * 1000:.0f} ms')
+    with FakeIMAPServer({'INBOX': messages}, latency=args.latency) as server:
+        for name in args.scenario:
+            commands = server.commands
+            results['scenarios'][name] = run_scenario(name, messages, server, args)
+            if name.startswith('download'):
+                results['scenarios'][name]['imap_commands'] = (server.commands - commands) // args.repeat
+            if args.json != '-':
+                scenario = results['scenarios'][name]
+                print(f'  {name:<16} {scenario["seconds_best"]:8.3f} s  {scenario["messages_per_second"]:9.1f} msg/s  '
+                      f'{scenario["megabytes_per_second"]:7.2f} MiB/s')
+
+    if args.json == '-':
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    elif args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f'Results written to {args.json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Замер стоимости очистки HTML одного письма разными движками.
+
+Сравнивает прежнюю схему (BeautifulSoup в remove_styles_from_html и еще
+один разбор BeautifulSoup при объединении) с однопроходными движками
+sanitize_html. По умолчанию использует синтетическую рассылку размером
+с типичное письмо, можно передать свои HTML-файлы.
+
+    python benchmarks/bench_sanitizer.py
+    python benchmarks/bench_sanitizer.py txt/user/INBOX/*.html --repeat 20 --json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yandex_mail_downloader as downloader
+
+
+def newsletter_html(items=40):
+    """Генерирует HTML, похожий на рассылку: таблицы, inline-стили, классы, <style>."""
+    blocks = []
+    for i in range(items):
+        blocks.append(
+            f'<tr><td class="item item-{i}" style="padding:16px;border-bottom:1px solid #eee;font-family:Arial">'
+            f'<table width="100%" cellpadding="0" cellspacing="0" style="border-collapse:collapse"><tr>'
+            f'<td class="thumb" style="width:120px"><img src="https://example.com/img/{i}.png" width="120" '
+            f'style="display:block;border:0" alt="Товар {i}"></td>'
+            f'<td class="text" style="padding-left:12px;color:#333;font-size:14px;line-height:20px">'
+            f'<h2 class="title" style="margin:0 0 8px;font-size:18px">Заголовок новости {i}</h2>'
+            f'<p style="margin:0">Текст новости номер {i} &mdash; скидки, акции и <b>важные</b> '
+            f'новости недели. <a href="https://example.com/{i}?utm_source=mail" class="link" '
+            f'style="color:#007bff">Подробнее&nbsp;&raquo;</a></p></td></tr></table></td></tr>'
+        )
+    style = ''.join(f'.item-{i}{{background:#fafafa}} .item-{i} .title{{color:#{i:06x}}}\n' for i in range(items))
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Рассылка</title>'
+        f'<style type="text/css">{style}</style></head>'
+        '<body class="body" style="margin:0;background:#f4f4f4">'
+        '<table class="wrapper" width="600" align="center" style="background:#fff">'
+        + ''.join(blocks)
+        + '</table><!-- footer --><p class="footer" style="font-size:11px">Отписаться</p></body></html>'
+    )
+
+
+def legacy_bs4(html_content):
+    """Прежняя схема: два полных разбора BeautifulSoup."""
+    cleaned = downloader._sanitize_bs4(html_content, strip_styles=True, unwrap=False)
+    return downloader._sanitize_bs4(cleaned, strip_styles=False, unwrap=True)
+
+
+def measure(func, documents, repeat):
+    """Возвращает среднее время обработки одного документа в миллисекундах."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for document in documents:
+            func(document)
+    return (time.perf_counter() - start) * 1000 / (repeat * len(documents))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark HTML sanitizer engines on newsletter-sized HTML')
+    parser.add_argument('files', nargs='*', help='HTML files to use instead of the synthetic newsletter')
+    parser.add_argument('--repeat', type=int, default=50, help='Number of passes over the documents')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    if args.files:
+        documents = []
+        for file_name in args.files:
+            with open(file_name, encoding='utf-8', errors='ignore') as f:
+                documents.append(f.read())
+    else:
+        documents = [newsletter_html()]
+
+    scenarios = {}
+    if downloader.BeautifulSoup is not None:
+        scenarios['legacy bs4 x2'] = legacy_bs4
+    for backend in sorted(downloader.HTML_SANITIZERS):
+        if backend == 'lxml' and downloader.lxml is None:
+            continue
+        if backend == 'bs4' and downloader.BeautifulSoup is None:
+            continue
+        scenarios[backend] = lambda html_content, backend=backend: downloader.HTML_SANITIZERS[backend](html_content, True, True)
+
+    average_size = sum(len(document.encode('utf-8')) for document in documents) / len(documents)
+    results = {
+        'documents': len(documents),
+        'average_size_bytes': int(average_size),
+        'ms_per_message': {name: round(measure(func, documents, args.repeat), 3) for name, func in scenarios.items()},
+    }
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+
+    print(f'Documents: {results["documents"]}, average size: {results["average_size_bytes"] / 1024:.1f} KiB')
+    for name, value in results['ms_per_message'].items():
+        print(f'  {name:<15} {value:8.3f} ms/message')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Локальный IMAP4-сервер для бенчмарков без обращения к imap.yandex.com.
+
+Поддерживает то, чем пользуется загрузчик: CAPABILITY, LOGIN, LIST,
+SELECT/EXAMINE, UID SEARCH, UID FETCH (UID, RFC822.SIZE, FLAGS,
+BODYSTRUCTURE, BODY[...] и BODY.PEEK[...] с секциями и диапазонами),
+IDLE, NOOP, CLOSE и LOGOUT. Каждый ответ можно задержать на latency
+секунд, чтобы изобразить сетевую задержку до сервера. Пароль не
+проверяется, разделитель ящиков - "|", как у Яндекса.
+
+Для тестов зеркалирования deliver() добавляет письмо и сообщает
+"* N EXISTS" соединениям, ждущим в IDLE, а drop_connections()
+обрывает все соединения.
+
+    with FakeIMAPServer({'INBOX': messages}, latency=0.02) as server:
+        connection = imaplib.IMAP4('127.0.0.1', server.port)
+"""
+import re
+import email
+import asyncio
+import threading
+
+
+def _quote(value):
+    if value is None:
+        return b'NIL'
+    if isinstance(value, str):
+        value = value.encode()
+    return b'"' + value.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+
+def _split_message(content):
+    """Делит письмо на заголовок (с пустой строкой) и тело."""
+    for separator in (b'\r\n\r\n', b'\n\n'):
+        index = content.find(separator)
+        if index >= 0:
+            return content[:index + len(separator)], content[index + len(separator):]
+    return content, b''
+
+
+def _bodystructure(part):
+    """Строит BODYSTRUCTURE части письма (только поля, которые разбирает загрузчик)."""
+    if part.is_multipart():
+        return (b'(' + b''.join(_bodystructure(sub) for sub in part.get_payload())
+                + b' ' + _quote(part.get_content_subtype().upper()) + b')')
+    params = (part.get_params() or [])[1:]
+    param_list = b'(' + b' '.join(_quote(key.upper()) + b' ' + _quote(value) for key, value in params) + b')' if params else b'NIL'
+    payload = _split_message(part.as_bytes())[1]
+    encoding = (part.get('Content-Transfer-Encoding') or '7BIT').upper()
+    fields = [_quote(part.get_content_maintype().upper()), _quote(part.get_content_subtype().upper()), param_list,
+              b'NIL', b'NIL', _quote(encoding), str(len(payload)).encode()]
+    if part.get_content_maintype() == 'text':
+        fields.append(str(payload.count(b'\n')).encode())
+    structure = b'(' + b' '.join(fields)
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_filename()
+        structure += (b' NIL (' + _quote(disposition.upper())
+                      + (b' (' + _quote('FILENAME') + b' ' + _quote(filename) + b')' if filename else b' NIL') + b') NIL')
+    return structure + b')'
+
+
+def _section(content, section):
+    """Возвращает содержимое секции BODY[section] письма."""
+    if section == '':
+        return content
+    header, body = _split_message(content)
+    if section == 'HEADER':
+        return header
+    if section == 'TEXT':
+        return body
+    match = re.match(r'HEADER\.FIELDS \((.*)\)', section)
+    if match:
+        names = match.group(1).upper().split()
+        lines = re.split(rb'\r?\n(?![ \t])', header.rstrip(b'\r\n'))
+        return b''.join(line + b'\r\n' for line in lines if line.split(b':', 1)[0].decode().upper() in names) + b'\r\n'
+
+    numbers = section.split('.')
+    mime = numbers[-1] == 'MIME'
+    if mime:
+        numbers = numbers[:-1]
+    part = email.message_from_bytes(content)
+    for number in numbers:
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+        elif number != '1':
+            return b''
+    part_header, part_body = _split_message(part.as_bytes())
+    return part_header if mime else part_body
+
+
+def _uid_set(spec, max_uid):
+    uids = set()
+    for item in spec.split(','):
+        first, _, last = item.partition(':')
+        first = max_uid if first == '*' else int(first)
+        last = first if not last else (max_uid if last == '*' else int(last))
+        uids.update(range(min(first, last), max(first, last) + 1))
+    return uids
+
+
+class Mailbox:
+    """Ящик фейкового сервера: список (uid, письмо) и счетчики для SELECT."""
+
+    def __init__(self, messages, uidvalidity=1):
+        self.messages = list(enumerate(messages, 1))
+        self.uidvalidity = uidvalidity
+        self.uidnext = len(self.messages) + 1
+        self.modseq = 1
+
+    def append(self, content):
+        self.messages.append((self.uidnext, content))
+        self.uidnext += 1
+        self.modseq += 1
+
+
+class FakeIMAPServer:
+    """
+    IMAP4-сервер без шифрования в отдельном потоке с собственным циклом asyncio.
+
+    Args:
+        mailboxes (dict): Имя ящика (через "|") -> список писем (bytes)
+        latency (float): Задержка перед каждым ответом в секундах
+        host (str): Адрес для прослушивания
+        port (int): Порт (0 - любой свободный, см. атрибут port)
+        capabilities (bytes): Ответ на CAPABILITY
+        auth_capabilities (bytes): Ответ на CAPABILITY после LOGIN (None - как до входа)
+    """
+
+    def __init__(self, mailboxes, latency=0.0, host='127.0.0.1', port=0,
+                 capabilities=b'IMAP4rev1 IDLE CONDSTORE ENABLE', auth_capabilities=None):
+        self.mailboxes = {name: Mailbox(messages) for name, messages in mailboxes.items()}
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.capabilities = capabilities
+        self.auth_capabilities = auth_capabilities or capabilities
+        # Открытые соединения и соединения в IDLE: writer -> выбранный ящик
+        self._writers = set()
+        self._idling = {}
+        # Количество обработанных команд - для оценки числа обращений к серверу
+        self.commands = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def idling(self):
+        """Количество соединений, ждущих в IDLE."""
+        return len(self._idling)
+
+    def deliver(self, name, content):
+        """Добавляет письмо в ящик и сообщает об этом соединениям в IDLE (из любого потока)."""
+        def append():
+            mailbox = self.mailboxes[name]
+            mailbox.append(content)
+            for writer, selected in list(self._idling.items()):
+                if selected is mailbox:
+                    writer.write(b'* %d EXISTS\r\n' % len(mailbox.messages))
+
+        self._loop.call_soon_threadsafe(append)
+
+    def drop_connections(self):
+        """Обрывает все открытые соединения (из любого потока)."""
+        def drop():
+            for writer in list(self._writers):
+                writer.transport.abort()
+
+        self._loop.call_soon_threadsafe(drop)
+
+    def _fetch(self, mailbox, spec, items):
+        """Формирует нетегированные ответы UID FETCH."""
+        names = re.findall(r'BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|[A-Z0-9.]+', items.upper())
+        max_uid = mailbox.messages[-1][0] if mailbox.messages else 0
+        wanted = _uid_set(spec, max_uid)
+        response = []
+        for sequence, (uid, content) in enumerate(mailbox.messages, 1):
+            if uid not in wanted:
+                continue
+            fields = [b'UID %d' % uid]
+            for name in names:
+                if name == 'RFC822.SIZE':
+                    fields.append(b'RFC822.SIZE %d' % len(content))
+                elif name == 'FLAGS':
+                    fields.append(b'FLAGS ()')
+                elif name == 'BODYSTRUCTURE':
+                    fields.append(b'BODYSTRUCTURE ' + _bodystructure(email.message_from_bytes(content)))
+                elif name.startswith('BODY'):
+                    match = re.match(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', name)
+                    data = _section(content, match.group(1))
+                    label = b'BODY[' + match.group(1).encode() + b']'
+                    if match.group(2):
+                        offset, size = int(match.group(2)), int(match.group(3))
+                        data = data[offset:offset + size]
+                        label += b'<%d>' % offset
+                    fields.append(label + b' {%d}\r\n' % len(data) + data)
+            response.append(b'* %d FETCH (' % sequence + b' '.join(fields) + b')\r\n')
+        return response
+
+    async def _handle(self, reader, writer):
+        selected = None
+        authenticated = False
+        self._writers.add(writer)
+        writer.write(b'* OK fake IMAP4rev1 server ready\r\n')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.commands += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                tag, _, rest = line.rstrip(b'\r\n').decode('utf-8', 'replace').partition(' ')
+                command, _, argument = rest.partition(' ')
+                command = command.upper()
+                if command == 'UID':
+                    command, _, argument = argument.partition(' ')
+                    command = command.upper()
+
+                response = []
+                if command == 'CAPABILITY':
+                    response.append(b'* CAPABILITY ' + (self.auth_capabilities if authenticated else self.capabilities) + b'\r\n')
+                elif command == 'LOGIN':
+                    authenticated = True
+                elif command in ('NOOP', 'CHECK', 'ENABLE'):
+                    pass
+                elif command == 'LOGOUT':
+                    writer.write(b'* BYE logging out\r\n' + tag.encode() + b' OK LOGOUT completed\r\n')
+                    break
+                elif command == 'LIST':
+                    for name in self.mailboxes:
+                        response.append(b'* LIST (\\HasNoChildren) "|" ' + _quote(name) + b'\r\n')
+                elif command in ('SELECT', 'EXAMINE'):
+                    selected = self.mailboxes.get(argument.strip().strip('"'))
+                    if selected is None:
+                        writer.write(tag.encode() + b' NO no such mailbox\r\n')
+                        continue
+                    response.append(b'* %d EXISTS\r\n* 0 RECENT\r\n' % len(selected.messages))
+                    response.append(b'* OK [UIDVALIDITY %d] UIDs valid\r\n' % selected.uidvalidity)
+                    response.append(b'* OK [UIDNEXT %d] Predicted next UID\r\n' % selected.uidnext)
+                    if b'CONDSTORE' in self.capabilities:
+                        response.append(b'* OK [HIGHESTMODSEQ %d] Highest\r\n' % selected.modseq)
+                elif command == 'CLOSE':
+                    selected = None
+                elif command == 'SEARCH' and selected is not None:
+                    uids = [uid for uid, _ in selected.messages]
+                    match = re.search(r'UID (\S+)', argument)
+                    if match:
+                        wanted = _uid_set(match.group(1), uids[-1] if uids else 0)
+                        uids = [uid for uid in uids if uid in wanted]
+                    response.append(b'* SEARCH' + b''.join(b' %d' % uid for uid in uids) + b'\r\n')
+                elif command == 'FETCH' and selected is not None:
+                    spec, _, items = argument.partition(' ')
+                    response.extend(self._fetch(selected, spec, items))
+                elif command == 'IDLE':
+                    writer.write(b'+ idling\r\n')
+                    await writer.drain()
+                    self._idling[writer] = selected
+                    try:
+                        await reader.readline()
+                    finally:
+                        self._idling.pop(writer, None)
+                else:
+                    writer.write(tag.encode() + b' BAD unsupported command\r\n')
+                    continue
+                response.append(tag.encode() + b' OK ' + command.encode() + b' completed\r\n')
+                writer.write(b''.join(response))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        self._writers.discard(writer)
+        writer.close()
@@ -0,0 +1,119 @@
+"""
+Генератор синтетических писем для бенчмарков.
+
+Письма детерминированы (зависят только от номера и seed), поэтому
+прогоны на разных машинах и коммитах сравнимы. Размер текста, доля
+писем с вложениями и вес HTML-части настраиваются.
+
+    python benchmarks/mailgen.py corpus/ --messages 1000 --size 4096 --attachments 0.2 --html-weight 3
+"""
+import os
+import random
+import argparse
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+WORDS = ('письмо отчет счет оплата встреча проект задача сроки договор клиент новости скидка '
+         'invoice report meeting project deadline update order delivery account payment review team').split()
+
+
+def _text(rng, size):
+    """Возвращает текст из случайных слов примерно указанного размера в байтах."""
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))).capitalize() + '.'
+        lines.append(line)
+        length += len(line.encode('utf-8')) + 1
+    return '\n'.join(lines) + '\n'
+
+
+def _html(rng, size):
+    """Возвращает HTML рассылки (таблицы, inline-стили) примерно указанного размера."""
+    rows = []
+    length = 0
+    while length < size:
+        row = (f'<tr><td class="item" style="padding:12px;border-bottom:1px solid #eee;font-family:Arial">'
+               f'<p style="margin:0;color:#333">{_text(rng, 120).strip()}</p>'
+               f'<a href="https://example.com/{rng.randint(1, 10 ** 6)}?utm_source=mail" style="color:#07f">'
+               f'Подробнее&nbsp;&raquo;</a></td></tr>')
+        rows.append(row)
+        length += len(row.encode('utf-8'))
+    return ('<html><head><style>.item{background:#fafafa}</style></head><body style="margin:0">'
+            '<table width="600" align="center">' + ''.join(rows) + '</table></body></html>')
+
+
+def generate_message(number, size=4096, attachment_ratio=0.1, html_weight=2.0, attachment_size=64 * 1024, seed=0):
+    """
+    Создает одно синтетическое письмо.
+
+    Args:
+        number (int): Номер письма (определяет содержимое вместе с seed)
+        size (int): Примерный размер текстовой части в байтах
+        attachment_ratio (float): Доля писем с вложением (0..1)
+        html_weight (float): Размер HTML-части относительно текстовой (0 - без HTML)
+        attachment_size (int): Размер вложения в байтах
+        seed (int): Зерно генератора
+
+    Returns:
+        bytes: Письмо в формате RFC 5322
+    """
+    rng = random.Random(seed * 1000003 + number)
+    msg = EmailMessage()
+    msg['Subject'] = f'{rng.choice(WORDS).capitalize()} {rng.choice(WORDS)} #{number}'
+    msg['From'] = f'sender{rng.randint(1, 50)}@example.com'
+    msg['To'] = 'user@yandex.ru'
+    msg['Date'] = format_datetime(datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=number))
+    msg['Message-ID'] = f'<bench-{seed}-{number}@example.com>'
+    msg.set_content(_text(rng, size))
+    if html_weight > 0:
+        msg.add_alternative(_html(rng, int(size * html_weight)), subtype='html')
+    if rng.random() < attachment_ratio:
+        msg.add_attachment(rng.randbytes(attachment_size), maintype='application', subtype='octet-stream',
+                           filename=f'file-{number}.bin')
+    # Постоянные границы MIME, чтобы письмо зависело только от номера и seed
+    for index, part in enumerate(part for part in msg.walk() if part.is_multipart()):
+        part.set_boundary(f'bench-boundary-{number}-{index}')
+    return msg.as_bytes()
+
+
+def generate_corpus(count, **options):
+    """Возвращает список из count писем (bytes), параметры - как у generate_message."""
+    return [generate_message(number, **options) for number in range(1, count + 1)]
+
+
+def write_corpus(folder, count, **options):
+    """
+    Записывает письма в папку как <uid>.eml, так же как их сохраняет загрузчик.
+
+    Returns:
+        int: Суммарный размер писем в байтах
+    """
+    os.makedirs(folder, exist_ok=True)
+    total = 0
+    for uid, content in enumerate(generate_corpus(count, **options), 1):
+        with open(os.path.join(folder, f'{uid}.eml'), 'wb') as f:
+            f.write(content)
+        total += len(content)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic EML corpus for benchmarks')
+    parser.add_argument('folder', help='Output folder for <uid>.eml files')
+    parser.add_argument('--messages', type=int, default=1000, help='Number of emails')
+    parser.add_argument('--size', type=int, default=4096, help='Approximate size of the text part in bytes')
+    parser.add_argument('--attachments', type=float, default=0.1, help='Share of emails with an attachment (0..1)')
+    parser.add_argument('--attachment-size', type=int, default=64 * 1024, help='Attachment size in bytes')
+    parser.add_argument('--html-weight', type=float, default=2.0, help='HTML part size relative to the text part (0 - no HTML)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    total = write_corpus(args.folder, args.messages, size=args.size, attachment_ratio=args.attachments,
+                         html_weight=args.html_weight, attachment_size=args.attachment_size, seed=args.seed)
+    print(f'Written {args.messages} emails ({total / 1024 / 1024:.1f} MiB) to {args.folder}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Общие фикстуры тестов: загрузчик и фейковый IMAP-сервер из benchmarks.
+"""
+import os
+import sys
+import imaplib
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import yandex_mail_downloader as downloader
+from fake_imap import FakeIMAPServer
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    """Построчный вывод и строка прогресса загрузчика тестам не нужны."""
+    downloader.set_verbosity(downloader.QUIET)
+    yield
+    downloader.set_verbosity(downloader.NORMAL)
+
+
+@pytest.fixture
+def imap_server():
+    """Запускает FakeIMAPServer с заданными ящиками и возвращает соединение imaplib с ним."""
+    servers = []
+    connections = []
+
+    def start(mailboxes, **options):
+        server = FakeIMAPServer(mailboxes, **options).start()
+        servers.append(server)
+        connection = imaplib.IMAP4('127.0.0.1', server.port)
+        connection.login('test', 'test')
+        connections.append(connection)
+        return server, connection
+
+    yield start
+    for connection in connections:
+        try:
+            connection.logout()
+        except Exception:
+            pass
+    for server in servers:
+        server.stop()
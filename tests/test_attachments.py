@@ -0,0 +1,159 @@
+"""
+Потоковое отделение вложений (_AttachmentSplitter) и хранилище вложений (AttachmentStore).
+
+Письмо без тел вложений вместе с сохраненными телами должно давать то же,
+что разбор исходного письма BytesParser.
+"""
+import io
+import os
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+
+import pytest
+
+from conftest import downloader
+
+PDF = b'%PDF-1.4\n' + bytes(range(256)) * 40
+BINARY = bytes(range(256)) * 3 + b'\r\n\n\r' * 10
+TEXT_FILE = 'строка с переводом\nвторая строка = с равенством\t\n'.encode('utf-8')
+
+
+def split(raw):
+    """Отделяет вложения от письма: (разобранное письмо без тел, сплиттер, сохраненные вложения)."""
+    saved = []
+
+    def save(part, chunks):
+        encoding = str(part.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+        saved.append((part.get_filename(), part.get_content_type(), b''.join(downloader._iter_decoded_chunks(chunks, encoding))))
+
+    splitter = downloader._AttachmentSplitter(io.BytesIO(raw), save)
+    skeleton = BytesParser(policy=policy.default).parsebytes(splitter.split())
+    return skeleton, splitter, saved
+
+
+def assert_same_as_parser(raw, attachments):
+    """Сверяет письмо без тел и сохраненные вложения с разбором исходного письма."""
+    original = BytesParser(policy=policy.default).parsebytes(raw)
+    skeleton, splitter, saved = split(raw)
+    original_parts = list(original.walk())
+    skeleton_parts = list(skeleton.walk())
+    assert len(skeleton_parts) == len(original_parts)
+
+    found = 0
+    for expected, part in zip(original_parts, skeleton_parts):
+        assert part.get_content_type() == expected.get_content_type()
+        index = splitter.index(part)
+        if index is not None:
+            filename, content_type, content = saved[index]
+            assert (filename, content_type) == (expected.get_filename(), expected.get_content_type())
+            assert content == expected.get_payload(decode=True)
+            found += 1
+        elif part.is_multipart():
+            assert part.preamble == expected.preamble
+            assert part.epilogue == expected.epilogue
+        elif part.get_content_maintype() != 'message':
+            assert part.get_payload(decode=True) == expected.get_payload(decode=True)
+    assert found == len(saved) == attachments
+
+
+def nested_message(linesep):
+    inner = EmailMessage()
+    inner['Subject'] = 'Forwarded'
+    inner.set_content('Inner text\n')
+    inner.add_attachment(BINARY, maintype='application', subtype='octet-stream', filename='inner.bin')
+
+    msg = EmailMessage()
+    msg['Subject'] = 'Nested'
+    msg['From'] = 'sender@example.com'
+    msg.set_content('Plain text\n')
+    msg.add_alternative('<p>HTML text</p>\n', subtype='html')
+    msg.add_attachment(PDF, maintype='application', subtype='pdf', filename='doc.pdf')
+    msg.add_attachment(inner)
+    return msg.as_bytes(policy=policy.default.clone(linesep=linesep))
+
+
+@pytest.mark.parametrize('linesep', ['\r\n', '\n'])
+def test_nested_multipart_and_message(linesep):
+    raw = nested_message(linesep)
+    assert (b'\r\n' in raw) == (linesep == '\r\n')
+    assert_same_as_parser(raw, 2)
+
+
+def test_boundary_prefix_of_another():
+    """Граница вложенной части начинается с границы внешней."""
+    raw = (b'Subject: Prefix\r\nMIME-Version: 1.0\r\nContent-Type: multipart/mixed; boundary="abc"\r\n\r\n'
+           b'--abc\r\nContent-Type: multipart/alternative; boundary="abcdef"\r\n\r\n'
+           b'--abcdef\r\nContent-Type: text/plain\r\n\r\ntext\r\n'
+           b'--abcdef\r\nContent-Type: text/html\r\n\r\n<p>html</p>\r\n'
+           b'--abcdef--\r\n'
+           b'--abc\r\nContent-Type: application/octet-stream\r\nContent-Disposition: attachment; filename="a.bin"\r\n\r\n'
+           b'--abcd is not a boundary\r\nbinary data\r\n'
+           b'--abc--\r\nepilogue\r\n')
+    assert_same_as_parser(raw, 1)
+    skeleton, splitter, saved = split(raw)
+    assert saved[0][2] == b'--abcd is not a boundary\r\nbinary data'
+
+
+def test_missing_closing_boundary():
+    """Письмо оборвано внутри вложения: сохраняется все, что есть до конца файла."""
+    raw = (b'Subject: Truncated\r\nMIME-Version: 1.0\r\nContent-Type: multipart/mixed; boundary="b1"\r\n\r\n'
+           b'--b1\r\nContent-Type: text/plain\r\n\r\ntext\r\n'
+           b'--b1\r\nContent-Type: application/octet-stream\r\nContent-Disposition: attachment; filename="a.bin"\r\n\r\n'
+           b'first line\r\nlast line without end')
+    assert_same_as_parser(raw, 1)
+
+
+@pytest.mark.parametrize('cte', ['base64', 'quoted-printable'])
+def test_encoded_attachments(cte):
+    msg = EmailMessage()
+    msg['Subject'] = cte
+    msg.set_content('Text\n')
+    msg.add_attachment(BINARY, maintype='application', subtype='octet-stream', filename='data.bin', cte=cte)
+    msg.add_attachment(TEXT_FILE, maintype='application', subtype='x-notes', filename='notes.txt', cte=cte)
+    raw = msg.as_bytes()
+    assert f'Content-Transfer-Encoding: {cte}'.encode() in raw
+    assert_same_as_parser(raw, 2)
+
+
+def test_forged_marker_is_ignored():
+    """Заголовок ATTACHMENT_MARKER, пришедший в письме, не принимается за вынесенное вложение."""
+    msg = EmailMessage()
+    msg.set_content('Text\n')
+    msg.add_attachment(PDF, maintype='application', subtype='pdf', filename='doc.pdf')
+    msg.get_payload()[0][downloader.ATTACHMENT_MARKER] = 'forged:0'
+    skeleton, splitter, saved = split(msg.as_bytes())
+    assert [splitter.index(part) for part in skeleton.walk()] == [None, None, 0]
+
+
+def test_attachment_store_dedup(tmp_path):
+    store = downloader.AttachmentStore(str(tmp_path))
+    first = store.save('a.pdf', 'application/pdf', [PDF[:100], PDF[100:]])
+    second = store.save('copy.pdf', 'application/pdf', [PDF])
+
+    assert first['blob'] == second['blob']
+    assert first['size'] == second['size'] == len(PDF)
+    assert (first['filename'], second['filename']) == ('a.pdf', 'copy.pdf')
+    with open(first['blob'], 'rb') as f:
+        assert f.read() == PDF
+    blobs = [name for _, _, names in os.walk(os.path.join(tmp_path, 'blobs')) for name in names]
+    assert blobs == [first['sha256']]
+    assert os.listdir(os.path.join(tmp_path, 'tmp')) == []
+
+
+def test_attachment_store_skips_large(tmp_path):
+    store = downloader.AttachmentStore(str(tmp_path), max_size=1000)
+    requested = []
+
+    def chunks():
+        for start in range(0, len(PDF), 400):
+            requested.append(start)
+            yield PDF[start:start + 400]
+
+    entry = store.save('big.pdf', 'application/pdf', chunks())
+
+    assert entry['skipped'] and entry['blob'] is None and entry['sha256'] is None
+    # Куски после превышения лимита не запрашиваются
+    assert requested == [0, 400, 800]
+    assert not os.path.exists(os.path.join(tmp_path, 'blobs'))
+    assert os.listdir(os.path.join(tmp_path, 'tmp')) == []
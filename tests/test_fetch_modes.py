@@ -0,0 +1,113 @@
+"""
+Режимы загрузки fetch_messages на фейковом IMAP-сервере.
+"""
+import re
+import email
+from email import policy
+from email.message import EmailMessage
+
+import pytest
+
+from conftest import downloader
+
+
+def plain_message(number):
+    msg = EmailMessage()
+    msg['Subject'] = f'Plain {number}'
+    msg['Message-ID'] = f'<plain-{number}@example.com>'
+    msg.set_content(f'Plain text {number}\n')
+    return msg.as_bytes()
+
+
+def message_with_pdf(number):
+    msg = EmailMessage()
+    msg['Subject'] = f'With PDF {number}'
+    msg['Message-ID'] = f'<pdf-{number}@example.com>'
+    msg.set_content(f'Text with attachment {number}\n')
+    msg.add_attachment(b'%PDF-1.4 ' + bytes(range(256)) * 200, maintype='application', subtype='pdf', filename='doc.pdf')
+    return msg.as_bytes()
+
+
+@pytest.mark.parametrize('order', ['plain_first', 'multipart_first'])
+def test_text_mode_mixes_single_part_and_multipart(imap_server, order):
+    """Одночастное письмо и multipart с одной текстовой частью и PDF не должны смешиваться в одну группу."""
+    messages = [plain_message(1), message_with_pdf(2), plain_message(3), message_with_pdf(4)]
+    if order == 'multipart_first':
+        messages.reverse()
+    server, connection = imap_server({'INBOX': messages})
+    connection.select('INBOX', readonly=True)
+    # Команды FETCH: (набор UID, элементы)
+    commands = []
+    uid_command = connection.uid
+
+    def record(command, *args):
+        if command == 'FETCH':
+            commands.append(args)
+        return uid_command(command, *args)
+
+    connection.uid = record
+
+    results = {uid: (content, error) for uid, content, error in
+               downloader.fetch_messages(connection, ['1', '2', '3', '4'], mode='text')}
+
+    # Одночастные письма запрашиваются через BODY[TEXT], multipart - по номерам частей
+    plain = '1,3' if order == 'plain_first' else '2,4'
+    multipart = '2,4' if order == 'plain_first' else '1,3'
+    assert (plain, '(UID BODY.PEEK[TEXT])') in commands
+    assert (multipart, '(UID BODY.PEEK[1.MIME] BODY.PEEK[1])') in commands
+
+    assert sorted(results) == ['1', '2', '3', '4']
+    for uid, (content, error) in results.items():
+        assert error is None
+        original = email.message_from_bytes(messages[int(uid) - 1], policy=policy.default)
+        saved = email.message_from_bytes(content, policy=policy.default)
+        assert saved[downloader.PARTIAL_HEADER.decode()] == 'text'
+        assert saved['Message-ID'] == original['Message-ID']
+        # Текст письма сохранен, вложение не скачано
+        assert saved.get_body(('plain',)).get_content() == original.get_body(('plain',)).get_content()
+        assert not any(part.get_filename() for part in saved.walk())
+        assert b'%PDF' not in content
+        assert len(content) < 2048
+
+
+def test_full_mode_matches_server(imap_server):
+    """В режиме full письма сохраняются байт в байт."""
+    messages = [plain_message(1), message_with_pdf(2)]
+    server, connection = imap_server({'INBOX': messages})
+    connection.select('INBOX', readonly=True)
+
+    results = list(downloader.fetch_messages(connection, ['1', '2'], mode='full'))
+
+    assert [(uid, content, error) for uid, content, error in results] == [('1', messages[0], None), ('2', messages[1], None)]
+
+
+def test_size_mismatch_is_saved(imap_server):
+    """Письмо, размер которого не совпал с RFC822.SIZE, сохраняется как есть."""
+    messages = [plain_message(1), plain_message(2)]
+    server, connection = imap_server({'INBOX': messages})
+    connection.select('INBOX', readonly=True)
+    uid_command = connection.uid
+
+    def inflate_size(command, *args):
+        # Сервер завышает RFC822.SIZE на 10 байт
+        typ, data = uid_command(command, *args)
+        return typ, [(re.sub(rb'RFC822\.SIZE (\d+)', lambda m: b'RFC822.SIZE %d' % (int(m.group(1)) + 10), item[0]), item[1])
+                     if isinstance(item, tuple) else item for item in data]
+
+    connection.uid = inflate_size
+
+    results = list(downloader.fetch_messages(connection, ['1', '2'], mode='full'))
+
+    assert results == [('1', messages[0], None), ('2', messages[1], None)]
+
+
+@pytest.mark.parametrize('reported', [-100, 0, 100])
+def test_streamed_message_ignores_reported_size(imap_server, reported):
+    """Потоковая загрузка читает письмо до конца, даже если RFC822.SIZE неверен."""
+    messages = [message_with_pdf(1)]
+    server, connection = imap_server({'INBOX': messages})
+    connection.select('INBOX', readonly=True)
+
+    chunks = list(downloader.fetch_message_chunks(connection, '1', len(messages[0]) + reported, chunk_size=4096))
+
+    assert b''.join(chunks) == messages[0]
@@ -0,0 +1,183 @@
+"""
+Повторные запуски run_account: --incremental, --sync и смена UIDVALIDITY на фейковом IMAP-сервере.
+"""
+import os
+import imaplib
+import mailbox
+
+import pytest
+
+from conftest import downloader
+from fake_imap import Mailbox
+from mailgen import generate_message
+
+
+class RecordingIMAP4(imaplib.IMAP4):
+    """Соединение без SSL, запоминающее критерии всех команд UID SEARCH."""
+
+    searches = []
+
+    def uid(self, command, *args):
+        if command == 'SEARCH':
+            self.searches.append(args[-1])
+        return super().uid(command, *args)
+
+
+@pytest.fixture
+def account(imap_server, tmp_path, monkeypatch):
+    """Запускает фейковый сервер и возвращает (server, run); run(*options) загружает аккаунт в tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(imaplib, 'IMAP4_SSL', lambda host, port, ssl_context=None: RecordingIMAP4(host, port))
+    servers = []
+
+    def start(messages):
+        server, connection = imap_server({'INBOX': messages})
+        servers.append(server)
+        return server
+
+    def run(*options):
+        RecordingIMAP4.searches = []
+        args = downloader.build_parser().parse_args(['user', 'password', '--server', '127.0.0.1',
+                                                     '--port', str(servers[-1].port), *options])
+        return downloader.run_account(args)
+
+    return start, run
+
+
+def local_uids():
+    return sorted(int(name[:-4]) for name in os.listdir(os.path.join('user', 'INBOX')) if name.endswith('.eml'))
+
+
+def test_incremental_downloads_only_new_mail(account):
+    start, run = account
+    server = start([generate_message(uid) for uid in range(1, 4)])
+    assert run('--incremental')['saved'] == 3
+
+    # Неизменившийся ящик не требует ни одной команды SEARCH
+    assert run('--incremental')['saved'] == 0
+    assert RecordingIMAP4.searches == []
+
+    server.mailboxes['INBOX'].append(generate_message(4))
+    server.mailboxes['INBOX'].append(generate_message(5))
+    assert run('--incremental')['saved'] == 2
+    assert RecordingIMAP4.searches == ['UID 4:*']
+    assert local_uids() == [1, 2, 3, 4, 5]
+    with open(os.path.join('user', 'INBOX', '5.eml'), 'rb') as f:
+        assert f.read() == generate_message(5)
+
+
+def test_delta_returning_last_known_email(account):
+    """Для "UID n:*" сервер возвращает последнее письмо, даже если его UID меньше n."""
+    start, run = account
+    server = start([generate_message(uid) for uid in range(1, 4)])
+    run('--incremental')
+
+    # Письмо пришло и удалено до следующего запуска: UIDNEXT вырос, а новых писем нет
+    server.mailboxes['INBOX'].append(generate_message(4))
+    server.mailboxes['INBOX'].messages.pop()
+    summary = run('--incremental', '--sync')
+
+    assert summary['saved'] == 0 and summary['removed'] == 0
+    assert RecordingIMAP4.searches == ['UID 4:*']
+    assert local_uids() == [1, 2, 3]
+
+
+def test_expunge_then_sync(account):
+    """Удаленное на сервере письмо находится по расхождению EXISTS и удаляется с --sync."""
+    start, run = account
+    server = start([generate_message(uid) for uid in range(1, 5)])
+    run('--incremental')
+
+    messages = server.mailboxes['INBOX'].messages
+    messages[:] = [message for message in messages if message[0] != 2]
+    summary = run('--incremental', '--sync')
+
+    assert summary['removed'] == 1
+    # EXISTS не сошелся с индексом: после поиска новых писем запрошен полный список
+    assert RecordingIMAP4.searches == ['UID 5:*', 'ALL']
+    assert local_uids() == [1, 3, 4]
+
+    # Следующий запуск видит ящик неизменившимся
+    assert run('--incremental', '--sync')['removed'] == 0
+    assert RecordingIMAP4.searches == []
+
+
+def test_expunge_without_sync_keeps_local_copy(account):
+    start, run = account
+    server = start([generate_message(uid) for uid in range(1, 4)])
+    run('--incremental')
+
+    server.mailboxes['INBOX'].messages.pop(0)
+    summary = run('--incremental')
+
+    assert summary['removed'] == 0 and summary['saved'] == 0
+    assert local_uids() == [1, 2, 3]
+
+
+def test_uidvalidity_change(account):
+    """После смены UIDVALIDITY индекс ящика строится заново, а письма скачиваются снова."""
+    start, run = account
+    server = start([generate_message(uid) for uid in range(1, 4)])
+    run('--incremental')
+
+    renumbered = [generate_message(uid) for uid in range(10, 12)]
+    server.mailboxes['INBOX'] = Mailbox(renumbered, uidvalidity=2)
+    summary = run('--incremental', '--sync')
+
+    assert summary['saved'] == 2
+    assert 'ALL' in RecordingIMAP4.searches
+    assert local_uids() == [1, 2]
+    for uid, content in enumerate(renumbered, 1):
+        with open(os.path.join('user', 'INBOX', f'{uid}.eml'), 'rb') as f:
+            assert f.read() == content
+
+
+def test_connection_error_is_account_error(account, monkeypatch):
+    start, run = account
+    start([])
+
+    def refuse(host, port, ssl_context=None):
+        raise ConnectionRefusedError('refused')
+
+    monkeypatch.setattr(imaplib, 'IMAP4_SSL', refuse)
+    with pytest.raises(downloader.AccountError, match='Failed to connect'):
+        run()
+
+
+def test_failed_account_closes_resources(account, monkeypatch):
+    """Ошибка посреди загрузки не оставляет открытыми индексы и хранилище аккаунта."""
+    start, run = account
+    start([generate_message(uid) for uid in range(1, 4)])
+    closed = []
+    for cls in (downloader.SyncState, downloader.PackStore, downloader.SearchIndex):
+        monkeypatch.setattr(cls, 'close', lambda self, close=cls.close: closed.append(type(self)) or close(self))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('broken mailbox')
+
+    monkeypatch.setattr(downloader, 'download_emails', fail)
+    with pytest.raises(RuntimeError):
+        run('--store', 'pack', '--index')
+    assert set(closed) == {downloader.SyncState, downloader.PackStore}
+
+
+def mbox_numbers():
+    """Номера писем mailgen в Mbox-файле ящика в порядке записи."""
+    return [int(message['Subject'].rsplit('#', 1)[1]) for message in mailbox.mbox(os.path.join('user', 'INBOX', 'INBOX.mbox'))]
+
+
+def test_sync_removes_expunged_email_from_mbox(account):
+    """Mbox-файл дописывается новыми письмами, а после удаления писем с --sync пересоздается без них."""
+    start, run = account
+    server = start([generate_message(uid) for uid in range(1, 4)])
+    run('--incremental', '--mbox')
+    assert mbox_numbers() == [1, 2, 3]
+
+    server.mailboxes['INBOX'].append(generate_message(4))
+    run('--incremental', '--mbox')
+    assert mbox_numbers() == [1, 2, 3, 4]
+
+    messages = server.mailboxes['INBOX'].messages
+    messages[:] = [message for message in messages if message[0] != 2]
+    assert run('--incremental', '--sync', '--mbox')['removed'] == 1
+    assert mbox_numbers() == [1, 3, 4]
@@ -0,0 +1,133 @@
+"""
+Режим зеркалирования (AsyncIMAPClient, mirror_mailbox) на фейковом IMAP-сервере.
+"""
+import os
+import time
+import asyncio
+import contextlib
+
+from conftest import downloader, FakeIMAPServer
+from mailgen import generate_message
+
+
+async def wait_until(predicate, timeout=10):
+    """Ждет выполнения условия, не блокируя цикл событий."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition was not met in time')
+        await asyncio.sleep(0.05)
+
+
+@contextlib.asynccontextmanager
+async def mirroring(server, tmp_path, postprocess=None):
+    """Зеркалирует INBOX фейкового сервера в tmp_path/INBOX, пока выполняется блок."""
+    # Опрос NOOP раз в час: новые письма может принести только IDLE или переподключение
+    args = downloader.build_parser().parse_args(['test', 'test', '--poll-interval', '3600'])
+    folder = os.path.join(tmp_path, 'INBOX')
+    os.makedirs(folder)
+    state = downloader.SyncState(str(tmp_path))
+    task = asyncio.ensure_future(downloader.mirror_mailbox('INBOX', 'INBOX', folder, state, args, '127.0.0.1', server.port,
+                                                           use_ssl=False, postprocess=postprocess))
+    try:
+        yield folder
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        state.close()
+
+
+def test_idle_wakes_up_on_exists(tmp_path):
+    """Письмо, о котором сервер сообщил "* N EXISTS" во время IDLE, скачивается и обрабатывается сразу."""
+    processed = []
+
+    async def scenario(server):
+        async with mirroring(server, tmp_path, lambda *mailbox: processed.append(mailbox)) as folder:
+            await wait_until(lambda: os.path.exists(os.path.join(folder, '2.eml')) and server.idling)
+            server.deliver('INBOX', generate_message(3))
+            await wait_until(lambda: os.path.exists(os.path.join(folder, '3.eml')) and len(processed) == 2)
+
+        with open(os.path.join(folder, '3.eml'), 'rb') as f:
+            assert f.read() == generate_message(3)
+        assert processed == [('INBOX', folder)] * 2
+
+    with FakeIMAPServer({'INBOX': [generate_message(1), generate_message(2)]}) as server:
+        asyncio.run(scenario(server))
+
+
+def test_reconnects_after_dropped_connection(tmp_path):
+    """После обрыва соединения зеркалирование переподключается и скачивает письма, пришедшие без него."""
+    async def scenario(server):
+        async with mirroring(server, tmp_path) as folder:
+            await wait_until(lambda: os.path.exists(os.path.join(folder, '1.eml')) and server.idling)
+            server.drop_connections()
+            server.deliver('INBOX', generate_message(2))
+            await wait_until(lambda: os.path.exists(os.path.join(folder, '2.eml')))
+
+    with FakeIMAPServer({'INBOX': [generate_message(1)]}) as server:
+        asyncio.run(scenario(server))
+
+
+def test_capabilities_are_refreshed_after_login():
+    """Возможности, объявленные сервером только после входа (например IDLE), учитываются."""
+    async def scenario(server):
+        client = downloader.AsyncIMAPClient('127.0.0.1', server.port, use_ssl=False)
+        await client.connect()
+        assert 'IDLE' not in client.capabilities
+        await client.login('test', 'test')
+        assert 'IDLE' in client.capabilities
+        await client.logout()
+
+    with FakeIMAPServer({'INBOX': []}, capabilities=b'IMAP4rev1', auth_capabilities=b'IMAP4rev1 IDLE') as server:
+        asyncio.run(scenario(server))
+
+
+class HidingServer(FakeIMAPServer):
+    """Не возвращает тело письма с UID hidden при первом запросе."""
+
+    hidden = 2
+
+    def _fetch(self, mailbox, spec, items):
+        response = super()._fetch(mailbox, spec, items)
+        if 'BODY' in items.upper() and self.hidden is not None:
+            kept = [line for line in response if b'(UID %d ' % self.hidden not in line]
+            if len(kept) != len(response):
+                self.hidden = None
+            response = kept
+        return response
+
+
+def test_failed_email_is_retried(tmp_path):
+    """Письмо, которое не удалось скачать, запрашивается снова, хотя письма с большими UID уже сохранены."""
+    async def scenario(server):
+        async with mirroring(server, tmp_path) as folder:
+            await wait_until(lambda: os.path.exists(os.path.join(folder, '3.eml')) and server.idling)
+            assert server.hidden is None and not os.path.exists(os.path.join(folder, '2.eml'))
+            server.deliver('INBOX', generate_message(4))
+            await wait_until(lambda: os.path.exists(os.path.join(folder, '4.eml')) and os.path.exists(os.path.join(folder, '2.eml')))
+
+    with HidingServer({'INBOX': [generate_message(1), generate_message(2), generate_message(3)]}) as server:
+        asyncio.run(scenario(server))
+
+
+def test_mailbox_error_does_not_stop_mirroring(tmp_path, monkeypatch):
+    """Неожиданная ошибка ящика не завершает зеркалирование: ящик перезапускается после паузы."""
+    download_emails = downloader.download_emails
+    calls = []
+
+    def failing_once(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError('database is locked')
+        return download_emails(*args)
+
+    monkeypatch.setattr(downloader, 'download_emails', failing_once)
+
+    async def scenario(server):
+        async with mirroring(server, tmp_path) as folder:
+            await wait_until(lambda: os.path.exists(os.path.join(folder, '1.eml')))
+        assert len(calls) == 2
+
+    with FakeIMAPServer({'INBOX': [generate_message(1)]}) as server:
+        asyncio.run(scenario(server))
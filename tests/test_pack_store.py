@@ -0,0 +1,53 @@
+"""
+Упакованное хранилище писем (PackStore): перенос EML-файлов и копии для процессов пула.
+"""
+import os
+import pickle
+import sqlite3
+
+import pytest
+
+from conftest import downloader
+from mailgen import generate_message
+
+
+@pytest.mark.parametrize('codec', sorted(downloader.PACK_CODECS))
+def test_import_folder(tmp_path, codec):
+    """EML-файлы переносятся в хранилище частями и удаляются, жесткие ссылки становятся одной записью."""
+    folder = tmp_path / 'INBOX'
+    folder.mkdir()
+    messages = {1: generate_message(1), 2: generate_message(2, size=3 * downloader.STREAM_CHUNK_SIZE)}
+    for uid, content in messages.items():
+        (folder / f'{uid}.eml').write_bytes(content)
+    os.link(folder / '2.eml', folder / '3.eml')
+
+    store = downloader.PackStore(str(tmp_path), codec)
+    assert store.import_folder('INBOX', str(folder)) == 3
+    assert os.listdir(folder) == []
+    assert store.get('INBOX', 1) == messages[1]
+    assert store.get('INBOX', 2) == store.get('INBOX', 3) == messages[2]
+    assert dict(store.sizes('INBOX')) == {1: len(messages[1]), 2: len(messages[2]), 3: len(messages[2])}
+    locations = store._db.execute('SELECT uid, segment, offset FROM messages ORDER BY uid').fetchall()
+    assert locations[1][1:] == locations[2][1:]
+    store.close()
+
+
+def test_pickled_store_is_read_only(tmp_path):
+    """Копия хранилища в процессе пула читает письма, но не пишет в индекс и закрывается после задачи."""
+    store = downloader.PackStore(str(tmp_path))
+    store.put('INBOX', 1, generate_message(1))
+    store.commit()
+
+    copy = pickle.loads(pickle.dumps(store))
+    assert copy.read_only
+    assert copy.get('INBOX', 1) == generate_message(1)
+    with pytest.raises(sqlite3.OperationalError):
+        copy._db.execute('DELETE FROM messages')
+
+    output_dir = str(tmp_path / 'out')
+    results = downloader._process_eml_chunk(['1.eml'], str(tmp_path), output_dir,
+                                            {'txt': True, 'store': copy, 'mailbox_name': 'INBOX'})
+    assert results[0][2] is None
+    with pytest.raises(sqlite3.ProgrammingError):
+        copy._db.execute('SELECT 1')
+    store.close()
@@ -0,0 +1,150 @@
+"""
+Продолжение прерванной работы: журнал CheckpointJournal и объединение HTML с .part-файлом.
+"""
+import os
+
+import pytest
+
+from conftest import downloader
+
+SIGNATURE = {'stage': 'test'}
+
+
+def test_journal_reopens_intact_file_without_rewriting(tmp_path):
+    path = str(tmp_path / 'stage.journal')
+    journal = downloader.CheckpointJournal(path, SIGNATURE)
+    journal.append({'n': 1})
+    journal.append({'n': 2})
+    journal.close()
+    inode = os.stat(path).st_ino
+
+    journal = downloader.CheckpointJournal(path, SIGNATURE)
+    journal.append({'n': 3})
+    journal.close()
+
+    assert os.stat(path).st_ino == inode
+    assert downloader.CheckpointJournal(path, SIGNATURE).entries == [{'n': 1}, {'n': 2}, {'n': 3}]
+
+
+@pytest.mark.parametrize('tail', ['{"n": 3', '{"n": 3}'])
+def test_journal_drops_torn_last_line(tmp_path, tail):
+    """Недописанная последняя строка (в том числе без перевода строки) отбрасывается или дописывается заново."""
+    path = str(tmp_path / 'stage.journal')
+    journal = downloader.CheckpointJournal(path, SIGNATURE)
+    journal.append({'n': 1})
+    journal.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(tail)
+
+    journal = downloader.CheckpointJournal(path, SIGNATURE)
+    expected = [{'n': 1}] + ([{'n': 3}] if tail.endswith('}') else [])
+    assert journal.entries == expected
+    journal.append({'n': 4})
+    journal.close()
+
+    assert downloader.CheckpointJournal(path, SIGNATURE).entries == expected + [{'n': 4}]
+
+
+def test_journal_with_other_signature_starts_over(tmp_path):
+    path = str(tmp_path / 'stage.journal')
+    journal = downloader.CheckpointJournal(path, SIGNATURE)
+    journal.append({'n': 1})
+    journal.close()
+
+    assert downloader.CheckpointJournal(path, {'stage': 'other'}).entries == []
+
+
+@pytest.fixture
+def letters(tmp_path):
+    """25 HTML-писем с многобайтным текстом (смещения в файле не равны числу символов)."""
+    input_dir = tmp_path / 'letters'
+    input_dir.mkdir()
+    names = []
+    for i in range(1, 26):
+        name = f'{i:02d}.eml.html'
+        (input_dir / name).write_text(f'<html><body><p>Письмо №{i}: ёжик — {"я" * i}</p></body></html>', encoding='utf-8')
+        names.append(name)
+    return str(input_dir), names
+
+
+def merge(input_dir, names, output_dir):
+    return downloader.merge_html_files_with_separators(input_dir, names, output_dir, batch=10)
+
+
+def read_outputs(output_dir):
+    return {name: open(os.path.join(output_dir, name), 'rb').read()
+            for name in os.listdir(output_dir) if name.endswith('.html')}
+
+
+def interrupted_merge(input_dir, names, output_dir, monkeypatch, after):
+    """Прерывает объединение после after писем, как Ctrl+C."""
+    added = []
+    add = downloader.metrics.add
+
+    def interrupt(*args, **kwargs):
+        added.append(args)
+        if len(added) == after:
+            raise KeyboardInterrupt
+        return add(*args, **kwargs)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(downloader.metrics, 'add', interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            merge(input_dir, names, output_dir)
+
+
+@pytest.mark.parametrize('damage', ['none', 'torn_journal', 'torn_part'])
+def test_resumed_merge_matches_clean_run(tmp_path, letters, monkeypatch, damage):
+    input_dir, names = letters
+    clean_dir = str(tmp_path / 'clean')
+    merge(input_dir, names, clean_dir)
+
+    output_dir = str(tmp_path / 'resumed')
+    interrupted_merge(input_dir, names, output_dir, monkeypatch, after=24)
+    summary_part = os.path.join(output_dir, 'result.html' + downloader.PARTIAL_SUFFIX)
+    journal_path = os.path.join(output_dir, downloader.MERGE_JOURNAL)
+    assert os.path.exists(summary_part)
+    with open(journal_path, encoding='utf-8') as f:
+        # Подпись и две законченные пачки из трех
+        assert len(f.read().splitlines()) == 3
+
+    if damage == 'torn_journal':
+        # Запись о второй пачке оборвана на середине
+        with open(journal_path, 'rb') as f:
+            content = f.read()
+        with open(journal_path, 'wb') as f:
+            f.write(content[:len(content) - 20])
+    elif damage == 'torn_part':
+        # Общий файл оборван на середине многобайтного письма третьей пачки
+        with open(summary_part, 'rb') as f:
+            content = f.read()
+        with open(summary_part, 'wb') as f:
+            f.write(content[:len(content) - 7])
+
+    added = []
+    add = downloader.metrics.add
+    monkeypatch.setattr(downloader.metrics, 'add', lambda *args, **kwargs: added.append(args) or add(*args, **kwargs))
+    merge(input_dir, names, output_dir)
+
+    # Продолжение с третьей пачки (по письму на вызов), а без записи о второй - и копия второй пачки
+    assert len(added) == (6 if damage == 'torn_journal' else 5)
+    assert read_outputs(output_dir) == read_outputs(clean_dir)
+    assert not os.path.exists(summary_part)
+
+
+def test_reused_batch_keeps_error_count(tmp_path, letters):
+    """Число ошибок готовой пачки не зависит от текста писем, похожего на разметку ошибки."""
+    input_dir, names = letters
+    with open(os.path.join(input_dir, names[0]), 'w', encoding='utf-8') as f:
+        f.write('<div class="letter error">это просто текст письма</div>')
+    with open(os.path.join(input_dir, names[11]), 'wb') as f:
+        f.write(b'\xff\xfe not utf-8')
+    output_dir = str(tmp_path / 'out')
+
+    summary_file, batches = merge(input_dir, names, output_dir)
+    assert [batch_info['errors'] for batch_info in batches] == [0, 1, 0]
+
+    # Без result.html письма копируются из готовых batch-файлов
+    os.remove(summary_file)
+    summary_file, reused = merge(input_dir, names, output_dir)
+    assert [batch_info['errors'] for batch_info in reused] == [0, 1, 0]
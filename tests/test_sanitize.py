@@ -0,0 +1,74 @@
+"""
+Очистка HTML (sanitize_html) всеми движками, с BeautifulSoup и без него.
+"""
+import os
+from email.message import EmailMessage
+
+import pytest
+
+from conftest import downloader
+
+XML_DECLARED = '<?xml version="1.0" encoding="utf-8"?>\n<html><body><p style="color: red" class="x">Привет</p></body></html>'
+
+
+@pytest.fixture(params=['with_bs4', 'without_bs4'])
+def bs4_setup(request, monkeypatch):
+    """Запускает тест с установленным BeautifulSoup и без него."""
+    if request.param == 'with_bs4':
+        if downloader.BeautifulSoup is None:
+            pytest.skip('beautifulsoup4 is not installed')
+    else:
+        monkeypatch.setattr(downloader, 'BeautifulSoup', None)
+    return request.param
+
+
+BACKENDS = ['htmlparser', 'lxml', 'bs4']
+
+
+def check_backend(backend):
+    """Пропускает движок bs4, если BeautifulSoup недоступен."""
+    if backend == 'bs4' and downloader.BeautifulSoup is None:
+        pytest.skip('bs4 backend needs beautifulsoup4')
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('html_content', ['', '   \r\n\t'])
+def test_blank_html(bs4_setup, backend, html_content):
+    """Пустой HTML дает пустую строку, а не ошибку разбора."""
+    check_backend(backend)
+    assert downloader.sanitize_html(html_content, unwrap=True, backend=backend) == ''
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_xml_declared_html(bs4_setup, backend):
+    """Строка с объявлением <?xml encoding=...?> очищается любым движком."""
+    check_backend(backend)
+    result = downloader.sanitize_html(XML_DECLARED, unwrap=True, backend=backend)
+    assert 'Привет' in result
+    assert 'style=' not in result and 'class=' not in result
+
+
+def test_bs4_is_offered_only_when_installed(monkeypatch):
+    """Без BeautifulSoup --sanitizer bs4 отклоняется при разборе аргументов."""
+    monkeypatch.setattr(downloader, 'BeautifulSoup', None)
+    assert 'bs4' not in downloader.available_sanitizers()
+    with pytest.raises(SystemExit):
+        downloader.build_parser().parse_args(['user', 'password', '--sanitizer', 'bs4'])
+
+
+@pytest.mark.parametrize('backend', ['htmlparser', 'lxml'])
+def test_email_with_empty_html_part(bs4_setup, backend, tmp_path):
+    """Письмо с пустой HTML-альтернативой обрабатывается, а не падает."""
+    msg = EmailMessage()
+    msg['Subject'] = 'Empty HTML'
+    msg['From'] = 'sender@example.com'
+    msg['Date'] = 'Mon, 01 Jan 2024 10:00:00 +0000'
+    msg.set_content('Plain body\n')
+    msg.add_alternative('', subtype='html')
+    with open(os.path.join(tmp_path, '1.eml'), 'wb') as f:
+        f.write(msg.as_bytes())
+
+    result = downloader.process_eml_file('1.eml', str(tmp_path), str(tmp_path / 'out'), txt=True, html=True,
+                                         sanitizer=backend)
+
+    assert 'Plain body' in result['text_body']
@@ -1,24 +1,512 @@
+import io
 import os
+import re
+import json
 import email
+import hashlib
 import imaplib
+import binascii
+import tempfile
+import ssl
+import sys
+import shutil
+import pathlib
+import mmap
+import zlib
+import time
+import asyncio
+import sqlite3
 import argparse
-from mailbox import mbox
+import threading
+import contextvars
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, timedelta
 import email
 # import base64
 from email import policy
 from email.parser import BytesParser
-from bs4 import BeautifulSoup
+from html import escape, unescape
+from html.parser import HTMLParser
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Уровни подробности вывода: только ошибки и итоги, обычный (с прогрессом), построчный по письмам
+QUIET, NORMAL, VERBOSE = 0, 1, 2
+VERBOSITY = NORMAL
+
+
+def set_verbosity(level):
+    """Задает уровень подробности вывода (в том числе в процессах-обработчиках)."""
+    global VERBOSITY
+    VERBOSITY = level
+
+
+def log(message, level=NORMAL):
+    """Печатает сообщение, если уровень подробности не ниже level."""
+    if VERBOSITY >= level:
+        metrics.clear_progress()
+        print(message)
+
+
+# Границы корзин гистограмм длительности этапов (секунды)
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# Как часто обновлять строку прогресса в терминале и в журнале (секунды)
+PROGRESS_INTERVAL = 1.0
+LOG_PROGRESS_INTERVAL = 30.0
+
+
+class Metrics:
+    """
+    Счетчики, скорость и гистограммы длительности этапов конвейера.
+
+    Этапы (search, fetch, write, parse, sanitize, merge) замеряются через
+    timer() или observe(). Фазы (download, decode, merge) считают
+    обработанные письма и байты: по ним строится строка прогресса со
+    скоростью и оценкой оставшегося времени. Снимок метрик можно
+    периодически выгружать в файл JSON lines или в textfile Prometheus
+    (по расширению .prom). Объект потокобезопасен.
+
+    При пакетной загрузке фазы каждого аккаунта считаются отдельно:
+    внутри account() письма относятся к аккаунту текущего контекста, а
+    строка прогресса подписывается его именем.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.stages = {}
+        self.phases = {}
+        self.phase = None
+        self._account = contextvars.ContextVar('metrics_account', default=None)
+        self.export_path = None
+        self._last_report = 0.0
+        self._progress_shown = False
+
+    def observe(self, stage, seconds):
+        """Добавляет замер длительности этапа в его гистограмму."""
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(METRIC_BUCKETS) + 1)}
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            for index, bound in enumerate(METRIC_BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                index = len(METRIC_BUCKETS)
+            histogram['buckets'][index] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        """Замеряет длительность блока with как этап stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def account(self, name):
+        """Относит фазы, начатые и учтенные внутри блока with, к аккаунту name."""
+        token = self._account.set(name)
+        try:
+            yield
+        finally:
+            self._account.reset(token)
+
+    @staticmethod
+    def _phase_name(key):
+        account, phase = key
+        return phase if account is None else f'{account}/{phase}'
+
+    @staticmethod
+    def _new_phase():
+        now = time.monotonic()
+        return {'started': now, 'updated': now, 'total': 0, 'done': 0, 'bytes': 0, 'failed': 0}
+
+    def start_phase(self, phase, total=0):
+        """Делает фазу текущей для строки прогресса и добавляет total ожидаемых писем."""
+        key = (self._account.get(), phase)
+        with self._lock:
+            data = self.phases.get(key)
+            if data is None:
+                data = self.phases[key] = self._new_phase()
+            data['total'] += total
+            self.phase = key
+
+    def add(self, phase, messages=1, size=0, failed=0):
+        """Учитывает обработанные письма фазы и обновляет прогресс."""
+        key = (self._account.get(), phase)
+        with self._lock:
+            data = self.phases.get(key)
+            if data is None:
+                data = self.phases[key] = self._new_phase()
+            data['done'] += messages
+            data['bytes'] += size
+            data['failed'] += failed
+            data['updated'] = time.monotonic()
+        self.tick()
+
+    def snapshot(self):
+        """Возвращает текущие метрики словарем (для JSON)."""
+        now = time.monotonic()
+        with self._lock:
+            phases = {}
+            for key, data in self.phases.items():
+                # Скорость считается до последнего письма фазы, чтобы завершенные фазы не "замедлялись"
+                elapsed = max(data['updated'] - data['started'], 1e-9)
+                rate = data['done'] / elapsed
+                remaining = max(data['total'] - data['done'] - data['failed'], 0)
+                phases[self._phase_name(key)] = {'phase': key[1], 'total': data['total'], 'done': data['done'], 'failed': data['failed'],
+                                 'bytes': data['bytes'], 'elapsed': round(elapsed, 3),
+                                 'messages_per_second': round(rate, 2),
+                                 'bytes_per_second': round(data['bytes'] / elapsed, 1),
+                                 'eta_seconds': round(remaining / rate, 1) if rate > 0 and remaining else None}
+                if key[0] is not None:
+                    phases[self._phase_name(key)]['account'] = key[0]
+            stages = {stage: {'count': data['count'], 'sum': round(data['sum'], 6),
+                              'buckets': dict(zip([str(bound) for bound in METRIC_BUCKETS] + ['+Inf'], data['buckets']))}
+                      for stage, data in self.stages.items()}
+        return {'time': datetime.now().isoformat(timespec='seconds'), 'elapsed': round(now - self.started, 3),
+                'phases': phases, 'stages': stages}
+
+    def progress_line(self, snapshot=None):
+        """Строка прогресса текущей фазы: письма, скорость, объем и оценка оставшегося времени."""
+        snapshot = snapshot or self.snapshot()
+        if self.phase is None:
+            return ''
+        name = self._phase_name(self.phase)
+        data = snapshot['phases'].get(name)
+        if data is None:
+            return ''
+        done = f'{data["done"]}/{data["total"]}' if data['total'] else f'{data["done"]}'
+        line = (f'{name}: {done} emails, {data["messages_per_second"]:.1f} msg/s, '
+                f'{data["bytes_per_second"] / 1024 / 1024:.2f} MiB/s')
+        if data['failed']:
+            line += f', {data["failed"]} failed'
+        if data['eta_seconds'] is not None:
+            line += f', ETA {timedelta(seconds=int(data["eta_seconds"]))}'
+        return line
+
+    def tick(self, force=False):
+        """Не чаще PROGRESS_INTERVAL обновляет строку прогресса и файл метрик."""
+        interactive = sys.stderr.isatty()
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_report < (PROGRESS_INTERVAL if interactive else LOG_PROGRESS_INTERVAL):
+                return
+            self._last_report = now
+        snapshot = self.snapshot()
+        if VERBOSITY >= NORMAL and self.phase is not None:
+            line = self.progress_line(snapshot)
+            if interactive:
+                sys.stderr.write('\r' + line + '\x1b[K')
+                self._progress_shown = True
+            else:
+                sys.stderr.write(line + '\n')
+            sys.stderr.flush()
+        if self.export_path:
+            self.export(snapshot)
+
+    def clear_progress(self):
+        """Стирает строку прогресса перед обычным выводом."""
+        if self._progress_shown:
+            sys.stderr.write('\r\x1b[K')
+            sys.stderr.flush()
+            self._progress_shown = False
+
+    def export(self, snapshot=None):
+        """Записывает снимок в export_path: строкой JSON или textfile Prometheus (*.prom)."""
+        snapshot = snapshot or self.snapshot()
+        if self.export_path.endswith('.prom'):
+            # Файл заменяется целиком, чтобы node_exporter не прочитал его наполовину
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.export_path)), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus(snapshot))
+            os.replace(tmp_path, self.export_path)
+        else:
+            with open(self.export_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(snapshot, ensure_ascii=False) + '\n')
+
+    @staticmethod
+    def prometheus(snapshot):
+        """Форматирует снимок метрик в текстовом формате Prometheus."""
+        def labels(data):
+            if 'account' in data:
+                return f'account="{data["account"]}",phase="{data["phase"]}"'
+            return f'phase="{data["phase"]}"'
+
+        lines = ['# HELP yandex_mail_downloader_messages_total Emails processed by pipeline phase.',
+                 '# TYPE yandex_mail_downloader_messages_total counter']
+        for data in snapshot['phases'].values():
+            lines.append(f'yandex_mail_downloader_messages_total{{{labels(data)}}} {data["done"]}')
+        lines += ['# HELP yandex_mail_downloader_failed_total Emails that failed by pipeline phase.',
+                  '# TYPE yandex_mail_downloader_failed_total counter']
+        for data in snapshot['phases'].values():
+            lines.append(f'yandex_mail_downloader_failed_total{{{labels(data)}}} {data["failed"]}')
+        lines += ['# HELP yandex_mail_downloader_bytes_total Bytes processed by pipeline phase.',
+                  '# TYPE yandex_mail_downloader_bytes_total counter']
+        for data in snapshot['phases'].values():
+            lines.append(f'yandex_mail_downloader_bytes_total{{{labels(data)}}} {data["bytes"]}')
+        lines += ['# HELP yandex_mail_downloader_stage_seconds Duration of pipeline stages.',
+                  '# TYPE yandex_mail_downloader_stage_seconds histogram']
+        for stage, data in snapshot['stages'].items():
+            cumulative = 0
+            for bound, count in data['buckets'].items():
+                cumulative += count
+                lines.append(f'yandex_mail_downloader_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'yandex_mail_downloader_stage_seconds_sum{{stage="{stage}"}} {data["sum"]}')
+            lines.append(f'yandex_mail_downloader_stage_seconds_count{{stage="{stage}"}} {data["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Возвращает итоговые строки: скорость фаз и средняя/максимальная корзина этапов."""
+        snapshot = self.snapshot()
+        lines = []
+        for phase, data in snapshot['phases'].items():
+            lines.append(f'  {phase}: {data["done"]} emails in {data["elapsed"]:.1f}s, '
+                         f'{data["messages_per_second"]:.1f} msg/s, {data["bytes_per_second"] / 1024 / 1024:.2f} MiB/s')
+        for stage, data in snapshot['stages'].items():
+            if data['count']:
+                lines.append(f'  {stage}: {data["count"]} x {data["sum"] / data["count"] * 1000:.2f} ms avg, {data["sum"]:.2f}s total')
+        return lines
+
+
+# Метрики текущего запуска
+metrics = Metrics()
+
+
+# Суффикс временных файлов: файл получает свое имя только целиком записанным
+PARTIAL_SUFFIX = '.part'
+
+
+@contextmanager
+def atomic_open(path, mode='wb', encoding=None):
+    """
+    Открывает файл для записи так, чтобы он появился только целиком.
+
+    Данные пишутся в path + PARTIAL_SUFFIX и переименовываются в path
+    после успешного закрытия, поэтому оборванный запуск не оставляет
+    обрезанных файлов под настоящими именами.
+    """
+    tmp_path = path + PARTIAL_SUFFIX
+    try:
+        with open(tmp_path, mode, encoding=encoding) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write(path, data, encoding=None):
+    """Записывает bytes или str (с encoding) в файл через atomic_open."""
+    with atomic_open(path, 'wb' if encoding is None else 'w', encoding=encoding) as f:
+        f.write(data)
+
+
+def remove_partial_files(folder):
+    """Удаляет временные файлы, оставшиеся в папке от оборванного запуска."""
+    removed = 0
+    if os.path.isdir(folder):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.endswith(PARTIAL_SUFFIX) and entry.is_file():
+                    os.remove(entry.path)
+                    removed += 1
+    return removed
+
+
+def link_file(source_path, path):
+    """
+    Создает path жесткой ссылкой на source_path (или копией, если ссылки не поддерживаются).
+
+    Raises:
+        OSError: Исходного файла нет
+    """
+    partial_path = path + PARTIAL_SUFFIX
+    try:
+        os.link(source_path, partial_path)
+    except OSError:
+        shutil.copyfile(source_path, partial_path)
+    os.replace(partial_path, path)
+
+
+class CheckpointJournal:
+    """
+    Журнал контрольных точек этапа: файл JSON lines, дописываемый по мере работы.
+
+    Первая строка хранит подпись параметров этапа. Если при открытии
+    подпись не совпадает (этап запущен с другими параметрами), журнал
+    начинается заново. Недописанная последняя строка после сбоя
+    отбрасывается.
+
+    Args:
+        path (str): Путь к файлу журнала
+        signature: JSON-совместимая подпись параметров этапа
+    """
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self.entries = []
+        self._file = None
+        valid = intact = False
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.read().split('\n')
+            try:
+                valid = json.loads(lines[0]) == {'signature': signature}
+            except ValueError:
+                valid = False
+            if valid:
+                for line in lines[1:]:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except ValueError:
+                        break
+                # Целый журнал заканчивается переводом строки после последней записи
+                intact = len(self.entries) == len(lines) - 2 and lines[-1] == ''
+        if intact:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        elif valid:
+            # Переписываем журнал без оборванной строки
+            self.rewrite(self.entries)
+        else:
+            self.rewrite([])
+
+    def rewrite(self, entries):
+        """Заменяет записи журнала (например, чтобы сжать его)."""
+        self.entries = list(entries)
+        if self._file is not None:
+            self._file.close()
+        with atomic_open(self.path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'signature': self.signature}, ensure_ascii=False) + '\n')
+            for entry in self.entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def append(self, entry):
+        """Дописывает запись и сразу сбрасывает ее на диск."""
+        self.entries.append(entry)
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# Журнал пачек объединения в выходной папке
+MERGE_JOURNAL = '.merge.journal'
+
+# Имена batch-файлов, которые создает объединение
+BATCH_FILE_RE = re.compile(r'batch_\d+_\d+-\d+\.html$')
+
+# Отметка с числом писем с ошибкой в конце batch-файла
+MERGE_ERRORS_MARK = '<!-- merge-errors: {} -->\n'
+MERGE_ERRORS_MARK_RE = re.compile(r'<!-- merge-errors: (\d+) -->\n\Z')
+
+
+def _plan_batches(input_dir, input_files, output_file, batch, params):
+    """
+    Делит входные файлы на пачки и вычисляет отпечаток состава каждой пачки.
+
+    Отпечаток зависит от имен, размеров и времени изменения писем пачки,
+    ее места в общем списке и параметров объединения, поэтому совпадает
+    только у пачки, которую не нужно собирать заново.
+
+    Returns:
+        list: Пачки с полями filename, path, range, errors и digest
+    """
+    plan = []
+    for start in range(0, len(input_files), batch):
+        members = input_files[start:start + batch]
+        start_idx, end_idx = start + 1, start + len(members)
+        digest = hashlib.sha256(json.dumps([params, start_idx], ensure_ascii=False).encode())
+        for input_file in members:
+            try:
+                stat = os.stat(os.path.join(input_dir, input_file))
+                digest.update(f'{input_file}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+            except OSError:
+                digest.update(f'{input_file}\0-\n'.encode())
+        batch_file_name = f'batch_{len(plan) + 1:03d}_{start_idx}-{end_idx}.html'
+        plan.append({
+            'filename': batch_file_name,
+            'path': os.path.join(output_file, batch_file_name),
+            'range': (start_idx, end_idx),
+            'errors': 0,
+            'digest': digest.hexdigest()
+        })
+    return plan
+
+
+def _read_batch_letters(path, header, footer, encoding):
+    """
+    Читает готовый batch-файл, если его заголовок совпадает с ожидаемым.
+
+    Число писем с ошибкой берется из отметки MERGE_ERRORS_MARK перед
+    окончанием файла, а не из текста писем: в самих письмах может
+    встретиться что угодно.
+
+    Returns:
+        tuple: (письма, число писем с ошибкой) или None, если пачку нужно собрать заново
+    """
+    try:
+        with open(path, 'r', encoding=encoding) as f:
+            content = f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+    if not (content.startswith(header) and content.endswith(footer)):
+        return None
+    content = content[len(header):len(content) - len(footer)]
+    match = MERGE_ERRORS_MARK_RE.search(content)
+    if match is None:
+        return None
+    return content[:match.start()], int(match.group(1))
+
 
 def merge_html_files_with_separators(input_dir, input_files, output_file, 
                                     start_separator="начало письма", 
                                     end_separator="конец письма",
                                     encoding='utf-8',
-                                    batch=100):
+                                    batch=100,
+                                    unwrap=True,
+                                    sanitizer=None):
     """
     Объединяет несколько HTML файлов в один с разделителями.
     Создает общий файл result.html и отдельные файлы по batch писем.
     
+    Каждое письмо сразу пишется и в общий файл, и в открытый batch-файл,
+    поэтому память не растет с количеством писем.
+
+    Объединение инкрементальное: в заголовке batch-файла записан отпечаток
+    состава пачки (см. _plan_batches), и пачка, письма которой не менялись,
+    не собирается заново, а копируется в result.html из готового файла.
+    Пачки result.html отмечаются в журнале .merge.journal: если не
+    изменилась ни одна, объединение пропускается, а прерванное объединение
+    продолжается с первой незаконченной пачки. Файлы пишутся под временными
+    именами и переименовываются целиком записанными; batch-файлы, которых
+    больше нет в списке пачек, удаляются.
+    
     Args:
         input_dir (str): Директория с входными HTML файлами
         input_files (list): Список путей к входным HTML файлам
@@ -27,6 +515,11 @@ def merge_html_files_with_separators(input_dir, input_files, output_file,
         end_separator (str): Текст для разделителя конца
         encoding (str): Кодировка файлов
         batch (int): Размер пачки писем для создания отдельных файлов
+        unwrap (bool): Снимать теги html/head/body (False, если файлы уже очищены)
+        sanitizer (str): Движок очистки HTML (см. sanitize_html)
+    
+    Returns:
+        tuple: (путь к result.html, список batch-файлов с полями filename, path, range, errors и digest)
     """
     
     # Создаем выходную директорию, если она не существует
@@ -34,10 +527,34 @@ def merge_html_files_with_separators(input_dir, input_files, output_file,
     
     # Общий файл со всеми письмами
     summary_file = os.path.join(output_file, 'result.html')
+
+    # Пачки и отпечатки их состава
+    params = [start_separator, end_separator, encoding, batch, unwrap, sanitizer]
+    plan = _plan_batches(input_dir, input_files, output_file, batch, params)
+    digests = [batch_info['digest'] for batch_info in plan]
     
-    # Для хранения содержимого писем для batch-файлов
+    # Готовые пачки result.html (метаданные без содержимого писем)
     batches = []
-    current_batch = []
+    journal = CheckpointJournal(os.path.join(output_file, MERGE_JOURNAL), params)
+    done = [entry['digest'] for entry in journal.entries]
+    resume_offset = None
+    if not os.path.exists(summary_file + PARTIAL_SUFFIX):
+        if (done == digests and os.path.exists(summary_file)
+                and all(os.path.exists(batch_info['path']) for batch_info in plan)):
+            journal.close()
+            log(f"Объединение без изменений: {summary_file}")
+            return summary_file, [dict(batch_info, errors=entry['errors']) for batch_info, entry in zip(plan, journal.entries)]
+        journal.rewrite([])
+    else:
+        # Продолжаем с первой пачки, состав которой изменился или которая не закончена
+        ready = 0
+        while ready < min(len(done), len(digests)) and done[ready] == digests[ready]:
+            ready += 1
+        if ready:
+            batches = [dict(batch_info, errors=entry['errors']) for batch_info, entry in zip(plan, journal.entries[:ready])]
+            resume_offset = journal.entries[ready - 1]['offset']
+            log(f"Продолжение объединения с письма {batches[-1]['range'][1] + 1}")
+        journal.rewrite(journal.entries[:ready])
     
     # Базовый HTML шаблон
     html_header = f'''<!DOCTYPE html>
@@ -67,6 +584,7 @@ body{{font-family:Arial,sans-serif;margin:20px}}
 <html>
 <head>
 <meta charset="{encoding}">
+<meta name="merge-digest" content="{digest}">
 <title>Письма {start_idx}-{end_idx}</title>
 <style>
 body{{font-family:Arial,sans-serif;margin:20px}}
@@ -83,100 +601,85 @@ body{{font-family:Arial,sans-serif;margin:20px}}
     
     batch_footer = '</body>\n</html>'
     
-    with open(summary_file, 'w', encoding=encoding) as out_f:
-        # Записываем заголовок
-        out_f.write(html_header)
+    first = batches[-1]['range'][1] + 1 if batches else 1
+    metrics.start_phase('merge', len(input_files) - first + 1)
+    created = 0
+
+    with open(summary_file + PARTIAL_SUFFIX, 'w' if resume_offset is None else 'r+', encoding=encoding) as out_f:
+        if resume_offset is None:
+            # Записываем заголовок
+            out_f.write(html_header)
+        else:
+            # Отбрасываем письма незаконченной пачки
+            out_f.seek(resume_offset)
+            out_f.truncate()
         
-        for i, input_file in enumerate(input_files, 1):
-            try:
-                file_path = os.path.join(input_dir, input_file)
-                with open(file_path, 'r', encoding=encoding) as in_f:
-                    html_content = in_f.read()
-                
-                # Извлекаем содержимое письма
-                soup = BeautifulSoup(html_content, 'html.parser')
-                
-                # Удаляем лишние теги
-                for tag in ['html', 'head', 'body']:
-                    if soup.find(tag):
-                        tag_content = soup.find(tag)
-                        if tag_content:
-                            tag_content.unwrap()
-                
-                # Готовим HTML письма
-                letter_html = f'<div class="letter">'
-                letter_html += f'<div class="separator"><h3>= {start_separator} {i} =</h3><p>Файл: {input_file}</p></div><hr>'
-                letter_html += str(soup)
-                letter_html += f'<hr><div class="separator"><h3>= {end_separator} {i} =</h3></div></div>'
-                
-                # Записываем в общий файл
-                out_f.write(letter_html + '\n')
-                
-                # Добавляем в текущую пачку
-                current_batch.append({
-                    'index': i,
-                    'filename': input_file,
-                    'content': letter_html,
-                    'success': True
-                })
-                
-                print(f"Файл {input_file} успешно добавлен (#{i})")
-                
-            except Exception as e:
-                print(f"Ошибка при обработке {input_file}: {e}")
-                
-                # HTML для ошибки
-                error_html = f'<div class="letter error"><h3>ОШИБКА: {start_separator} {i}</h3>'
-                error_html += f'<p>Файл: {input_file}</p><p>Ошибка: {str(e)}</p>'
-                error_html += f'<h3>{end_separator} {i}</h3></div>'
-                
-                out_f.write(error_html + '\n')
-                
-                # Добавляем ошибку в пачку
-                current_batch.append({
-                    'index': i,
-                    'filename': input_file,
-                    'content': error_html,
-                    'success': False,
-                    'error': str(e)
-                })
-            
-            # Создаем batch-файл если набралась пачка или это последний файл
-            if len(current_batch) == batch or i == len(input_files):
-                if current_batch:
-                    batch_number = len(batches) + 1
-                    start_idx = current_batch[0]['index']
-                    end_idx = current_batch[-1]['index']
-                    
-                    batch_file_name = f'batch_{batch_number:03d}_{start_idx}-{end_idx}.html'
-                    batch_file_path = os.path.join(output_file, batch_file_name)
-                    
-                    # Создаем batch-файл
-                    with open(batch_file_path, 'w', encoding=encoding) as batch_f:
-                        # Заголовок batch-файла
-                        batch_f.write(batch_header.format(
-                            encoding=encoding,
-                            start_idx=start_idx,
-                            end_idx=end_idx,
-                            batch_size=len(current_batch)
-                        ))
-                        
-                        # Содержимое писем
-                        for letter in current_batch:
-                            batch_f.write(letter['content'] + '\n')
+        for batch_info in plan[len(batches):]:
+            start_idx, end_idx = batch_info['range']
+            header = batch_header.format(
+                encoding=encoding,
+                digest=batch_info['digest'],
+                start_idx=start_idx,
+                end_idx=end_idx,
+                batch_size=end_idx - start_idx + 1
+            )
+
+            # Пачка из тех же писем уже собрана: копируем ее письма
+            ready = _read_batch_letters(batch_info['path'], header, batch_footer, encoding)
+            if ready is not None:
+                letters, batch_info['errors'] = ready
+                out_f.write(letters)
+                metrics.add('merge', end_idx - start_idx + 1 - batch_info['errors'], len(letters), batch_info['errors'])
+            else:
+                with open(batch_info['path'] + PARTIAL_SUFFIX, 'w', encoding=encoding) as batch_f:
+                    # Заголовок batch-файла
+                    batch_f.write(header)
+
+                    for i, input_file in enumerate(input_files[start_idx - 1:end_idx], start_idx):
+                        letter_start = time.perf_counter()
+                        try:
+                            file_path = os.path.join(input_dir, input_file)
+                            with open(file_path, 'r', encoding=encoding) as in_f:
+                                html_content = in_f.read()
+                            
+                            # Извлекаем содержимое письма
+                            if unwrap:
+                                html_content = sanitize_html(html_content, strip_styles=False, unwrap=True, backend=sanitizer)
+                            
+                            # Готовим HTML письма
+                            letter_html = f'<div class="letter">'
+                            letter_html += f'<div class="separator"><h3>= {start_separator} {i} =</h3><p>Файл: {input_file}</p></div><hr>'
+                            letter_html += html_content
+                            letter_html += f'<hr><div class="separator"><h3>= {end_separator} {i} =</h3></div></div>'
+                            
+                            log(f"Файл {input_file} успешно добавлен (#{i})", VERBOSE)
+                            failed = 0
+                            
+                        except Exception as e:
+                            print(f"Ошибка при обработке {input_file}: {e}")
+                            failed = 1
+                            
+                            # HTML для ошибки
+                            letter_html = f'<div class="letter error"><h3>ОШИБКА: {start_separator} {i}</h3>'
+                            letter_html += f'<p>Файл: {input_file}</p><p>Ошибка: {str(e)}</p>'
+                            letter_html += f'<h3>{end_separator} {i}</h3></div>'
+                            batch_info['errors'] += 1
                         
-                        batch_f.write(batch_footer)
-                    
-                    print(f"Создан batch-файл: {batch_file_name}")
-                    batches.append({
-                        'filename': batch_file_name,
-                        'path': batch_file_path,
-                        'letters': current_batch.copy(),
-                        'range': (start_idx, end_idx)
-                    })
-                    
-                    # Очищаем пачку
-                    current_batch = []
+                        # Записываем в общий файл и в текущую пачку
+                        out_f.write(letter_html + '\n')
+                        batch_f.write(letter_html + '\n')
+                        metrics.observe('merge', time.perf_counter() - letter_start)
+                        metrics.add('merge', 1 - failed, len(letter_html), failed)
+
+                    batch_f.write(MERGE_ERRORS_MARK.format(batch_info['errors']))
+                    batch_f.write(batch_footer)
+                os.replace(batch_info['path'] + PARTIAL_SUFFIX, batch_info['path'])
+                log(f"Создан batch-файл: {batch_info['filename']}", VERBOSE)
+                created += 1
+
+            batches.append(batch_info)
+            out_f.flush()
+            journal.append(dict(batch_info, offset=out_f.tell()))
         
         # Добавляем список batch-файлов в общий файл
         if batches:
@@ -191,10 +694,19 @@ body{{font-family:Arial,sans-serif;margin:20px}}
         
         # Закрываем общий файл
         out_f.write(html_footer)
+
+    os.replace(summary_file + PARTIAL_SUFFIX, summary_file)
+    journal.close()
+
+    # Пачки прошлых запусков, которых больше нет (например, после удаления писем)
+    current = {batch_info['filename'] for batch_info in batches}
+    for name in os.listdir(output_file):
+        if BATCH_FILE_RE.match(name) and name not in current:
+            os.remove(os.path.join(output_file, name))
     
     # Вывод статистики
-    print(f"\n✓ Общий файл: {summary_file}")
-    print(f"✓ Создано batch-файлов: {len(batches)}")
+    log(f"\n✓ Общий файл: {summary_file}")
+    log(f"✓ Создано batch-файлов: {created}, без изменений: {len(batches) - created}")
     
     return summary_file, batches
 
@@ -228,292 +740,3608 @@ def process_directory(input_dir, output_dir, batch_size=100):
     
     return result
 
-def remove_styles_from_html(html_content):
+# Теги, которые снимаются при извлечении содержимого письма
+UNWRAP_TAGS = ('html', 'head', 'body')
+
+
+class _SanitizingHTMLParser(HTMLParser):
     """
-    Удаляет стили из HTML-контента.
-    
-    Args:
-        html_content (str): Исходный HTML-контент
-    
-    Returns:
-        str: Оптимизированный HTML без стилей
+    Очистка HTML за один проход по событиям html.parser.
+
+    Разметка переписывается по мере разбора: содержимое <style> и атрибуты
+    style/class отбрасываются, теги html/head/body снимаются с сохранением
+    содержимого. Дерево документа не строится.
     """
-    # Создаем объект BeautifulSoup
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # Удаляем все теги <style>
-    for style_tag in soup.find_all('style'):
-        style_tag.decompose()
-    
-    # Удаляем атрибуты style у всех элементов
-    for tag in soup.find_all(attrs={'style': True}):
-        del tag['style']
-    
-    # Удаляем атрибуты class у всех элементов (если нужно)
-    for tag in soup.find_all(attrs={'class': True}):
-        del tag['class']
-    
-    # Возвращаем оптимизированный HTML
-    return str(soup)
 
-# Function for converting downloaded mailboxes from EML to Mbox format
-def convert_to_mbox(mailbox_folder):
-    for item in os.listdir(mailbox_folder):
-        item_path = os.path.join(mailbox_folder, item)
-        if os.path.isdir(item_path):
-            # Recursively convert nested mailboxes
-            convert_to_mbox(item_path)
-        elif item.endswith('.eml'):
-            mbox_path = os.path.join(mailbox_folder, f'{os.path.basename(os.path.normpath(mailbox_folder))}.mbox')
-            mbox_file = mbox(mbox_path)
-            with open(item_path, 'rb') as f:
-                message = f.read()
-            mbox_file.add(message)
-            mbox_file.flush()
-
-def process_eml_file(file_name, input_dir, output_dir='output'):
-    """Обработка EML файла с сохранением вложений"""
-    eml_file = os.path.join(input_dir, file_name)
+    def __init__(self, strip_styles=True, unwrap=False):
+        super().__init__(convert_charrefs=False)
+        self.strip_styles = strip_styles
+        self.unwrap = unwrap
+        self.parts = []
+        self._skip = 0
 
-    # Создаем выходную директорию
-    os.makedirs(output_dir, exist_ok=True)
-    
-    with open(eml_file, 'rb') as f:
-        msg = BytesParser(policy=policy.default).parse(f)
-    
-    # Информация о письме
-    print("Subject:", msg['subject'])
-    print("From:", msg['from'])
-    print("Date:", msg['date'])
+    def _tag(self, tag, attrs, closing=''):
+        if self.strip_styles:
+            attrs = [(name, value) for name, value in attrs if name not in ('style', 'class')]
+        text = ''.join(f' {name}' if value is None else f' {name}="{escape(value)}"' for name, value in attrs)
+        return f'<{tag}{text}{closing}>'
 
-    head = 'Subject:' + msg['subject'] + '\nFrom:' + msg['from'] + '\nDate:' + msg['date'] + '\n'
-    # Сохраняем текст письма
-    text_body = ''
-    html_body = ''
-    
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            
-            if content_type == 'text/plain':
-                    payload = part.get_payload(decode=True)
-                    charset = part.get_content_charset() or 'utf-8'
-                    text_body = payload.decode(charset, errors='ignore')
-                
-            elif content_type == 'text/html':
-                    payload = part.get_payload(decode=True)
-                    charset = part.get_content_charset() or 'utf-8'
-                    html_body = payload.decode(charset, errors='ignore')
-                    html_body = remove_styles_from_html(html_body)
-            elif part.get_filename():  # Вложение
-                if args.files:
-                    filename = part.get_filename()
-                    content = part.get_payload(decode=True)
-                    
-                    # Сохраняем вложение
-                    filepath = os.path.join(output_dir, filename)
-                    with open(filepath, 'wb') as f:
-                        f.write(content)
-                    print(f"Сохранено вложение: {filename}")
-    else:
-        # Не multipart письмо
-        payload = msg.get_payload(decode=True)
-        charset = msg.get_content_charset() or 'utf-8'
-        text_body = payload.decode(charset, errors='ignore')
-    
-    # if head:
-    #     with open(os.path.join(output_dir, f'{file_name}.txt'), 'w', encoding='utf-8') as f:
-    #         f.write(head)
-    
-    # Сохраняем текст письма
-    if text_body and args.txt:
-        with open(os.path.join(output_dir, f'{file_name}.txt'), 'w', encoding='utf-8') as f:
-            f.write(head + text_body)
-    
-    if html_body and args.html:
-        with open(os.path.join(output_dir, f'{file_name}.html'), 'w', encoding='utf-8') as f:
-            f.write(head + html_body)
-    
-    return {
-        'subject': msg['subject'],
-        'from': msg['from'],
-        'text_body': text_body,
-        'html_body': html_body
-    }
+    def handle_starttag(self, tag, attrs):
+        if self.strip_styles and tag == 'style':
+            self._skip += 1
+        elif not self._skip and not (self.unwrap and tag in UNWRAP_TAGS):
+            self.parts.append(self._tag(tag, attrs))
 
+    def handle_startendtag(self, tag, attrs):
+        if not self._skip and not (self.strip_styles and tag == 'style') and not (self.unwrap and tag in UNWRAP_TAGS):
+            self.parts.append(self._tag(tag, attrs, '/'))
 
-if __name__ == '__main__':
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description='Download all mailboxes and their contents from a Yandex email account')
-    parser.add_argument('username', type=str, help='Yandex email account username')
-    parser.add_argument('password', type=str, help='Yandex email account password')
-    parser.add_argument('-m', '--mbox', action='store_true', help='Convert downloaded mailboxes to Mbox format')
-    parser.add_argument('-s', '--sync', action='store_true', help='Delete local email files that are not on the server')
-    parser.add_argument('-a', '--max-age', type=int, default=-1, help='Only download emails newer than (since) X days')
-    parser.add_argument('-e', '--exclude', type=str, nargs='+', help='List mailboxes to exclude from downloading')
-    parser.add_argument('-i', '--include', type=str, nargs='+', help='List mailboxes to include (only those specified will be downloaded)')
-    parser.add_argument('--batch', type=int, default=100, help='Batch size N mails')
-    parser.add_argument('--txt', action='store_true', help='Include mail txt')
-    parser.add_argument('--html', action='store_true', help='Include mail html')
-    parser.add_argument('--files', action='store_true', help='Include mail attachments')
-    parser.add_argument('--unseen', action='store_true', help='Include unseen only')
+    def handle_endtag(self, tag):
+        if self.strip_styles and tag == 'style':
+            self._skip = max(0, self._skip - 1)
+        elif not self._skip and not (self.unwrap and tag in UNWRAP_TAGS):
+            self.parts.append(f'</{tag}>')
 
-    args = parser.parse_args()
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
 
-    # Connect to the Yandex IMAP server over SSL
-    imap_server = 'imap.yandex.com'
-    imap_port = 993
-    print(f'Connecting to {imap_server}:{imap_port}...')
-    connection = imaplib.IMAP4_SSL(imap_server, imap_port)
+    def handle_entityref(self, name):
+        if not self._skip:
+            self.parts.append(f'&{name};')
 
-    # Login to the Yandex email account
-    print(f'Logging in as {args.username}..')
-    try:
-        connection.login(args.username, args.password)
-    except Exception as e:
-        print('Error: Failed to login to the Yandex email account')
-        print(str(e))
-        exit()
+    def handle_charref(self, name):
+        if not self._skip:
+            self.parts.append(f'&#{name};')
 
-    # Get the list of mailboxes
-    print('Listing account mailboxes..\n')
-    try:
-        connection.select()
-        typ, data = connection.list()
-    except Exception as e:
-        print('Error: Failed to get the list of mailboxes')
-        print(str(e))
-        exit()
+    def handle_comment(self, data):
+        if not self._skip:
+            self.parts.append(f'<!--{data}-->')
 
-    # Create local account folder
-    local_folder_name = args.username
-    os.makedirs(local_folder_name, exist_ok=True)
+    def handle_decl(self, decl):
+        self.parts.append(f'<!{decl}>')
 
-    # Download all mailboxes and their contents locally
-    for mailbox in data:
-        # Mailbox name
-        mailbox_name = mailbox.decode('utf-8').split(' "|" ')[-1].replace('"', '').replace('/', '_')
-        mailbox_name_canonical = mailbox_name.replace('|', '/')
+    def handle_pi(self, data):
+        self.parts.append(f'<?{data}>')
 
-        if args.include is not None and mailbox_name_canonical not in args.include:
-            continue
-        if args.exclude is not None and mailbox_name_canonical in args.exclude:
-            continue
+    def unknown_decl(self, data):
+        self.parts.append(f'<![{data}]>')
 
-        # Mailbox server path
-        mailbox_path = mailbox_name.split('|')
 
-        # Determine local mailbox folder path
-        mailbox_folder_path = local_folder_name
-        for folder in mailbox_path:
-            mailbox_folder_path = os.path.join(mailbox_folder_path, folder)
+def _sanitize_htmlparser(html_content, strip_styles, unwrap):
+    parser = _SanitizingHTMLParser(strip_styles, unwrap)
+    parser.feed(html_content)
+    parser.close()
+    return ''.join(parser.parts)
 
-        # Create necessary directories recursively
-        os.makedirs(mailbox_folder_path, exist_ok=True)
-        
-        # Select mailbox
-        try:
-            connection.select('"' + mailbox_name + '"' if (' ' in mailbox_name or not mailbox_name.isascii()) else mailbox_name, readonly=True)
-
-            if args.unseen:
-                # Скачиваем только непрочитанные письма
-                typ, data = connection.uid('SEARCH', None, 'UNSEEN')
-            elif args.max_age > 0:
-                # Фильтр по дате: непрочитанные письма старше указанного возраста
-                cutoff_date = (datetime.today() - timedelta(days=args.max_age)).strftime('%d-%b-%Y')
-                typ, data = connection.uid('SEARCH', None, f'(SINCE {cutoff_date})')
-            else:
-                # Все письма
-                typ, data = connection.uid('SEARCH', None, 'ALL')
-                
-        except Exception as e:
-            print(f'Error: Failed to select mailbox {mailbox_name_canonical}')
-            print(str(e))
+
+def _sanitize_lxml(html_content, strip_styles, unwrap):
+    document = lxml.html.document_fromstring(html_content)
+    if strip_styles:
+        for element in list(document.iter()):
+            if element.tag == 'style':
+                element.drop_tree()
+            elif isinstance(element.tag, str):
+                element.attrib.pop('style', None)
+                element.attrib.pop('class', None)
+    if not unwrap:
+        return lxml.html.tostring(document, encoding='unicode')
+    parts = []
+    for container in document:
+        if not isinstance(container.tag, str):
+            # Комментарии и инструкции вне head/body
+            parts.append(lxml.html.tostring(container, encoding='unicode'))
             continue
+        if container.text:
+            parts.append(container.text)
+        parts.extend(lxml.html.tostring(child, encoding='unicode') for child in container)
+    return ''.join(parts)
 
-        # Initialize counters
-        saved = 0
-        skipped = 0
-        failed = 0
-        removed = 0
-        total = 0
 
-        # Download mailbox contents
-        print(f'Downloading contents of mailbox {mailbox_name_canonical}..')
+def _sanitize_bs4(html_content, strip_styles, unwrap):
+    # Создаем объект BeautifulSoup
+    soup = BeautifulSoup(html_content, 'html.parser')
+    
+    if strip_styles:
+        # Удаляем все теги <style>
+        for style_tag in soup.find_all('style'):
+            style_tag.decompose()
+        
+        # Удаляем атрибуты style и class у всех элементов
+        for tag in soup.find_all(attrs={'style': True}):
+            del tag['style']
+        for tag in soup.find_all(attrs={'class': True}):
+            del tag['class']
+    
+    if unwrap:
+        # Удаляем лишние теги
+        for tag in UNWRAP_TAGS:
+            tag_content = soup.find(tag)
+            if tag_content:
+                tag_content.unwrap()
+    
+    return str(soup)
 
-        email_uids = data[0].split()
 
-        for email_uid in email_uids:
-            total += 1
+# Доступные движки очистки HTML
+HTML_SANITIZERS = {
+    'htmlparser': _sanitize_htmlparser,
+    'lxml': _sanitize_lxml,
+    'bs4': _sanitize_bs4,
+}
 
-            try:
-                # Decode email UID
-                email_uid = email_uid.decode()
+DEFAULT_HTML_SANITIZER = 'lxml' if lxml is not None else 'htmlparser'
 
-                email_file_name = f'{email_uid}.eml'
-                email_file_path = os.path.join(mailbox_folder_path, email_file_name)
-                email_file_size = os.stat(email_file_path).st_size if os.path.isfile(email_file_path) else -1
 
-                # Check if the email has already been downloaded
-                if email_file_name in os.listdir(mailbox_folder_path) and email_file_size > 0:
-                    skipped += 1
-                    continue
+def available_sanitizers():
+    """Возвращает движки очистки HTML, которые можно выбрать без недостающих пакетов."""
+    return sorted(backend for backend in HTML_SANITIZERS if backend != 'bs4' or BeautifulSoup is not None)
+
+
+def sanitize_html(html_content, strip_styles=True, unwrap=False, backend=None):
+    """
+    Очищает HTML выбранным движком за один проход.
+
+    Если быстрый движок не справился с документом (lxml, например, не
+    принимает строку с объявлением <?xml encoding=...?>), используется
+    BeautifulSoup, а без него - html.parser. Пустой HTML возвращается
+    пустой строкой.
+
+    Args:
+        html_content (str): Исходный HTML-контент
+        strip_styles (bool): Удалять теги <style> и атрибуты style/class
+        unwrap (bool): Снимать теги html/head/body, оставляя их содержимое
+        backend (str): 'lxml', 'htmlparser' или 'bs4' (по умолчанию самый быстрый из доступных)
+
+    Returns:
+        str: Очищенный HTML
+    """
+    # lxml не разбирает пустой документ
+    if not html_content.strip():
+        return ''
+    backend = backend or DEFAULT_HTML_SANITIZER
+    if backend == 'lxml' and lxml is None:
+        backend = 'htmlparser'
+    if backend == 'bs4':
+        return _sanitize_bs4(html_content, strip_styles, unwrap)
+    try:
+        return HTML_SANITIZERS[backend](html_content, strip_styles, unwrap)
+    except Exception:
+        if BeautifulSoup is not None:
+            return _sanitize_bs4(html_content, strip_styles, unwrap)
+        if backend == 'htmlparser':
+            raise
+        return _sanitize_htmlparser(html_content, strip_styles, unwrap)
+
+
+def remove_styles_from_html(html_content, backend=None):
+    """
+    Удаляет стили из HTML-контента.
+    
+    Args:
+        html_content (str): Исходный HTML-контент
+        backend (str): Движок очистки (см. sanitize_html)
+    
+    Returns:
+        str: Оптимизированный HTML без стилей
+    """
+    return sanitize_html(html_content, backend=backend)
+
+# Размер буфера записи Mbox-файла
+MBOX_BUFFER_SIZE = 1024 * 1024
+
+# Через сколько писем отмечать в индексе уже записанную часть Mbox-файла
+MBOX_CHECKPOINT = 1000
+
+
+def mbox_entry(content):
+    """
+    Превращает EML-письмо в запись Mbox-файла (формат mboxo, как в модуле mailbox).
+
+    Args:
+        content (bytes): Исходное письмо
+
+    Returns:
+        bytes: Строка From, письмо с экранированными строками "From " и пустая строка
+    """
+    content = content.replace(b'\r\n', b'\n')
+    if content.startswith(b'From '):
+        content = b'>' + content
+    content = content.replace(b'\nFrom ', b'\n>From ')
+    if not content.endswith(b'\n'):
+        content += b'\n'
+    from_line = f'From MAILER-DAEMON {time.asctime(time.gmtime())}\n'.encode()
+    return from_line + content + b'\n'
+
+
+# Function for converting downloaded mailboxes from EML to Mbox format
+def convert_to_mbox(mailbox_folder, state=None, mailbox_name=None, store=None):
+    """
+    Дописывает письма ящика в Mbox-файл одним проходом.
+
+    Письма пишутся в порядке UID в один открытый файл с буферизацией.
+    С индексом синхронизации экспорт инкрементальный: в файл добавляются
+    только письма, которых в нем еще нет, а каждые MBOX_CHECKPOINT писем
+    записанная часть отмечается в индексе: после сбоя недописанный хвост
+    отрезается и запись продолжается. Если Mbox-файл изменили или
+    удалили вне скрипта или из индекса удалены записанные в него письма
+    (--sync), он пересоздается целиком.
+
+    Args:
+        mailbox_folder (str): Локальная папка ящика с EML-файлами
+        state (SyncState): Индекс синхронизации (без него файл пересоздается)
+        mailbox_name (str): Каноническое имя ящика в индексе
+        store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+
+    Returns:
+        int: Количество добавленных писем
+    """
+    mbox_path = os.path.join(mailbox_folder, f'{os.path.basename(os.path.normpath(mailbox_folder))}.mbox')
+    mbox_size = os.path.getsize(mbox_path) if os.path.exists(mbox_path) else None
+
+    if state is not None:
+        exported_uids, exported_size = state.mbox_exported(mailbox_name)
+        if exported_size is not None and mbox_size is not None and mbox_size > exported_size:
+            # Прервано после контрольной точки: отбрасываем недописанный хвост и продолжаем с нее
+            os.truncate(mbox_path, exported_size)
+            mbox_size = exported_size
+        if exported_size != mbox_size:
+            # Файл записан не нами (или обрезан): начинаем заново
+            exported_uids = set()
+        email_uids = state.uids(mailbox_name)
+        if exported_uids - email_uids:
+            # Файл только дописывается: удаленные с --sync письма убираются пересозданием файла
+            exported_uids = set()
+        if not exported_uids:
+            # Прежние отметки сбрасываются до записи, иначе после сбоя к ним дописался бы новый файл
+            state.add_mbox_exported(mailbox_name, [], reset=True, size=0)
+        email_uids = sorted(email_uids - exported_uids)
+    elif store is not None:
+        exported_uids = set()
+        email_uids = sorted(store.uids(mailbox_name))
+    else:
+        exported_uids = set()
+        email_uids = sorted(int(os.path.splitext(item)[0]) for item in os.listdir(mailbox_folder)
+                            if item.endswith('.eml') and os.path.splitext(item)[0].isdigit())
+
+    exported = []
+    metrics.start_phase('mbox', len(email_uids))
+    with open(mbox_path, 'ab' if exported_uids else 'wb', buffering=MBOX_BUFFER_SIZE) as mbox_file:
+        for email_uid in email_uids:
+            item_path = os.path.join(mailbox_folder, f'{email_uid}.eml')
+            try:
+                if store is not None:
+                    message = store.get(mailbox_name, email_uid)
+                else:
+                    with open(item_path, 'rb') as f:
+                        message = f.read()
+            except (OSError, KeyError, zlib.error) as e:
+                print(f'Error: Failed to add email with UID {email_uid} to Mbox file')
+                print(str(e))
+                metrics.add('mbox', 0, failed=1)
+                continue
+            mbox_file.write(mbox_entry(message))
+            exported.append(email_uid)
+            metrics.add('mbox', size=len(message))
+
+            # Прерванный после контрольной точки запуск продолжается с нее, а не собирает файл заново
+            if state is not None and len(exported) % MBOX_CHECKPOINT == 0:
+                mbox_file.flush()
+                state.add_mbox_exported(mailbox_name, exported[-MBOX_CHECKPOINT:], reset=False, size=mbox_file.tell())
+
+    if state is not None:
+        checkpointed = len(exported) - len(exported) % MBOX_CHECKPOINT
+        state.add_mbox_exported(mailbox_name, exported[checkpointed:], reset=False, size=os.path.getsize(mbox_path))
+
+    return len(exported)
+
+
+# Максимальный размер сохраняемого вложения по умолчанию (МБ)
+MAX_ATTACHMENT_SIZE_MB = 50
+
+# Размер куска закодированных данных при декодировании вложения
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+
+def safe_attachment_name(filename):
+    """Превращает недоверенное имя вложения в безопасное имя файла без пути."""
+    filename = os.path.basename((filename or '').replace('\\', '/'))
+    filename = ''.join(char for char in filename if char.isprintable()).strip(' .')
+    return filename or 'attachment'
+
+
+def _iter_decoded_chunks(chunks, encoding):
+    """
+    Декодирует куски тела части письма в кодировке Content-Transfer-Encoding по мере поступления.
+
+    Args:
+        chunks (iterable): Куски закодированного тела (bytes)
+        encoding (str): Content-Transfer-Encoding в нижнем регистре
+
+    Yields:
+        bytes: Очередной кусок декодированных данных
+    """
+    if encoding == 'base64':
+        tail = b''
+        for chunk in chunks:
+            chunk = tail + b''.join(chunk.split())
+            usable = len(chunk) - len(chunk) % 4
+            tail = chunk[usable:]
+            if usable:
+                yield binascii.a2b_base64(chunk[:usable])
+        if tail.rstrip(b'='):
+            # Недописанный хвост base64: добиваем паддингом, как делает email
+            yield binascii.a2b_base64(tail + b'=' * (-len(tail) % 4))
+    elif encoding == 'quoted-printable':
+        # Мягкий перенос "=" в конце строки декодируется только вместе с переводом строки
+        tail = b''
+        for chunk in chunks:
+            tail += chunk
+            end = tail.rfind(b'\n') + 1
+            if end and len(tail) >= ATTACHMENT_CHUNK_SIZE:
+                yield binascii.a2b_qp(tail[:end])
+                tail = tail[end:]
+        if tail:
+            yield binascii.a2b_qp(tail)
+    elif encoding in ('7bit', '8bit', 'binary'):
+        yield from chunks
+    else:
+        # uuencode и прочие редкие кодировки декодируем целиком
+        part = email.message_from_bytes(b'Content-Transfer-Encoding: ' + encoding.encode('ascii', 'replace') + b'\r\n\r\n' + b''.join(chunks))
+        yield part.get_payload(decode=True) or b''
+
+
+def _iter_decoded_payload(part):
+    """
+    Декодирует тело части письма кусками, не создавая полную копию в памяти.
+
+    Yields:
+        bytes: Очередной кусок декодированных данных
+    """
+    encoded = part.get_payload(decode=False)
+    if not isinstance(encoded, str):
+        yield part.get_payload(decode=True) or b''
+        return
+
+    encoding = str(part.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+    yield from _iter_decoded_chunks((encoded[start:start + ATTACHMENT_CHUNK_SIZE].encode('ascii', 'surrogateescape')
+                                     for start in range(0, len(encoded), ATTACHMENT_CHUNK_SIZE)), encoding)
+
+
+class AttachmentStore:
+    """
+    Хранилище вложений с адресацией по содержимому.
+
+    Вложение декодируется кусками прямо во временный файл, по пути
+    считается SHA-256, и файл переименовывается в blobs/<xx>/<sha256>.
+    Одинаковые вложения из разных писем и ящиков хранятся один раз,
+    а вложения больше max_size не сохраняются.
+    """
+
+    def __init__(self, root, max_size=MAX_ATTACHMENT_SIZE_MB * 1024 * 1024):
+        self.root = root
+        self.max_size = max_size
+
+    def add(self, part):
+        """
+        Сохраняет вложение из части письма.
+
+        Args:
+            part (email.message.Message): Часть письма с вложением
+
+        Returns:
+            dict: Описание вложения: filename, content_type, size, sha256 и blob
+                  (путь к файлу или None, если вложение пропущено) и skipped (причина)
+        """
+        return self.save(part.get_filename(), part.get_content_type(), _iter_decoded_payload(part))
+
+    def save(self, filename, content_type, chunks):
+        """
+        Сохраняет вложение из кусков декодированных данных (см. add).
+
+        Куски после превышения max_size не запрашиваются.
+        """
+        entry = {
+            'filename': safe_attachment_name(filename),
+            'content_type': content_type,
+            'size': 0,
+            'sha256': None,
+            'blob': None,
+            'skipped': None,
+        }
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    entry['size'] += len(chunk)
+                    if self.max_size and entry['size'] > self.max_size:
+                        entry['skipped'] = f'larger than {self.max_size} bytes'
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+            if entry['skipped']:
+                os.remove(tmp_path)
+                return entry
+
+            entry['sha256'] = digest.hexdigest()
+            blob_path = os.path.join(self.root, 'blobs', entry['sha256'][:2], entry['sha256'])
+            if os.path.exists(blob_path):
+                # Такое вложение уже сохранено
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+            entry['blob'] = blob_path
+            return entry
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+# Заголовок, которым в письме без тел вложений помечена вынесенная часть (метка разбора и номер вложения)
+ATTACHMENT_MARKER = 'X-Downloader-Attachment'
+
+# Строка заголовка или его продолжение (как в email.feedparser)
+_HEADER_LINE_RE = re.compile(rb'^(From |[\041-\071\073-\176]*:|[\t ])')
+
+
+class _AttachmentSplitter:
+    """
+    Читает письмо построчно и отделяет тела вложений от остального письма.
+
+    Тела частей с именем файла (кроме text/plain и text/html) передаются
+    кусками в save(part, chunks) и не попадают в память целиком; вместо
+    них в письме остается пустая часть с заголовком ATTACHMENT_MARKER
+    (см. index). Остальное письмо (заголовки, текст, HTML) собирается для BytesParser.
+    Части разбираются так же, как в email.feedparser: строка перед
+    границей multipart относится к границе.
+    """
+
+    def __init__(self, f, save):
+        self.f = f
+        self.save = save
+        self.out = io.BytesIO()
+        self.count = 0
+        # Случайная метка отличает свои заголовки ATTACHMENT_MARKER от пришедших в письме
+        self.token = os.urandom(8).hex()
+        self._pushed = None
+        self._at_start = True
+
+    def split(self):
+        """Возвращает письмо без тел вложений (bytes)."""
+        self._entity((), top=True)
+        return self.out.getvalue()
+
+    def index(self, part):
+        """Возвращает номер вложения, вынесенного из части разобранного письма, или None."""
+        for value in part.get_all(ATTACHMENT_MARKER, ()):
+            token, _, index = str(value).partition(':')
+            if token == self.token and index.isdigit():
+                return int(index)
+        return None
+
+    def _read(self):
+        """Возвращает (кусок, начало строки) или (None, True) в конце файла; строки длиннее куска делятся."""
+        if self._pushed is not None:
+            piece, self._pushed = self._pushed, None
+            return piece
+        at_start = self._at_start
+        piece = self.f.readline(ATTACHMENT_CHUNK_SIZE)
+        if not piece:
+            return None, True
+        self._at_start = piece.endswith(b'\n')
+        return piece, at_start
+
+    def _boundary(self, piece, at_start, boundaries):
+        """Возвращает совпадение строки с одной из границ или None."""
+        if not at_start or not piece.startswith(b'--'):
+            return None
+        for boundary_re in boundaries:
+            match = boundary_re.match(piece)
+            if match:
+                return match
+        return None
+
+    def _copy(self, boundaries):
+        """Переписывает строки до границы (она остается непрочитанной) или конца файла."""
+        while True:
+            piece, at_start = self._read()
+            if piece is None:
+                return
+            if self._boundary(piece, at_start, boundaries):
+                self._pushed = (piece, at_start)
+                return
+            self.out.write(piece)
+
+    def _body(self, boundaries):
+        """Возвращает куски тела части до границы без перевода строки перед ней."""
+        eol = b''
+        while True:
+            piece, at_start = self._read()
+            if piece is None:
+                return
+            if self._boundary(piece, at_start, boundaries):
+                self._pushed = (piece, at_start)
+                return
+            if eol:
+                yield eol
+            eol = piece[len(piece.rstrip(b'\r\n')):]
+            yield piece[:len(piece) - len(eol)]
+
+    def _entity(self, boundaries, top=False):
+        """Разбирает часть письма (или письмо целиком) до границы из boundaries."""
+        header = []
+        blank = b''
+        while True:
+            piece, at_start = self._read()
+            if piece is None:
+                break
+            if self._boundary(piece, at_start, boundaries):
+                self._pushed = (piece, at_start)
+                break
+            if at_start and piece in (b'\r\n', b'\n'):
+                blank = piece
+                break
+            if at_start and not _HEADER_LINE_RE.match(piece):
+                # Тело без пустой строки после заголовка
+                self._pushed = (piece, at_start)
+                break
+            header.append(piece)
+        header = b''.join(header)
+        part = BytesParser(policy=policy.default).parsebytes(header + (blank or b'\r\n'), headersonly=True)
+
+        boundary = part.get_boundary() if part.get_content_maintype() == 'multipart' else None
+        encoding = str(part.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+        if boundary:
+            self.out.write(header + blank)
+            self._multipart(boundary, boundaries)
+        elif (part.get_content_maintype() == 'message' and part.get_content_subtype() != 'delivery-status'
+              and encoding in ('7bit', '8bit', 'binary')):
+            # Вложенное письмо разбирается как письмо
+            self.out.write(header + blank)
+            self._entity(boundaries)
+        elif not top and part.get_filename() and part.get_content_type() not in ('text/plain', 'text/html'):
+            linesep = b'\r\n' if header.endswith(b'\r\n') or not header else b'\n'
+            self.out.write(header + f'{ATTACHMENT_MARKER}: {self.token}:{self.count}'.encode() + linesep + (blank or linesep))
+            self.count += 1
+            chunks = self._body(boundaries)
+            self.save(part, chunks)
+            # Остаток пропущенного вложения
+            for _ in chunks:
+                pass
+        else:
+            self.out.write(header + blank)
+            self._copy(boundaries)
+
+    def _multipart(self, boundary, boundaries):
+        """Разбирает тело multipart: преамбулу, части и эпилог."""
+        boundary_re = re.compile(b'--' + re.escape(boundary.encode('utf-8', 'surrogateescape')) + rb'(--)?[ \t]*(\r\n|\r|\n)?$')
+        inner = boundaries + (boundary_re,)
+        self._copy(inner)
+        while True:
+            piece, at_start = self._read()
+            if piece is None:
+                return
+            match = self._boundary(piece, at_start, (boundary_re,))
+            if match is None:
+                # Граница внешней части
+                self._pushed = (piece, at_start)
+                return
+            self.out.write(piece)
+            if match.group(1):
+                self._copy(boundaries)
+                return
+            self._entity(inner)
+
+
+def process_eml_file(file_name, input_dir, output_dir='output', txt=False, html=False, files=False, sanitizer=None,
+                     attachment_store=None, store=None, mailbox_name=None):
+    """
+    Обработка EML файла с сохранением вложений
+
+    Args:
+        file_name (str): Имя EML файла
+        input_dir (str): Директория с EML файлами
+        output_dir (str): Директория для результатов
+        txt (bool): Сохранять текст письма
+        html (bool): Сохранять HTML письма
+        files (bool): Сохранять вложения
+        sanitizer (str): Движок очистки HTML (см. sanitize_html)
+        attachment_store (AttachmentStore): Хранилище вложений
+            (по умолчанию - папка attachments внутри output_dir)
+        store (PackStore): Упакованное хранилище писем, из которого письмо
+            <uid>.eml ящика mailbox_name читается вместо файла
+        mailbox_name (str): Каноническое имя ящика в store
+    """
+    eml_file = os.path.join(input_dir, file_name)
+
+    # Создаем выходную директорию
+    os.makedirs(output_dir, exist_ok=True)
+    
+    if files and attachment_store is None:
+        attachment_store = AttachmentStore(os.path.join(output_dir, 'attachments'))
+
+    # Вложения сохраняются по мере чтения письма, разбирается только остальное письмо
+    streamed = []
+
+    def save_attachment(part, chunks):
+        if files:
+            encoding = str(part.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+            streamed.append(attachment_store.save(part.get_filename(), part.get_content_type(),
+                                                  _iter_decoded_chunks(chunks, encoding)))
+        else:
+            streamed.append(None)
+
+    # Длительности этапов передаются в результате: процесс пула не видит метрики основного
+    timings = {'parse': 0.0, 'sanitize': 0.0}
+    start = time.perf_counter()
+    if store is not None:
+        # Упакованное письмо распаковывается в память целиком
+        content = store.get(mailbox_name, os.path.splitext(file_name)[0])
+        size = len(content)
+        splitter = _AttachmentSplitter(io.BytesIO(content), save_attachment)
+        skeleton = splitter.split()
+        del content
+    else:
+        with open(eml_file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            splitter = _AttachmentSplitter(f, save_attachment)
+            skeleton = splitter.split()
+    msg = BytesParser(policy=policy.default).parsebytes(skeleton)
+    timings['parse'] = time.perf_counter() - start
+    
+    # Информация о письме
+    log(f"Subject: {msg['subject']}\nFrom: {msg['from']}\nDate: {msg['date']}", VERBOSE)
+
+    head = 'Subject:' + msg['subject'] + '\nFrom:' + msg['from'] + '\nDate:' + msg['date'] + '\n'
+    # Сохраняем текст письма
+    text_body = ''
+    html_body = ''
+    attachments = []
+    
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            
+            if content_type == 'text/plain':
+                    payload = part.get_payload(decode=True)
+                    charset = part.get_content_charset() or 'utf-8'
+                    text_body = payload.decode(charset, errors='ignore')
+                
+            elif content_type == 'text/html':
+                    payload = part.get_payload(decode=True)
+                    charset = part.get_content_charset() or 'utf-8'
+                    html_body = payload.decode(charset, errors='ignore')
+                    # Стили и обертка html/head/body убираются за один проход
+                    start = time.perf_counter()
+                    html_body = sanitize_html(html_body, unwrap=True, backend=sanitizer)
+                    timings['sanitize'] += time.perf_counter() - start
+            elif part.get_filename():  # Вложение
+                if files:
+                    # Вложение уже сохранено при чтении письма (или сохраняем его из части)
+                    index = splitter.index(part)
+                    entry = streamed[index] if index is not None else attachment_store.add(part)
+                    if entry['skipped']:
+                        print(f"Пропущено вложение {entry['filename']}: {entry['skipped']}")
+                    else:
+                        entry['blob'] = os.path.relpath(entry['blob'], output_dir)
+                        log(f"Сохранено вложение: {entry['filename']}", VERBOSE)
+                    attachments.append(entry)
+    else:
+        # Не multipart письмо
+        payload = msg.get_payload(decode=True)
+        charset = msg.get_content_charset() or 'utf-8'
+        text_body = payload.decode(charset, errors='ignore')
+    
+    # if head:
+    #     with open(os.path.join(output_dir, f'{file_name}.txt'), 'w', encoding='utf-8') as f:
+    #         f.write(head)
+    
+    # Сохраняем текст письма
+    if text_body and txt:
+        atomic_write(os.path.join(output_dir, f'{file_name}.txt'), head + text_body, encoding='utf-8')
+    
+    if html_body and html:
+        atomic_write(os.path.join(output_dir, f'{file_name}.html'), head + html_body, encoding='utf-8')
+    
+    # Список вложений письма со ссылками на файлы в хранилище
+    if attachments:
+        atomic_write(os.path.join(output_dir, f'{file_name}.attachments.json'),
+                     json.dumps(attachments, ensure_ascii=False, indent=2), encoding='utf-8')
+    
+    return {
+        'subject': msg['subject'],
+        'from': msg['from'],
+        'date': msg['date'],
+        'text_body': text_body,
+        'html_body': html_body,
+        'attachments': attachments,
+        'size': size,
+        'timings': timings
+    }
+
+
+# Сколько файлов отдавать процессу-обработчику за одну задачу
+DECODE_CHUNK_SIZE = 50
+
+
+def _process_eml_chunk(file_names, input_dir, output_dir, options):
+    """Обрабатывает пачку EML файлов в процессе пула и собирает результаты по файлам."""
+    results = []
+    for file_name in file_names:
+        try:
+            results.append((file_name, process_eml_file(file_name, input_dir, output_dir, **options), None))
+        except Exception as e:
+            # Исключение передаем строкой: не все исключения можно передать между процессами
+            results.append((file_name, None, f'{type(e).__name__}: {e}'))
+    store = options.get('store')
+    if store is not None and store.read_only:
+        # Копия хранилища, переданная в процесс пула вместе с задачей, больше не нужна
+        store.close()
+    return results
+
+
+# Журнал обработанных писем в выходной папке ящика
+DECODE_JOURNAL = '.decode.journal'
+
+
+def _source_key(file_name, input_dir, stored_sizes):
+    """Отпечаток исходного письма: размер и время изменения файла (или размер в хранилище)."""
+    try:
+        if stored_sizes is not None:
+            return str(stored_sizes[int(os.path.splitext(file_name)[0])])
+        stat = os.stat(os.path.join(input_dir, file_name))
+        return f'{stat.st_size}:{stat.st_mtime_ns}'
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def decode_eml_files(file_names, input_dir, output_dir, workers=None, chunk_size=DECODE_CHUNK_SIZE, journal=None, executor=None,
+                     **options):
+    """
+    Параллельно обрабатывает EML файлы функцией process_eml_file.
+
+    Файлы отдаются пулу процессов пачками по chunk_size, при этом в работе
+    одновременно держится не больше нескольких пачек на процесс, чтобы
+    результаты не копились в памяти.
+
+    С журналом каждое обработанное письмо сразу отмечается в нем вместе с
+    отпечатком исходного файла, а письма, уже отмеченные с тем же
+    отпечатком, пропускаются: прерванная обработка продолжается с места
+    остановки.
+
+    Args:
+        file_names (list): Имена EML файлов
+        input_dir (str): Директория с EML файлами
+        output_dir (str): Директория для результатов
+        workers (int): Количество процессов (None - по числу ядер, 1 - без пула)
+        chunk_size (int): Количество файлов в одной задаче
+        journal (CheckpointJournal): Журнал обработанных писем (None - обработать все)
+        executor (ProcessPoolExecutor): Общий пул процессов (None - создать пул на время вызова)
+        **options: txt, html, files, store и другие параметры process_eml_file
+
+    Yields:
+        tuple: (file_name, result, error) в исходном порядке файлов (кроме пропущенных)
+    """
+    if journal is not None:
+        done = {entry['file']: entry['key'] for entry in journal.entries}
+        if len(journal.entries) > 2 * len(done):
+            journal.rewrite({'file': file_name, 'key': key} for file_name, key in done.items())
+        store = options.get('store')
+        stored_sizes = dict(store.sizes(options.get('mailbox_name'))) if store is not None else None
+        keys = {file_name: _source_key(file_name, input_dir, stored_sizes) for file_name in file_names}
+        file_names = [file_name for file_name in file_names if keys[file_name] is None or done.get(file_name) != keys[file_name]]
+
+    metrics.start_phase('decode', len(file_names))
+    for file_name, result, error in _decode_chunks(file_names, input_dir, output_dir, workers, chunk_size, options, executor):
+        if error is None:
+            for stage, seconds in result['timings'].items():
+                metrics.observe(stage, seconds)
+            metrics.add('decode', size=result['size'])
+            if journal is not None and keys[file_name] is not None:
+                journal.append({'file': file_name, 'key': keys[file_name]})
+        else:
+            metrics.add('decode', 0, failed=1)
+        yield file_name, result, error
+
+
+def decode_pool(workers):
+    """
+    Создает пул процессов обработки писем.
+
+    Пул запускает процессы по мере надобности, то есть уже из потоков
+    загрузки, а дочерний процесс fork наследует блокировки, захваченные
+    в этот момент другими потоками. Поэтому процессы порождаются через
+    forkserver (spawn там, где его нет).
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method),
+                               initializer=set_verbosity, initargs=(VERBOSITY,))
+
+
+def _decode_chunks(file_names, input_dir, output_dir, workers, chunk_size, options, executor=None):
+    """Раздает пачки файлов процессам пула (см. decode_eml_files)."""
+    chunks = [file_names[start:start + chunk_size] for start in range(0, len(file_names), chunk_size)]
+
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield from _process_eml_chunk(chunk, input_dir, output_dir, options)
+        return
+
+    if executor is None:
+        workers = workers or os.cpu_count() or 1
+        with decode_pool(workers) as executor:
+            yield from _decode_chunks(file_names, input_dir, output_dir, workers, chunk_size, options, executor)
+        return
+
+    max_pending = (workers or os.cpu_count() or 1) * 2
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(_process_eml_chunk, chunk, input_dir, output_dir, options))
+        if len(pending) >= max_pending:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+# Сколько UID запрашивать одной командой FETCH по умолчанию
+FETCH_BATCH_SIZE = 200
+
+# Сколько байт писем (по RFC822.SIZE) запрашивать одной командой FETCH в режиме full
+FETCH_BATCH_BYTES = 32 * 1024 * 1024
+
+# Письма больше этого размера (МБ) скачиваются частями прямо на диск
+STREAM_MESSAGE_SIZE_MB = 16
+
+# Размер одной части BODY.PEEK[]<offset.size> при потоковой загрузке письма
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Токены ответа FETCH: скобки, строки в кавычках, литералы и атомы
+# (атом может содержать секцию вида BODY[HEADER.FIELDS (MESSAGE-ID)]<0>)
+_FETCH_TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}$|[^\s()"\[\]]*\[[^\]]*\](?:<\d+>)?|[^\s()"]+')
+
+
+def uid_set(uids):
+    """
+    Сжимает список UID в набор IMAP вида '1:5,7,9:12'.
+
+    Args:
+        uids (list): Список UID (str, bytes или int)
+
+    Returns:
+        str: Набор UID для команды UID FETCH
+    """
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in ranges)
+
+
+def _tokenize_fetch_data(data):
+    """Превращает ответ imaplib (строки и кортежи с литералами) в поток токенов."""
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            text, literal = item
+        else:
+            text, literal = item, None
+        for match in _FETCH_TOKEN_RE.finditer(text):
+            token = match.group()
+            if token.startswith(b'{') and literal is not None:
+                continue
+            if token.startswith(b'"'):
+                token = re.sub(rb'\\(.)', rb'\1', token[1:-1])
+            yield token
+        if literal is not None:
+            # Литерал отдаем отдельным токеном, чтобы не путать его со скобками
+            yield (literal,)
+
+
+def parse_fetch_response(data):
+    """
+    Разбирает ответ UID FETCH на отдельные сообщения.
+
+    Генератор: каждое сообщение отдается сразу, как только разобрано,
+    не дожидаясь разбора остальной части ответа.
+
+    Args:
+        data (list): Данные ответа imaplib для команды FETCH
+
+    Yields:
+        dict: Атрибуты сообщения, например {'UID': b'5', 'RFC822': b'...'}
+    """
+    stack = []
+    for token in _tokenize_fetch_data(data):
+        if token == b'(':
+            stack.append([])
+        elif token == b')':
+            if not stack:
+                continue
+            items = stack.pop()
+            if stack:
+                stack[-1].append(items)
+                continue
+            # Закрылся список атрибутов сообщения
+            message = {}
+            for key, value in zip(items[::2], items[1::2]):
+                if isinstance(value, tuple):
+                    value = value[0]
+                message[key.decode('ascii', 'replace').upper()] = value
+            yield message
+        elif stack:
+            stack[-1].append(token)
+        # Номер сообщения до открывающей скобки пропускаем
+
+
+# Режимы загрузки: письмо целиком, только текст и HTML, только заголовки
+FETCH_MODES = ('full', 'text', 'headers')
+
+# Атрибуты FETCH для первого запроса в каждом режиме (PEEK не ставит флаг \\Seen)
+_FETCH_ITEMS = {
+    'full': '(UID RFC822.SIZE BODY.PEEK[])',
+    'text': '(UID BODYSTRUCTURE BODY.PEEK[HEADER])',
+    'headers': '(UID BODY.PEEK[HEADER])',
+}
+
+# Заголовок, которым помечаются не полностью скачанные письма
+PARTIAL_HEADER = b'X-Downloader-Partial'
+
+
+def _structure_value(value):
+    """Приводит элемент BODYSTRUCTURE к bytes (литералы приходят кортежем)."""
+    if isinstance(value, tuple):
+        value = value[0]
+    return value if isinstance(value, bytes) else b''
+
+
+def text_sections(structure, prefix=''):
+    """
+    Находит в BODYSTRUCTURE текстовые части письма (text/plain и text/html не вложениями).
+
+    Args:
+        structure (list): Разобранный BODYSTRUCTURE
+        prefix (str): Номер родительской части
+
+    Returns:
+        list: Номера частей для BODY[<часть>], например ['1.1', '1.2']
+    """
+    if structure and isinstance(structure[0], list):
+        # multipart: вложенные части идут первыми, затем подтип и расширения
+        sections = []
+        for index, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            sections += text_sections(child, f'{prefix}.{index}' if prefix else str(index))
+        return sections
+
+    if len(structure) < 2:
+        return []
+    maintype = _structure_value(structure[0]).upper()
+    subtype = _structure_value(structure[1]).upper()
+    if maintype != b'TEXT' or subtype not in (b'PLAIN', b'HTML'):
+        return []
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and _structure_value(disposition[0]).upper() == b'ATTACHMENT':
+        return []
+    return [prefix or '1']
+
+
+def _mark_partial(header, mode, content_type=None):
+    """Добавляет в блок заголовков метку частичной загрузки и, при необходимости, новый Content-Type."""
+    lines = re.split(rb'\r?\n(?=[^ \t])', header.rstrip(b'\r\n'))
+    if content_type is not None:
+        lines = [line for line in lines
+                 if not line.lower().startswith((b'content-type:', b'content-transfer-encoding:'))]
+        lines.append(b'Content-Type: ' + content_type)
+    lines.append(PARTIAL_HEADER + b': ' + mode.encode())
+    return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+def _build_text_message(uid, header, structure, parts):
+    """
+    Собирает EML из заголовков и скачанных текстовых частей письма.
+
+    Args:
+        uid (str): UID письма
+        header (bytes): BODY[HEADER]
+        structure (list): BODYSTRUCTURE письма
+        parts (dict): {номер части: (MIME-заголовки, тело)}
+
+    Returns:
+        bytes: Письмо без вложений
+    """
+    if not (structure and isinstance(structure[0], list)):
+        # Одночастное письмо: заголовки письма уже описывают тело
+        body = parts.get('1', (b'', b''))[1]
+        return _mark_partial(header, 'text') + body
+
+    boundary = f'partial-{uid}-{hashlib.sha1(header).hexdigest()[:16]}'.encode()
+    content = [_mark_partial(header, 'text', b'multipart/mixed; boundary="' + boundary + b'"')]
+    for section, (mime_header, body) in parts.items():
+        content.append(b'--' + boundary + b'\r\n' + mime_header + body + b'\r\n')
+    content.append(b'--' + boundary + b'--\r\n')
+    return b''.join(content)
+
+
+def _fetch_text_parts(connection, messages):
+    """
+    Докачивает текстовые части писем, сгруппировав письма с одинаковым набором частей.
+
+    Одночастное письмо и multipart с единственной текстовой частью дают
+    одинаковый набор ('1',), но запрашиваются по-разному (BODY[TEXT] и
+    BODY[1.MIME] BODY[1]), поэтому в ключ группы входит и вид письма.
+
+    Args:
+        connection (imaplib.IMAP4): Соединение с выбранным почтовым ящиком
+        messages (dict): {uid: (header, structure)}
+
+    Yields:
+        tuple: (uid, content, error)
+    """
+    groups = {}
+    for uid, (header, structure) in messages.items():
+        multipart = bool(structure) and isinstance(structure[0], list)
+        groups.setdefault((multipart, tuple(text_sections(structure))), []).append(uid)
+
+    for (multipart, sections), uids in groups.items():
+        if not sections:
+            # Нет текстовых частей: сохраняем только заголовки
+            for uid in uids:
+                yield uid, _mark_partial(messages[uid][0], 'text'), None
+            continue
+
+        single_part = sections == ('1',) and not multipart
+        if single_part:
+            items = '(UID BODY.PEEK[TEXT])'
+        else:
+            items = '(UID ' + ' '.join(f'BODY.PEEK[{section}.MIME] BODY.PEEK[{section}]' for section in sections) + ')'
+        try:
+            with metrics.timer('fetch'):
+                typ, data = connection.uid('FETCH', uid_set(uids), items)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f'FETCH failed: {data}')
+        except imaplib.IMAP4.abort:
+            raise
+        except Exception as e:
+            for uid in uids:
+                yield uid, None, e
+            continue
+
+        pending = set(uids)
+        for message in parse_fetch_response(data):
+            uid = message.get('UID', b'').decode()
+            if uid not in pending:
+                continue
+            pending.discard(uid)
+            if single_part:
+                parts = {'1': (b'', message.get('BODY[TEXT]') or b'')}
+            else:
+                parts = {section: (message.get(f'BODY[{section}.MIME]') or b'', message.get(f'BODY[{section}]') or b'')
+                         for section in sections}
+            header, structure = messages[uid]
+            yield uid, _build_text_message(uid, header, structure, parts), None
+
+        for uid in uids:
+            if uid in pending:
+                yield uid, None, imaplib.IMAP4.error('message parts were not returned by the server')
+
+
+def fetch_messages(connection, email_uids, batch_size=FETCH_BATCH_SIZE, mode='full'):
+    """
+    Скачивает письма пачками UID FETCH вместо отдельной команды на каждое письмо.
+
+    Если сервер отклонил пачку целиком, письма этой пачки запрашиваются
+    по одному, чтобы ошибка осталась привязанной к конкретному UID.
+
+    Режимы:
+        full - письмо целиком (BODY.PEEK[]); если размер не совпал с
+               RFC822.SIZE, письмо сохраняется с предупреждением
+               (строгая сверка - в --verify);
+        text - сначала BODYSTRUCTURE и заголовки, затем только text/plain и
+               text/html части, без вложений;
+        headers - только заголовки.
+    Все режимы используют PEEK и не меняют флаг \\Seen.
+
+    Args:
+        connection (imaplib.IMAP4): Соединение с выбранным почтовым ящиком
+        email_uids (list): Список UID (str)
+        batch_size (int): Количество UID в одной команде FETCH
+        mode (str): Режим загрузки из FETCH_MODES
+
+    Yields:
+        tuple: (uid, content, error) - содержимое письма или ошибка
+    """
+    batch_size = max(1, batch_size)
+    for start in range(0, len(email_uids), batch_size):
+        chunk = email_uids[start:start + batch_size]
+        try:
+            with metrics.timer('fetch'):
+                typ, data = connection.uid('FETCH', uid_set(chunk), _FETCH_ITEMS[mode])
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f'FETCH failed: {data}')
+        except imaplib.IMAP4.abort:
+            # Соединение разорвано, повторять по одному бессмысленно
+            raise
+        except Exception as e:
+            if len(chunk) == 1:
+                yield chunk[0], None, e
+            else:
+                for uid in chunk:
+                    yield from fetch_messages(connection, [uid], 1, mode)
+            continue
+
+        pending = set(chunk)
+        structures = {}
+        for message in parse_fetch_response(data):
+            uid = message.get('UID', b'').decode()
+            content = message.get('BODY[]' if mode == 'full' else 'BODY[HEADER]')
+            if uid not in pending or content is None:
+                continue
+            pending.discard(uid)
+            if mode == 'full':
+                size = message.get('RFC822.SIZE')
+                if size is not None and int(size) != len(content):
+                    # Некоторые серверы считают RFC822.SIZE иначе, чем отдают письмо, поэтому
+                    # письмо сохраняется как есть, а обрезанные находит и докачивает --verify
+                    log(f'Warning: Email {uid}: size mismatch: received {len(content)} of {int(size)} bytes')
+                yield uid, content, None
+            elif mode == 'headers':
+                yield uid, _mark_partial(content, 'headers'), None
+            else:
+                structures[uid] = (content, message.get('BODYSTRUCTURE') or [])
+
+        if structures:
+            yield from _fetch_text_parts(connection, structures)
+
+        for uid in chunk:
+            if uid in pending:
+                yield uid, None, imaplib.IMAP4.error('message was not returned by the server')
+
+
+def fetch_sizes(connection, email_uids, batch_size=FETCH_BATCH_SIZE):
+    """
+    Запрашивает размеры писем (RFC822.SIZE) пачками UID FETCH, не скачивая сами письма.
+
+    Returns:
+        dict: UID (str) -> размер письма в байтах
+    """
+    sizes = {}
+    batch_size = max(1, batch_size)
+    for start in range(0, len(email_uids), batch_size):
+        with metrics.timer('fetch'):
+            typ, data = connection.uid('FETCH', uid_set(email_uids[start:start + batch_size]), '(UID RFC822.SIZE)')
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f'FETCH failed: {data}')
+        for message in parse_fetch_response(data):
+            size = message.get('RFC822.SIZE')
+            if size is not None:
+                sizes[message.get('UID', b'').decode()] = int(size)
+    return sizes
+
+
+def size_batches(email_uids, sizes, batch_size=FETCH_BATCH_SIZE, max_bytes=FETCH_BATCH_BYTES):
+    """
+    Делит UID на пачки не больше batch_size писем и max_bytes байт.
+
+    Письмо больше max_bytes попадает в пачку одно. Письма с неизвестным
+    размером считаются пустыми.
+
+    Yields:
+        list: UID (str) очередной пачки
+    """
+    batch = []
+    total = 0
+    for email_uid in email_uids:
+        size = sizes.get(email_uid, 0)
+        if batch and (len(batch) >= batch_size or total + size > max_bytes):
+            yield batch
+            batch = []
+            total = 0
+        batch.append(email_uid)
+        total += size
+    if batch:
+        yield batch
+
+
+def fetch_message_chunks(connection, email_uid, size, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Скачивает письмо частями BODY.PEEK[]<offset.size>, не держа его в памяти целиком.
+
+    Части запрашиваются, пока сервер не вернет неполную часть, поэтому
+    письмо, размер которого не совпал с RFC822.SIZE, скачивается целиком
+    и сохраняется с предупреждением.
+
+    Args:
+        connection (imaplib.IMAP4): Соединение с выбранным почтовым ящиком
+        email_uid (str): UID письма
+        size (int): Размер письма (RFC822.SIZE)
+        chunk_size (int): Размер одной части в байтах
+
+    Yields:
+        bytes: Очередная часть письма
+
+    Raises:
+        imaplib.IMAP4.error: Сервер не вернул ни одной части письма
+    """
+    offset = 0
+    while True:
+        with metrics.timer('fetch'):
+            typ, data = connection.uid('FETCH', email_uid, f'(UID BODY.PEEK[]<{offset}.{chunk_size}>)')
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f'FETCH failed: {data}')
+        chunk = None
+        for message in parse_fetch_response(data):
+            if message.get('UID', b'').decode() == email_uid:
+                chunk = next((value for key, value in message.items() if key.startswith('BODY[]')), None)
+        if not chunk:
+            if not offset:
+                # Письмо удалено во время загрузки
+                raise imaplib.IMAP4.error(f'FETCH returned no data: {data}')
+            break
+        offset += len(chunk)
+        yield chunk
+        if len(chunk) < chunk_size:
+            break
+    if offset != size:
+        log(f'Warning: Email {email_uid}: size mismatch: received {offset} of {size} bytes')
+
+
+def stream_message(connection, email_file_path, email_uid, size, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Скачивает большое письмо частями сразу в EML-файл.
+
+    В памяти находится только одна часть письма, SHA-256 и Message-ID
+    считаются по ходу записи. Файл появляется под своим именем только
+    после получения всех частей (см. atomic_open).
+
+    Args:
+        connection (imaplib.IMAP4): Соединение с выбранным почтовым ящиком
+        email_file_path (str): Путь EML-файла
+        email_uid (str): UID письма
+        size (int): Размер письма (RFC822.SIZE)
+        chunk_size (int): Размер одной части в байтах
+
+    Returns:
+        tuple: (digest, message_id) - SHA-256 содержимого и Message-ID письма
+    """
+    digest = hashlib.sha256()
+    # Начало письма, в котором ищется Message-ID
+    header = b''
+    with atomic_open(email_file_path) as f:
+        for chunk in fetch_message_chunks(connection, email_uid, size, chunk_size):
+            if len(header) < chunk_size:
+                header += chunk[:chunk_size - len(header)]
+            digest.update(chunk)
+            with metrics.timer('write'):
+                f.write(chunk)
+    return digest.hexdigest(), message_id(header)
+
+
+# Заголовок для поиска копий письма в других ящиках до загрузки
+_MESSAGE_ID_ITEMS = '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+
+_HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
+_MESSAGE_ID_RE = re.compile(rb'^Message-ID:[ \t]*(.*(?:\r?\n[ \t].*)*)', re.IGNORECASE | re.MULTILINE)
+
+
+def message_id(content):
+    """
+    Возвращает Message-ID письма или его заголовка (bytes).
+
+    Ищется только в заголовке самого письма, а не во вложенных письмах.
+
+    Returns:
+        str: Message-ID без пробельных символов или None, если его нет
+    """
+    end = _HEADER_END_RE.search(content)
+    match = _MESSAGE_ID_RE.search(content, 0, end.start() if end else len(content))
+    if match is None:
+        return None
+    return re.sub(rb'\s+', b'', match.group(1)).decode('ascii', 'replace') or None
+
+
+# Параметры IMAP-сервера Яндекса
+IMAP_SERVER = 'imap.yandex.com'
+IMAP_PORT = 993
+
+# Сколько UID отдавать одному рабочему соединению за раз
+WORKER_CHUNK_SIZE = 1000
+
+# Сколько раз переоткрывать разорванное соединение, прежде чем считать письма не скачанными
+CONNECTION_RETRIES = 3
+
+
+def connect_imap(username, password, server=IMAP_SERVER, port=IMAP_PORT, ssl_context=None):
+    """Открывает SSL-соединение с IMAP-сервером и авторизуется."""
+    connection = imaplib.IMAP4_SSL(server, port, ssl_context=ssl_context)
+    connection.login(username, password)
+    return connection
+
+
+def imap_mailbox_name(mailbox_name):
+    """Возвращает имя ящика в виде, пригодном для команды SELECT."""
+    if ' ' in mailbox_name or not mailbox_name.isascii():
+        return '"' + mailbox_name + '"'
+    return mailbox_name
+
+
+class IMAPConnectionPool:
+    """
+    Ограниченный пул авторизованных IMAP-соединений для параллельной загрузки.
+
+    Каждый поток пула держит собственное соединение и переключает ящик
+    только тогда, когда задача относится к другому ящику. Разорванное
+    соединение переоткрывается с экспоненциальной задержкой, а общий
+    интервал между командами не дает серверу заблокировать аккаунт.
+    """
+
+    def __init__(self, username, password, workers, throttle=0.0, retries=CONNECTION_RETRIES, server=IMAP_SERVER, port=IMAP_PORT,
+                 ssl_context=None):
+        self.username = username
+        self.password = password
+        self.server = server
+        self.port = port
+        self.ssl_context = ssl_context
+        self.throttle = throttle
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._next_command = 0.0
+        self._connections = []
+
+    def _wait_turn(self):
+        """Выдерживает минимальный интервал между командами всех потоков."""
+        if self.throttle <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_command - now
+            self._next_command = max(now, self._next_command) + self.throttle
+        if delay > 0:
+            time.sleep(delay)
+
+    def _connection(self, mailbox_name):
+        """Возвращает соединение текущего потока с выбранным ящиком."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            self._wait_turn()
+            connection = connect_imap(self.username, self.password, self.server, self.port, self.ssl_context)
+            self._local.connection = connection
+            self._local.mailbox = None
+            with self._lock:
+                self._connections.append(connection)
+
+        if self._local.mailbox != mailbox_name:
+            self._wait_turn()
+            typ, data = connection.select(imap_mailbox_name(mailbox_name), readonly=True)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f'SELECT {mailbox_name} failed: {data}')
+            self._local.mailbox = mailbox_name
+        return connection
+
+    def _drop_connection(self):
+        """Забывает соединение текущего потока после обрыва."""
+        connection = self._local.connection
+        self._local.connection = None
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+        try:
+            connection.shutdown()
+        except Exception:
+            pass
+
+    def _run(self, mailbox_name, func, args):
+        for attempt in range(self.retries + 1):
+            try:
+                connection = self._connection(mailbox_name)
+                self._wait_turn()
+                return func(connection, *args)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                if getattr(self._local, 'connection', None) is not None:
+                    self._drop_connection()
+                if attempt == self.retries:
+                    raise
+                delay = 2 ** attempt
+                print(f'Connection lost ({e}), reconnecting in {delay}s..')
+                time.sleep(delay)
+
+    def submit(self, mailbox_name, func, *args):
+        """
+        Ставит задачу в очередь пула.
+
+        Args:
+            mailbox_name (str): Ящик, который должен быть выбран в соединении
+            func (callable): Функция вида func(connection, *args)
+
+        Returns:
+            Future: Результат func
+        """
+        # Задача выполняется в контексте вызывающего потока, чтобы метрики попали в его аккаунт
+        return self.executor.submit(contextvars.copy_context().run, self._run, mailbox_name, func, args)
+
+    def close(self):
+        """Дожидается задач и закрывает все соединения пула."""
+        self.executor.shutdown(wait=True)
+        for connection in self._connections:
+            try:
+                connection.logout()
+            except Exception:
+                pass
+        self._connections = []
+
+
+def mailbox_status(connection):
+    """
+    Возвращает параметры выбранного ящика из ответа на SELECT/EXAMINE.
+
+    Args:
+        connection (imaplib.IMAP4): Соединение сразу после выбора ящика
+
+    Returns:
+        dict: EXISTS, UIDVALIDITY, UIDNEXT и HIGHESTMODSEQ (None, если сервер их не прислал)
+    """
+    status = {}
+    for key in ('EXISTS', 'UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'):
+        typ, data = connection.response(key)
+        values = [value for value in data if value]
+        status[key] = int(values[-1]) if values else None
+    return status
+
+
+# Файл индекса синхронизации в папке аккаунта
+SYNC_STATE_FILE = '.sync_state.sqlite'
+
+
+class SyncState:
+    """
+    Локальный индекс синхронизации аккаунта (SQLite в папке аккаунта).
+
+    Для каждого ящика хранит UIDVALIDITY и наибольший скачанный UID,
+    для каждого письма - UID и размер. Проверка "уже скачано" и удаление
+    при --sync сводятся к операциям над множествами UID вместо
+    обращений к файловой системе на каждое письмо.
+
+    Message-ID и SHA-256 скачанных писем позволяют найти копию письма,
+    уже сохраненную в другом ящике (см. find_copy).
+    """
+
+    def __init__(self, account_folder):
+        self.path = os.path.join(account_folder, SYNC_STATE_FILE)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # Ящики, индекс которых был пересоздан в этом запуске
+        self.rebuilt = set()
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS mailboxes ('
+                             'name TEXT PRIMARY KEY, uidvalidity INTEGER, max_uid INTEGER NOT NULL DEFAULT 0)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                             'mailbox TEXT NOT NULL, uid INTEGER NOT NULL, size INTEGER NOT NULL, '
+                             'PRIMARY KEY (mailbox, uid)) WITHOUT ROWID')
+            # Состояние ящика на сервере после последнего полного прохода
+            columns = {row[1] for row in self._db.execute('PRAGMA table_info(mailboxes)')}
+            for column in ('uidnext INTEGER', 'highestmodseq INTEGER', 'exists_count INTEGER', 'search_key TEXT'):
+                if column.split()[0] not in columns:
+                    self._db.execute(f'ALTER TABLE mailboxes ADD COLUMN {column}')
+            # Письма, уже дописанные в Mbox-файл ящика, и размер файла после последней дозаписи
+            if 'mbox_size' not in columns:
+                self._db.execute('ALTER TABLE mailboxes ADD COLUMN mbox_size INTEGER')
+            self._db.execute('CREATE TABLE IF NOT EXISTS mbox_exported ('
+                             'mailbox TEXT NOT NULL, uid INTEGER NOT NULL, PRIMARY KEY (mailbox, uid)) WITHOUT ROWID')
+            # Режим загрузки для писем, скачанных не целиком (NULL - письмо полное)
+            columns = {row[1] for row in self._db.execute('PRAGMA table_info(messages)')}
+            if 'partial' not in columns:
+                self._db.execute('ALTER TABLE messages ADD COLUMN partial TEXT')
+            # Ключи поиска копий письма в других ящиках
+            for column in ('message_id TEXT', 'digest TEXT'):
+                if column.split()[0] not in columns:
+                    self._db.execute(f'ALTER TABLE messages ADD COLUMN {column}')
+            self._db.execute('CREATE INDEX IF NOT EXISTS messages_message_id ON messages (message_id)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS messages_digest ON messages (digest)')
+
+    def open_mailbox(self, mailbox, uidvalidity, mailbox_folder_path, store=None):
+        """
+        Готовит индекс ящика и возвращает множество уже скачанных UID.
+
+        При первом запуске индекс строится по уже скачанным EML-файлам
+        (или по упакованному хранилищу).
+        Если UIDVALIDITY на сервере изменилась, старые UID больше ничего
+        не значат: индекс ящика очищается и письма скачиваются заново.
+
+        Args:
+            mailbox (str): Каноническое имя ящика
+            uidvalidity (int): UIDVALIDITY ящика на сервере
+            mailbox_folder_path (str): Локальная папка ящика
+            store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+
+        Returns:
+            set: UID (int) писем, которые уже есть локально
+        """
+        uidvalidity = uidvalidity or 0
+        with self._lock, self._db:
+            row = self._db.execute('SELECT uidvalidity FROM mailboxes WHERE name = ?', (mailbox,)).fetchone()
+            if row is None:
+                self._db.execute('INSERT INTO mailboxes (name, uidvalidity) VALUES (?, ?)', (mailbox, uidvalidity))
+                if store is not None:
+                    self._seed(mailbox, [(mailbox, uid, size) for uid, size in store.sizes(mailbox)])
+                else:
+                    self._seed_from_folder(mailbox, mailbox_folder_path)
+            elif row[0] != uidvalidity:
+                print(f'UIDVALIDITY of mailbox {mailbox} has changed, rebuilding the local index..')
+                self._db.execute('DELETE FROM messages WHERE mailbox = ?', (mailbox,))
+                self._db.execute('UPDATE mailboxes SET uidvalidity = ?, max_uid = 0, mbox_size = NULL WHERE name = ?',
+                                 (uidvalidity, mailbox))
+                self.rebuilt.add(mailbox)
+            return {uid for uid, in self._db.execute('SELECT uid FROM messages WHERE mailbox = ?', (mailbox,))}
+
+    def mailbox_info(self, mailbox):
+        """
+        Возвращает сохраненное состояние ящика.
+
+        Returns:
+            dict: uidvalidity, max_uid, uidnext, highestmodseq, exists и search_key
+                  или None, если ящик еще не скачивался
+        """
+        with self._lock:
+            row = self._db.execute('SELECT uidvalidity, max_uid, uidnext, highestmodseq, exists_count, search_key '
+                                   'FROM mailboxes WHERE name = ?', (mailbox,)).fetchone()
+        if row is None:
+            return None
+        keys = ('uidvalidity', 'max_uid', 'uidnext', 'highestmodseq', 'exists', 'search_key')
+        return dict(zip(keys, row))
+
+    def update_status(self, mailbox, status, search_key):
+        """
+        Запоминает UIDNEXT, HIGHESTMODSEQ и EXISTS ящика после успешного прохода.
+
+        Args:
+            mailbox (str): Каноническое имя ящика
+            status (dict): Результат mailbox_status или None, чтобы сбросить состояние
+            search_key (str): Вид поиска, которым был получен список писем
+        """
+        status = status or {}
+        with self._lock, self._db:
+            self._db.execute('UPDATE mailboxes SET uidnext = ?, highestmodseq = ?, exists_count = ?, search_key = ? '
+                             'WHERE name = ?', (status.get('UIDNEXT'), status.get('HIGHESTMODSEQ'),
+                                                status.get('EXISTS'), search_key, mailbox))
+
+    def _seed_from_folder(self, mailbox, mailbox_folder_path):
+        """Заполняет индекс по EML-файлам, скачанным до появления индекса."""
+        rows = []
+        with os.scandir(mailbox_folder_path) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+                if ext == '.eml' and name.isdigit() and entry.is_file():
+                    size = entry.stat().st_size
+                    if size > 0:
+                        rows.append((mailbox, int(name), size))
+        self._seed(mailbox, rows)
+
+    def _seed(self, mailbox, rows):
+        """Записывает в индекс письма (mailbox, uid, size), найденные локально."""
+        self._db.executemany('INSERT OR REPLACE INTO messages (mailbox, uid, size) VALUES (?, ?, ?)', rows)
+        if rows:
+            self._db.execute('UPDATE mailboxes SET max_uid = ? WHERE name = ?', (max(row[1] for row in rows), mailbox))
+
+    def add(self, mailbox, uid, size, partial=None, message_id=None, digest=None):
+        """Отмечает письмо как скачанное (фиксируется вызовом commit)."""
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO messages (mailbox, uid, size, partial, message_id, digest) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (mailbox, int(uid), size, partial, message_id, digest))
+            self._db.execute('UPDATE mailboxes SET max_uid = MAX(max_uid, ?) WHERE name = ?', (int(uid), mailbox))
+
+    def remove(self, mailbox, uids):
+        """Удаляет письма из индекса (фиксируется вызовом commit)."""
+        with self._lock:
+            self._db.executemany('DELETE FROM messages WHERE mailbox = ? AND uid = ?', [(mailbox, int(uid)) for uid in uids])
+            self._db.execute('UPDATE mailboxes SET max_uid = (SELECT COALESCE(MAX(uid), 0) FROM messages WHERE mailbox = ?) '
+                             'WHERE name = ?', (mailbox, mailbox))
+
+    def mbox_exported(self, mailbox):
+        """
+        Возвращает письма, уже записанные в Mbox-файл ящика.
+
+        Returns:
+            tuple: (uids, size) - множество UID (int) и размер Mbox-файла после записи
+        """
+        with self._lock:
+            row = self._db.execute('SELECT mbox_size FROM mailboxes WHERE name = ?', (mailbox,)).fetchone()
+            uids = {uid for uid, in self._db.execute('SELECT uid FROM mbox_exported WHERE mailbox = ?', (mailbox,))}
+        return uids, row[0] if row else None
+
+    def add_mbox_exported(self, mailbox, uids, reset, size):
+        """
+        Отмечает письма как записанные в Mbox-файл.
+
+        Args:
+            mailbox (str): Каноническое имя ящика
+            uids (list): UID добавленных писем
+            reset (bool): Файл был пересоздан, прежние отметки недействительны
+            size (int): Размер Mbox-файла после записи
+        """
+        with self._lock, self._db:
+            if reset:
+                self._db.execute('DELETE FROM mbox_exported WHERE mailbox = ?', (mailbox,))
+            self._db.executemany('INSERT OR IGNORE INTO mbox_exported (mailbox, uid) VALUES (?, ?)',
+                                 [(mailbox, int(uid)) for uid in uids])
+            self._db.execute('UPDATE mailboxes SET mbox_size = ? WHERE name = ?', (size, mailbox))
+
+    def incomplete_uids(self, mailbox, fetch_mode):
+        """
+        Возвращает UID писем, скачанных в более бедном режиме, чем fetch_mode.
+
+        Такие письма нужно скачать заново: например, после --fetch-mode text
+        запуск в режиме full докачивает письма целиком.
+        """
+        if fetch_mode == 'full':
+            condition = 'partial IS NOT NULL'
+        elif fetch_mode == 'text':
+            condition = "partial = 'headers'"
+        else:
+            return set()
+        with self._lock:
+            return {uid for uid, in self._db.execute(f'SELECT uid FROM messages WHERE mailbox = ? AND {condition}', (mailbox,))}
+
+    def sizes(self, mailbox):
+        """Возвращает {UID: размер} полностью скачанных писем ящика."""
+        with self._lock:
+            return dict(self._db.execute('SELECT uid, size FROM messages WHERE mailbox = ? AND partial IS NULL', (mailbox,)))
+
+    def find_copy(self, message_id=None, size=None, digest=None):
+        """
+        Ищет полностью скачанную копию письма в любом ящике.
+
+        Копия ищется по SHA-256 содержимого, а без него - по Message-ID
+        вместе с размером: у разных писем с одинаковым Message-ID (например,
+        отправленного и вернувшегося через рассылку) размеры обычно разные.
+
+        Returns:
+            tuple: (ящик, UID, SHA-256) копии или None
+        """
+        with self._lock:
+            if digest is not None:
+                return self._db.execute('SELECT mailbox, uid, digest FROM messages WHERE digest = ? AND partial IS NULL '
+                                        'LIMIT 1', (digest,)).fetchone()
+            return self._db.execute('SELECT mailbox, uid, digest FROM messages WHERE message_id = ? AND size = ? '
+                                    'AND partial IS NULL AND digest IS NOT NULL LIMIT 1', (message_id, size)).fetchone()
+
+    def digests(self, mailbox):
+        """Возвращает {UID: SHA-256} полностью скачанных писем ящика."""
+        with self._lock:
+            return dict(self._db.execute('SELECT uid, digest FROM messages WHERE mailbox = ? AND partial IS NULL '
+                                         'AND digest IS NOT NULL', (mailbox,)))
+
+    def uids(self, mailbox):
+        """Возвращает множество UID (int) писем ящика, записанных в индекс."""
+        with self._lock:
+            return {uid for uid, in self._db.execute('SELECT uid FROM messages WHERE mailbox = ?', (mailbox,))}
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+# Папка упакованного хранилища писем в папке аккаунта
+PACK_FOLDER = '.pack'
+
+# Размер сегмента, после которого запись начинается в новый файл
+PACK_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# Способы сжатия писем: (сжатие, распаковка)
+PACK_CODECS = {
+    'none': (bytes, bytes),
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+# Потоковое сжатие больших писем: объект с методами compress и flush (None - без сжатия)
+PACK_STREAM_CODECS = {
+    'none': lambda: None,
+    'zlib': lambda: zlib.compressobj(6),
+}
+if zstandard is not None:
+    # decompressobj распаковывает и записи потокового сжатия, в заголовке которых нет размера
+    PACK_CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                           lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data))
+    PACK_STREAM_CODECS['zstd'] = lambda: zstandard.ZstdCompressor(level=3).compressobj()
+
+DEFAULT_PACK_CODEC = 'zstd' if 'zstd' in PACK_CODECS else 'zlib'
+
+
+class PackStore:
+    """
+    Упакованное хранилище писем вместо отдельного EML-файла на каждый UID.
+
+    Письма сжимаются по одному и дописываются в конец файлов-сегментов
+    (segment-00001.pack, ...), а индекс в SQLite хранит для пары
+    (ящик, UID) сегмент, смещение и длину записи. Чтение идет через mmap
+    сегмента, поэтому отдельное письмо достается без чтения остальных.
+    Удаленные письма только убираются из индекса, место в сегментах
+    не освобождается. Поэтому копия письма из другого ящика хранится
+    как еще одна запись индекса, указывающая на те же байты (см. link).
+
+    Объект можно передать в другой процесс: там индекс открывается
+    только для чтения, без создания таблиц (см. read_only).
+    """
+
+    def __init__(self, account_folder, codec=DEFAULT_PACK_CODEC):
+        if codec not in PACK_CODECS:
+            raise ValueError(f'Unknown compression: {codec} (available: {", ".join(sorted(PACK_CODECS))})')
+        self.root = os.path.join(account_folder, PACK_FOLDER)
+        self.codec = codec
+        self._open()
+
+    def _open(self, read_only=False):
+        self.read_only = read_only
+        index_path = os.path.join(self.root, 'index.sqlite')
+        if read_only:
+            self._db = sqlite3.connect(pathlib.Path(os.path.abspath(index_path)).as_uri() + '?mode=ro', uri=True,
+                                       check_same_thread=False)
+        else:
+            os.makedirs(self.root, exist_ok=True)
+            self._db = sqlite3.connect(index_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._segment = None
+        # Перенесенные EML-файлы с жесткими ссылками: (устройство, inode, размер, mtime) -> (ящик, UID).
+        # Размер и время изменения защищают от inode, занятого новым файлом после удаления перенесенного
+        self._imported = {}
+        if read_only:
+            return
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                             'mailbox TEXT NOT NULL, uid INTEGER NOT NULL, segment INTEGER NOT NULL, '
+                             'offset INTEGER NOT NULL, length INTEGER NOT NULL, size INTEGER NOT NULL, codec TEXT NOT NULL, '
+                             'PRIMARY KEY (mailbox, uid)) WITHOUT ROWID')
+
+    def __getstate__(self):
+        return {'root': self.root, 'codec': self.codec}
+
+    def __setstate__(self, data):
+        self.root = data['root']
+        self.codec = data['codec']
+        self._open(read_only=True)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.root, f'segment-{segment:05d}.pack')
+
+    def _writer(self):
+        """Возвращает (номер, файл) сегмента для дозаписи, начиная новый по достижении PACK_SEGMENT_SIZE."""
+        if self._segment is None:
+            row = self._db.execute('SELECT MAX(segment) FROM messages').fetchone()
+            segment = row[0] or 1
+            self._segment = (segment, open(self._segment_path(segment), 'ab'))
+        segment, f = self._segment
+        if f.tell() >= PACK_SEGMENT_SIZE:
+            f.close()
+            segment += 1
+            self._segment = (segment, open(self._segment_path(segment), 'ab'))
+        return self._segment
+
+    def put(self, mailbox, uid, content):
+        """Сжимает и дописывает письмо в хранилище (фиксируется вызовом commit)."""
+        data = PACK_CODECS[self.codec][0](content)
+        with self._lock:
+            segment, f = self._writer()
+            offset = f.tell()
+            f.write(data)
+            self._db.execute('INSERT OR REPLACE INTO messages (mailbox, uid, segment, offset, length, size, codec) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (mailbox, int(uid), segment, offset, len(data), len(content), self.codec))
+
+    def put_file(self, mailbox, uid, path):
+        """Сжимает и дописывает в хранилище письмо из файла частями, не читая его в память целиком (фиксируется вызовом commit)."""
+        with self._lock, open(path, 'rb') as source:
+            segment, f = self._writer()
+            offset = f.tell()
+            compressor = PACK_STREAM_CODECS[self.codec]()
+            size = 0
+            for chunk in iter(lambda: source.read(STREAM_CHUNK_SIZE), b''):
+                size += len(chunk)
+                f.write(chunk if compressor is None else compressor.compress(chunk))
+            if compressor is not None:
+                f.write(compressor.flush())
+            self._db.execute('INSERT OR REPLACE INTO messages (mailbox, uid, segment, offset, length, size, codec) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (mailbox, int(uid), segment, offset, f.tell() - offset, size, self.codec))
+
+    def link(self, mailbox, uid, source_mailbox, source_uid):
+        """
+        Записывает письмо как ссылку на уже сохраненную копию (фиксируется вызовом commit).
+
+        Returns:
+            bool: Ссылка создана (False - копии нет в хранилище)
+        """
+        with self._lock:
+            cursor = self._db.execute('INSERT OR REPLACE INTO messages (mailbox, uid, segment, offset, length, size, codec) '
+                                      'SELECT ?, ?, segment, offset, length, size, codec FROM messages '
+                                      'WHERE mailbox = ? AND uid = ?', (mailbox, int(uid), source_mailbox, int(source_uid)))
+            return cursor.rowcount > 0
+
+    def _map(self, segment, end):
+        """Возвращает mmap сегмента, переоткрывая его, если сегмент с тех пор вырос."""
+        mapped = self._maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            if mapped is not None:
+                mapped.close()
+            if self._segment is not None and self._segment[0] == segment:
+                self._segment[1].flush()
+            with open(self._segment_path(segment), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = mapped
+        return mapped
+
+    def get(self, mailbox, uid):
+        """
+        Читает письмо из хранилища.
+
+        Raises:
+            KeyError: Письма нет в хранилище
+        """
+        with self._lock:
+            row = self._db.execute('SELECT segment, offset, length, codec FROM messages WHERE mailbox = ? AND uid = ?',
+                                   (mailbox, int(uid))).fetchone()
+            if row is None:
+                raise KeyError(f'{mailbox}/{uid}')
+            segment, offset, length, codec = row
+            data = self._map(segment, offset + length)[offset:offset + length]
+        return PACK_CODECS[codec][1](data)
+
+    def remove(self, mailbox, uids):
+        """Удаляет письма из индекса хранилища (фиксируется вызовом commit)."""
+        with self._lock:
+            self._db.executemany('DELETE FROM messages WHERE mailbox = ? AND uid = ?', [(mailbox, int(uid)) for uid in uids])
+
+    def uids(self, mailbox):
+        """Возвращает множество UID (int) писем ящика в хранилище."""
+        with self._lock:
+            return {uid for uid, in self._db.execute('SELECT uid FROM messages WHERE mailbox = ?', (mailbox,))}
+
+    def sizes(self, mailbox):
+        """Возвращает список пар (UID, размер несжатого письма) ящика."""
+        with self._lock:
+            return self._db.execute('SELECT uid, size FROM messages WHERE mailbox = ?', (mailbox,)).fetchall()
+
+    def mailboxes(self):
+        """Возвращает канонические имена ящиков, письма которых есть в хранилище."""
+        with self._lock:
+            return [name for name, in self._db.execute('SELECT DISTINCT mailbox FROM messages ORDER BY mailbox')]
+
+    def import_folder(self, mailbox, mailbox_folder_path):
+        """
+        Переносит в хранилище EML-файлы, скачанные раньше в папку ящика.
+
+        Файлы удаляются только после того, как их записи зафиксированы.
+        Жесткие ссылки на один файл (копии письма из --dedup) переносятся
+        ссылками на одну запись.
+
+        Returns:
+            int: Количество перенесенных писем
+        """
+        moved = []
+        with os.scandir(mailbox_folder_path) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+                if ext == '.eml' and name.isdigit() and entry.is_file():
+                    stat = entry.stat()
+                    inode = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                    source = self._imported.get(inode)
+                    if source is None or not self.link(mailbox, name, *source):
+                        self.put_file(mailbox, name, entry.path)
+                        if stat.st_nlink > 1:
+                            self._imported[inode] = (mailbox, name)
+                    moved.append(entry.path)
+        if moved:
+            self.commit()
+            for path in moved:
+                os.remove(path)
+        return len(moved)
+
+    def commit(self):
+        with self._lock:
+            if self._segment is not None:
+                self._segment[1].flush()
+                os.fsync(self._segment[1].fileno())
+            self._db.commit()
+
+    def close(self):
+        if not self.read_only:
+            self.commit()
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+            if self._segment is not None:
+                self._segment[1].close()
+                self._segment = None
+            self._db.close()
+
+
+def verify_mailbox(connection, state, mailbox_name_canonical, mailbox_folder_path, store=None):
+    """
+    Сверяет скачанные письма с RFC822.SIZE на сервере и с локальными файлами.
+
+    Письма, размер которых не совпадает с сервером, и письма, файл
+    которых пропал или отличается по размеру от индекса, удаляются из
+    индекса синхронизации, чтобы их скачали заново.
+
+    Args:
+        connection (imaplib.IMAP4): Соединение с выбранным ящиком
+        state (SyncState): Индекс синхронизации
+        mailbox_name_canonical (str): Каноническое имя ящика
+        mailbox_folder_path (str): Локальная папка ящика
+        store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+
+    Returns:
+        set: UID (int) писем, которые нужно скачать заново
+    """
+    local_sizes = state.sizes(mailbox_name_canonical)
+    if not local_sizes:
+        return set()
+    typ, data = connection.uid('FETCH', '1:*', '(UID RFC822.SIZE)')
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f'FETCH failed: {data}')
+    server_sizes = {int(message['UID']): int(message['RFC822.SIZE'])
+                    for message in parse_fetch_response(data) if 'UID' in message and 'RFC822.SIZE' in message}
+    stored_sizes = dict(store.sizes(mailbox_name_canonical)) if store is not None else None
+
+    broken = set()
+    for email_uid, size in local_sizes.items():
+        if server_sizes.get(email_uid, size) != size:
+            broken.add(email_uid)
+        elif stored_sizes is not None:
+            if stored_sizes.get(email_uid) != size:
+                broken.add(email_uid)
+        else:
+            try:
+                if os.path.getsize(os.path.join(mailbox_folder_path, f'{email_uid}.eml')) != size:
+                    broken.add(email_uid)
+            except OSError:
+                broken.add(email_uid)
+    if broken:
+        state.remove(mailbox_name_canonical, broken)
+        state.commit()
+    return broken
+
+
+def search_criteria(args):
+    """
+    Возвращает критерий UID SEARCH по параметрам командной строки.
+
+    Returns:
+        tuple: (search_key, criteria) - вид поиска и строка критерия (None для всех писем)
+    """
+    if args.unseen:
+        # Скачиваем только непрочитанные письма
+        return 'UNSEEN', 'UNSEEN'
+    if args.max_age > 0:
+        # Фильтр по дате: непрочитанные письма старше указанного возраста
+        cutoff_date = (datetime.today() - timedelta(days=args.max_age)).strftime('%d-%b-%Y')
+        return 'SINCE', f'(SINCE {cutoff_date})'
+    # Все письма
+    return 'ALL', None
+
+
+def search_uids(connection, criteria):
+    """Выполняет UID SEARCH и возвращает список UID (bytes)."""
+    with metrics.timer('search'):
+        typ, data = connection.uid('SEARCH', None, criteria)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f'SEARCH failed: {data}')
+    return data[0].split() if data and data[0] else []
+
+
+def search_mailbox(connection, status, previous, known_uids, args, refetch=frozenset()):
+    """
+    Ищет письма выбранного ящика, при --incremental - только изменения.
+
+    В инкрементальном режиме неизменившийся ящик (тот же UIDNEXT, EXISTS,
+    а для --unseen и HIGHESTMODSEQ) не требует ни одной команды SEARCH.
+    Иначе запрашиваются только UID больше последнего скачанного, а
+    удаленные на сервере письма вычисляются сравнением EXISTS с индексом:
+    полный список UID нужен лишь тогда, когда счетчики не сходятся.
+
+    Args:
+        connection (imaplib.IMAP4): Соединение с выбранным ящиком
+        status (dict): Результат mailbox_status
+        previous (dict): Результат SyncState.mailbox_info до открытия ящика
+        known_uids (set): UID (int) уже скачанных писем
+        args (argparse.Namespace): Параметры командной строки
+        refetch (set): UID (int) писем, которые нужно скачать заново, даже
+            если ящик не изменился (не входят в known_uids)
+
+    Returns:
+        tuple: (email_uids, server_uids) - UID для обработки (bytes) и множество
+               UID (int) на сервере или None, если оно неизвестно
+    """
+    search_key, criteria = search_criteria(args)
+
+    incremental = (args.incremental and previous is not None and previous['uidnext'] is not None
+                   and previous['search_key'] == search_key
+                   and previous['uidvalidity'] == (status['UIDVALIDITY'] or 0))
+    if not incremental:
+        email_uids = search_uids(connection, criteria or 'ALL')
+        return email_uids, {int(email_uid) for email_uid in email_uids}
+
+    modseq_known = previous['highestmodseq'] is not None and status['HIGHESTMODSEQ'] is not None
+    unchanged = status['UIDNEXT'] == previous['uidnext'] and status['EXISTS'] == previous['exists']
+    if args.unseen:
+        # После смены флагов старые письма снова могут стать непрочитанными
+        unchanged = unchanged and modseq_known and status['HIGHESTMODSEQ'] == previous['highestmodseq']
+    again = [str(email_uid).encode() for email_uid in sorted(refetch)]
+    if unchanged:
+        return again, known_uids | set(refetch)
+
+    delta = f'UID {previous["max_uid"] + 1}:*'
+    if args.unseen and modseq_known:
+        delta = f'(OR UID {previous["max_uid"] + 1}:* MODSEQ {previous["highestmodseq"] + 1})'
+    new_uids = [email_uid for email_uid in search_uids(connection, f'{criteria} {delta}' if criteria else delta)
+                if int(email_uid) not in known_uids and int(email_uid) not in refetch]
+
+    if criteria is None:
+        if status['EXISTS'] == len(known_uids) + len(refetch) + len(new_uids):
+            # Ничего не удалено, и локально не хватает только новых писем
+            return again + new_uids, known_uids | set(refetch) | {int(email_uid) for email_uid in new_uids}
+        email_uids = search_uids(connection, 'ALL')
+        return email_uids, {int(email_uid) for email_uid in email_uids}
+
+    # Результат поиска с фильтрами нельзя сверить с EXISTS
+    if args.sync:
+        email_uids = search_uids(connection, criteria)
+        return email_uids, {int(email_uid) for email_uid in email_uids}
+    return again + new_uids, None
+
+
+# Файл полнотекстового индекса в папке аккаунта
+SEARCH_INDEX_FILE = '.search_index.sqlite'
+
+
+def html_to_text(html_content):
+    """Грубо превращает HTML в текст для индексации: убирает теги и раскрывает сущности."""
+    text = re.sub(r'(?is)<(script|style)\b.*?</\1>', ' ', html_content)
+    text = re.sub(r'<[^>]+>', ' ', text)
+    return re.sub(r'\s+', ' ', unescape(text)).strip()
+
+
+class SearchIndex:
+    """
+    Полнотекстовый индекс скачанных писем (SQLite FTS5 в папке аккаунта).
+
+    Таблица messages сопоставляет паре (ящик, UID) номер строки индекса,
+    поэтому повторная обработка письма заменяет его запись, а не
+    дублирует ее.
+    """
+
+    def __init__(self, account_folder):
+        self.path = os.path.join(account_folder, SEARCH_INDEX_FILE)
+        # В режиме зеркалирования письма индексируются из рабочего потока (по одному ящику за раз)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                             'id INTEGER PRIMARY KEY, mailbox TEXT NOT NULL, uid INTEGER NOT NULL, path TEXT NOT NULL, '
+                             'subject TEXT, sender TEXT, date TEXT, UNIQUE (mailbox, uid))')
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                             "subject, sender, body, tokenize = 'unicode61 remove_diacritics 2')")
+
+    def add(self, mailbox, uid, path, result):
+        """
+        Добавляет или обновляет письмо в индексе (фиксируется вызовом commit).
+
+        Args:
+            mailbox (str): Каноническое имя ящика
+            uid (int): UID письма
+            path (str): Путь к EML-файлу ('' - письмо в упакованном хранилище, см. index_path)
+            result (dict): Результат process_eml_file
+        """
+        subject = str(result.get('subject') or '')
+        sender = str(result.get('from') or '')
+        date = str(result.get('date') or '')
+        body = result.get('text_body') or html_to_text(result.get('html_body') or '')
+        self._write(mailbox, uid, path, subject, sender, date, body)
+
+    def link(self, mailbox, uid, path, source_mailbox, source_uid):
+        """
+        Добавляет письмо как копию уже проиндексированного письма другого ящика.
+
+        Returns:
+            bool: Письмо добавлено (False - копии нет в индексе)
+        """
+        row = self._db.execute('SELECT m.subject, m.sender, m.date, f.body FROM messages m '
+                               'JOIN messages_fts f ON f.rowid = m.id WHERE m.mailbox = ? AND m.uid = ?',
+                               (source_mailbox, int(source_uid))).fetchone()
+        if row is None:
+            return False
+        self._write(mailbox, uid, path, *row)
+        return True
+
+    def _write(self, mailbox, uid, path, subject, sender, date, body):
+        row = self._db.execute('SELECT id FROM messages WHERE mailbox = ? AND uid = ?', (mailbox, int(uid))).fetchone()
+        if row is None:
+            cursor = self._db.execute('INSERT INTO messages (mailbox, uid, path, subject, sender, date) VALUES (?, ?, ?, ?, ?, ?)',
+                                      (mailbox, int(uid), path, subject, sender, date))
+            row_id = cursor.lastrowid
+        else:
+            row_id = row[0]
+            self._db.execute('UPDATE messages SET path = ?, subject = ?, sender = ?, date = ? WHERE id = ?',
+                             (path, subject, sender, date, row_id))
+            self._db.execute('DELETE FROM messages_fts WHERE rowid = ?', (row_id,))
+        self._db.execute('INSERT INTO messages_fts (rowid, subject, sender, body) VALUES (?, ?, ?, ?)',
+                         (row_id, subject, sender, body))
+
+    def remove(self, mailbox, uids):
+        """Удаляет письма ящика из индекса (фиксируется вызовом commit)."""
+        for uid in uids:
+            row = self._db.execute('SELECT id FROM messages WHERE mailbox = ? AND uid = ?', (mailbox, int(uid))).fetchone()
+            if row is not None:
+                self._db.execute('DELETE FROM messages_fts WHERE rowid = ?', (row[0],))
+                self._db.execute('DELETE FROM messages WHERE id = ?', (row[0],))
+
+    def search(self, query, limit=50):
+        """
+        Ищет письма по запросу FTS5 (например: "счет AND оплата", "subject:отчет").
+
+        Если запрос не разбирается как выражение FTS5, его слова ищутся как есть.
+
+        Returns:
+            list: Кортежи (mailbox, uid, path, date, subject), самые релевантные первыми
+        """
+        sql = ('SELECT m.mailbox, m.uid, m.path, m.date, m.subject FROM messages_fts '
+               'JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ? ORDER BY rank LIMIT ?')
+        try:
+            return self._db.execute(sql, (query, limit)).fetchall()
+        except sqlite3.OperationalError:
+            quoted = ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+            return self._db.execute(sql, (quoted, limit)).fetchall()
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+def index_path(mailbox_folder_path, file_name, store=None):
+    """
+    Возвращает путь письма для полнотекстового индекса.
+
+    Письма упакованного хранилища не имеют своего файла: для них
+    сохраняется пустой путь, а найти их можно по ящику и UID (см. export).
+    """
+    return '' if store is not None else os.path.join(mailbox_folder_path, file_name)
+
+
+def search_command(argv):
+    """
+    Подкоманда search: поиск по полнотекстовому индексу скачанных писем.
+
+        python3 yandex_mail_downloader.py search <username> <query> [--limit N]
+    """
+    parser = argparse.ArgumentParser(prog='yandex_mail_downloader.py search',
+                                     description='Search downloaded emails with the full-text index')
+    parser.add_argument('username', type=str, help='Yandex email account username (local account folder)')
+    parser.add_argument('query', type=str, nargs='+', help='Search query (SQLite FTS5 syntax)')
+    parser.add_argument('-n', '--limit', type=int, default=50, help='Maximum number of results')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(os.path.join(args.username, SEARCH_INDEX_FILE)):
+        print(f'Error: No search index in {args.username}, run the download with --index first')
+        return
+
+    index = SearchIndex(args.username)
+    started = time.perf_counter()
+    results = index.search(' '.join(args.query), args.limit)
+    elapsed = (time.perf_counter() - started) * 1000
+    packed = set()
+    for mailbox, uid, path, date, subject in results:
+        if not path:
+            packed.add(mailbox)
+        print(f'{mailbox}\t{uid}\t{path or "-"}\t{date}\t{subject}')
+    print(f'Found: {len(results)} ({elapsed:.1f} ms)')
+    if packed:
+        mailboxes = ' '.join(f'"{mailbox}"' if ' ' in mailbox else mailbox for mailbox in sorted(packed))
+        print(f'Emails without a path are kept in the pack store, unpack them with: '
+              f'python3 yandex_mail_downloader.py export {args.username} {mailboxes}')
+    index.close()
+
+
+def export_command(argv):
+    """
+    Подкоманда export: выгружает письма из упакованного хранилища обратно в EML-файлы.
+
+        python3 yandex_mail_downloader.py export <username> [mailbox ...] [--output DIR]
+    """
+    parser = argparse.ArgumentParser(prog='yandex_mail_downloader.py export',
+                                     description='Export emails from the packed store to EML files')
+    parser.add_argument('username', type=str, help='Yandex email account username (local account folder)')
+    parser.add_argument('mailboxes', type=str, nargs='*', help='Mailboxes to export (default: all)')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Folder for the mailbox folders (default: the account folder)')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(os.path.join(args.username, PACK_FOLDER)):
+        print(f'Error: No packed store in {args.username}, download with --store pack first')
+        return
+
+    store = PackStore(args.username)
+    for mailbox_name_canonical in store.mailboxes():
+        if args.mailboxes and mailbox_name_canonical not in args.mailboxes:
+            continue
+        mailbox_folder_path = os.path.join(args.output or args.username, *mailbox_name_canonical.split('/'))
+        os.makedirs(mailbox_folder_path, exist_ok=True)
+        exported = 0
+        for email_uid in sorted(store.uids(mailbox_name_canonical)):
+            with open(os.path.join(mailbox_folder_path, f'{email_uid}.eml'), 'wb') as f:
+                f.write(store.get(mailbox_name_canonical, email_uid))
+            exported += 1
+        print(f'Mailbox {mailbox_name_canonical}: exported {exported} emails to {mailbox_folder_path}')
+    store.close()
+
+
+def _checkpoint_download(state, store):
+    """Фиксирует скачанные письма: сначала хранилище, затем индекс, который на него ссылается."""
+    if store is not None:
+        store.commit()
+    if state is not None:
+        state.commit()
+
+
+def link_message(state, store, mailbox_name_canonical, mailbox_folder_path, email_uid, source):
+    """
+    Сохраняет письмо ссылкой на его копию в другом ящике вместо отдельной копии.
+
+    EML-файл становится жесткой ссылкой на файл копии, в упакованном
+    хранилище добавляется запись, указывающая на те же байты.
+
+    Args:
+        state (SyncState): Индекс синхронизации (по нему находится папка аккаунта)
+        store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+        mailbox_name_canonical (str): Каноническое имя ящика
+        mailbox_folder_path (str): Локальная папка ящика
+        email_uid (str): UID письма
+        source (tuple): (ящик, UID) копии
+
+    Returns:
+        bool: Ссылка создана (False - копии нет локально, письмо нужно скачать)
+    """
+    source_mailbox, source_uid = source[:2]
+    if store is not None:
+        return store.link(mailbox_name_canonical, email_uid, source_mailbox, source_uid)
+    source_path = os.path.join(os.path.dirname(state.path), *source_mailbox.split('/'), f'{source_uid}.eml')
+    try:
+        link_file(source_path, os.path.join(mailbox_folder_path, f'{email_uid}.eml'))
+    except OSError:
+        return False
+    return True
+
+
+def link_duplicates(connection, mailbox_folder_path, mailbox_name_canonical, email_uids, batch_size=FETCH_BATCH_SIZE,
+                    state=None, store=None):
+    """
+    Находит письма, копии которых уже скачаны в других ящиках, и сохраняет их ссылками.
+
+    Перед загрузкой запрашиваются только Message-ID и размер писем
+    (BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)] RFC822.SIZE). Письма без
+    Message-ID и письма, для которых копия не нашлась, остаются для
+    обычной загрузки; их копии ищутся после загрузки по SHA-256
+    (см. download_emails).
+
+    Args:
+        connection (imaplib.IMAP4): Соединение с выбранным почтовым ящиком
+        mailbox_folder_path (str): Локальная папка ящика
+        mailbox_name_canonical (str): Каноническое имя ящика
+        email_uids (list): Список UID (str)
+        batch_size (int): Количество UID в одной команде FETCH
+        state (SyncState): Индекс синхронизации
+        store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+
+    Returns:
+        tuple: (linked, email_uids) - количество сохраненных ссылками писем и UID, которые нужно скачать
+    """
+    linked = set()
+    batch_size = max(1, batch_size)
+    for start in range(0, len(email_uids), batch_size):
+        chunk = email_uids[start:start + batch_size]
+        try:
+            with metrics.timer('dedup'):
+                typ, data = connection.uid('FETCH', uid_set(chunk), _MESSAGE_ID_ITEMS)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f'FETCH failed: {data}')
+        except imaplib.IMAP4.abort:
+            raise
+        except Exception as e:
+            # Без заголовков письма пачки просто скачиваются целиком
+            log(f'Warning: Failed to fetch Message-IDs from mailbox {mailbox_name_canonical}: {e}')
+            continue
+
+        for message in parse_fetch_response(data):
+            email_uid = message.get('UID', b'').decode()
+            header = next((value for key, value in message.items() if key.startswith('BODY[HEADER')), None)
+            size = message.get('RFC822.SIZE')
+            if header is None or size is None or email_uid in linked:
+                continue
+            header_message_id = message_id(header)
+            if header_message_id is None:
+                continue
+            source = state.find_copy(header_message_id, int(size))
+            if source is not None and link_message(state, store, mailbox_name_canonical, mailbox_folder_path, email_uid, source):
+                state.add(mailbox_name_canonical, email_uid, int(size), message_id=header_message_id, digest=source[2])
+                log(f'  UID {email_uid} is a copy of {source[0]}/{source[1]}, linked', VERBOSE)
+                linked.add(email_uid)
+        _checkpoint_download(state, store)
+
+    return len(linked), [email_uid for email_uid in email_uids if email_uid not in linked]
+
+
+def download_emails(connection, mailbox_folder_path, mailbox_name_canonical, email_uids, batch_size=FETCH_BATCH_SIZE, state=None,
+                    fetch_mode='full', store=None, dedup=False, stream_size=STREAM_MESSAGE_SIZE_MB * 1024 * 1024, progress=None):
+    """
+    Скачивает письма с указанными UID из выбранного ящика в EML-файлы или упакованное хранилище.
+
+    В режиме full сначала запрашиваются размеры писем: письма больше
+    stream_size скачиваются частями прямо в файл (см. stream_message),
+    остальные - пачками не больше FETCH_BATCH_BYTES байт, так что память
+    на соединение не зависит от размера писем.
+
+    Args:
+        connection (imaplib.IMAP4): Соединение с выбранным почтовым ящиком
+        mailbox_folder_path (str): Локальная папка ящика
+        mailbox_name_canonical (str): Имя ящика для сообщений об ошибках
+        email_uids (list): Список UID (str)
+        batch_size (int): Количество UID в одной команде FETCH
+        state (SyncState): Индекс синхронизации, в который записываются скачанные письма
+        fetch_mode (str): Режим загрузки из FETCH_MODES
+        store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+        dedup (bool): Сохранять письмо ссылкой, если такое же уже скачано в другой ящик
+        stream_size (int): Размер письма в байтах, с которого оно скачивается частями (0 - всегда целиком)
+        progress (dict): UID -> письмо сохранено (True) или не скачано (False), заполняется по ходу загрузки.
+            UID, которые уже есть в словаре, не запрашиваются: так после обрыва соединения
+            повторный вызов продолжает загрузку с того же места
+
+    Returns:
+        tuple: (saved, failed) - количество сохраненных и не скачанных писем
+    """
+    saved = 0
+    failed = 0
+    batch_size = max(1, batch_size)
+    if progress is not None:
+        email_uids = [email_uid for email_uid in email_uids if email_uid not in progress]
+
+    # По размерам большие письма скачиваются потоком, а каждая пачка укладывается в FETCH_BATCH_BYTES
+    sizes = {}
+    if fetch_mode == 'full' and stream_size > 0:
+        try:
+            sizes = fetch_sizes(connection, email_uids, batch_size)
+        except imaplib.IMAP4.abort:
+            raise
+        except Exception as e:
+            log(f'Warning: Failed to fetch email sizes from mailbox {mailbox_name_canonical}: {e}')
+    large = [email_uid for email_uid in email_uids if sizes.get(email_uid, 0) > stream_size]
+
+    def received():
+        # Большие письма приходят без содержимого: ниже они скачиваются в файл потоком
+        for email_uid in large:
+            yield email_uid, None, None
+        small = [email_uid for email_uid in email_uids if sizes.get(email_uid, 0) <= stream_size]
+        for batch in size_batches(small, sizes, batch_size):
+            yield from fetch_messages(connection, batch, len(batch), fetch_mode)
+
+    # Скачиваем недостающие письма пачками и сохраняем каждое сразу после получения
+    for email_uid, email_content, error in received():
+        email_file_path = os.path.join(mailbox_folder_path, f'{email_uid}.eml')
+        try:
+            if error is not None:
+                raise error
+
+            # Ключи для поиска копий письма в других ящиках
+            if email_content is None:
+                size = sizes[email_uid]
+                log(f'  UID {email_uid}: streaming {size / 1024 / 1024:.1f} MiB', VERBOSE)
+                digest, email_message_id = stream_message(connection, email_file_path, email_uid, size)
+            else:
+                size = len(email_content)
+                digest = hashlib.sha256(email_content).hexdigest() if fetch_mode == 'full' else None
+                email_message_id = message_id(email_content)
+            source = state.find_copy(digest=digest) if dedup and state is not None and digest is not None else None
+
+            # Сохраняем письмо в формате EML (или ссылку на сохраненную ранее копию)
+            with metrics.timer('write'):
+                if source is None or not link_message(state, store, mailbox_name_canonical, mailbox_folder_path, email_uid, source):
+                    if email_content is None:
+                        if store is not None:
+                            store.put_file(mailbox_name_canonical, email_uid, email_file_path)
+                    elif store is not None:
+                        store.put(mailbox_name_canonical, email_uid, email_content)
+                    else:
+                        atomic_write(email_file_path, email_content)
+                if email_content is None and store is not None:
+                    # Скачанный потоком файл нужен был только для упакованного хранилища
+                    os.remove(email_file_path)
+            saved += 1
+            metrics.add('download', size=size)
+            if state is not None:
+                state.add(mailbox_name_canonical, email_uid, size,
+                          partial=None if fetch_mode == 'full' else fetch_mode,
+                          message_id=email_message_id, digest=digest)
+            if progress is not None:
+                progress[email_uid] = True
+        except imaplib.IMAP4.abort:
+            # Соединение разорвано во время потоковой загрузки
+            raise
+        except Exception as e:
+            print(f'Error: Failed to download email with UID {email_uid} from mailbox {mailbox_name_canonical}')
+            print(str(e))
+            failed += 1
+            metrics.add('download', 0, failed=1)
+            if progress is not None:
+                progress[email_uid] = False
+        finally:
+            # Контрольная точка после каждой пачки FETCH, чтобы прерванный запуск не скачивал их снова
+            if (saved + failed) % batch_size == 0:
+                _checkpoint_download(state, store)
+
+    _checkpoint_download(state, store)
+
+    return saved, failed
+
+
+def finish_mailbox(mailbox_folder_path, mailbox_name_canonical, server_uids, status, counters, args, state, store=None):
+    """
+    Завершает обработку ящика: синхронизация, итоги и конвертация в Mbox.
+
+    Args:
+        mailbox_folder_path (str): Локальная папка ящика
+        mailbox_name_canonical (str): Каноническое имя ящика
+        server_uids (set): UID (int) писем на сервере или None, если они неизвестны
+        status (dict): Состояние ящика из mailbox_status
+        counters (dict): Счетчики saved/skipped/failed/total
+        args (argparse.Namespace): Параметры командной строки
+        state (SyncState): Индекс синхронизации
+        store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+
+    Returns:
+        int: Количество удаленных локально писем
+    """
+    removed = 0
+    if args.sync and server_uids is not None:
+        stale_uids = state.uids(mailbox_name_canonical) - server_uids
+        if store is not None:
+            # After a UIDVALIDITY change old emails are not in the sync index, so compare with the pack
+            stale_uids |= store.uids(mailbox_name_canonical) - server_uids
+            store.remove(mailbox_name_canonical, stale_uids)
+            store.commit()
+        else:
+            for email_uid in stale_uids:
+                email_file_path = os.path.join(mailbox_folder_path, f'{email_uid}.eml')
+                if os.path.exists(email_file_path):
+                    os.remove(email_file_path)
+        removed += len(stale_uids)
+        state.remove(mailbox_name_canonical, stale_uids)
+        state.commit()
+
+        # After a UIDVALIDITY change old files are not in the index, so scan the folder once
+        if store is None and mailbox_name_canonical in state.rebuilt:
+            for file in os.listdir(mailbox_folder_path):
+                email_uid, ext = os.path.splitext(file)
+                if ext == '.eml' and email_uid.isdigit() and int(email_uid) not in server_uids:
+                    os.remove(os.path.join(mailbox_folder_path, file))
+                    removed += 1
+
+    # Remember the server state for --incremental only if nothing is left behind
+    search_key, criteria = search_criteria(args)
+    state.update_status(mailbox_name_canonical, status if counters['failed'] == 0 else None, search_key)
+
+    metrics.clear_progress()
+    linked = f'\n  Linked: {counters["linked"]}' if counters.get('linked') else ''
+    print(f'  Saved: {counters["saved"]}{linked}\n  Skipped: {counters["skipped"]}\n  Failed: {counters["failed"]}\n  Removed: {removed}\n  Total: {counters["total"]}')
+
+    # Convert to MBOX format if specified
+    if args.mbox:
+        log('Creating Mbox file..')
+        exported = convert_to_mbox(mailbox_folder_path, state, mailbox_name_canonical, store)
+        metrics.clear_progress()
+        print(f'  Added to Mbox: {exported}\n')
+    else:
+        print('')
+    return removed
+
+
+def link_decoded(source, mailbox_name_canonical, mailbox_folder_path, output_dir, file_name, search_index=None, store=None):
+    """
+    Создает результаты обработки письма ссылками на результаты его копии из другого ящика.
+
+    Args:
+        source (tuple): (ящик, папка результатов, имя EML файла) обработанной копии
+        mailbox_name_canonical (str): Каноническое имя ящика письма
+        mailbox_folder_path (str): Локальная папка ящика письма
+        output_dir (str): Папка результатов ящика письма
+        file_name (str): Имя EML файла письма
+        search_index (SearchIndex): Полнотекстовый индекс (None - не индексировать)
+        store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+
+    Returns:
+        bool: Результаты созданы (False - письмо нужно обработать)
+    """
+    source_mailbox, source_dir, source_file = source
+    if search_index is not None and not search_index.link(mailbox_name_canonical, os.path.splitext(file_name)[0],
+                                                         index_path(mailbox_folder_path, file_name, store),
+                                                         source_mailbox, os.path.splitext(source_file)[0]):
+        return False
+    for suffix in ('.txt', '.html'):
+        source_path = os.path.join(source_dir, source_file + suffix)
+        if os.path.exists(source_path):
+            link_file(source_path, os.path.join(output_dir, file_name + suffix))
+
+    # Пути к вложениям в списке заданы относительно папки результатов
+    source_path = os.path.join(source_dir, source_file + '.attachments.json')
+    if os.path.exists(source_path):
+        with open(source_path, 'r', encoding='utf-8') as f:
+            attachments = json.load(f)
+        for entry in attachments:
+            if entry.get('blob'):
+                entry['blob'] = os.path.relpath(os.path.join(source_dir, entry['blob']), output_dir)
+        atomic_write(os.path.join(output_dir, file_name + '.attachments.json'),
+                     json.dumps(attachments, ensure_ascii=False, indent=2), encoding='utf-8')
+    return True
+
+
+def postprocess_mailbox(mailbox_name_canonical, mailbox_folder_path, args, store=None, attachment_store=None, search_index=None,
+                        state=None, decoded_copies=None, executor=None):
+    """
+    Обрабатывает скачанные письма ящика и объединяет их HTML в пачки.
+
+    Обрабатываются только новые и измененные письма: журнал обработки
+    хранит UID и отпечаток (размер и время изменения) каждого письма.
+    Результаты писем, которых больше нет в ящике, удаляются, а объединение
+    собирает заново только пачки, состав которых изменился.
+
+    С decoded_copies письма, копии которых уже обработаны в ящиках,
+    пройденных раньше, не обрабатываются: их результаты создаются
+    ссылками на результаты копии (копии находятся по SHA-256 в state).
+
+    Args:
+        mailbox_name_canonical (str): Каноническое имя ящика
+        mailbox_folder_path (str): Локальная папка ящика
+        args (argparse.Namespace): Параметры командной строки
+        store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+        attachment_store (AttachmentStore): Общее хранилище вложений
+        search_index (SearchIndex): Полнотекстовый индекс (None - не индексировать)
+        state (SyncState): Индекс синхронизации (нужен для decoded_copies)
+        decoded_copies (dict): SHA-256 -> (ящик, папка результатов, имя EML файла)
+            обработанных писем; пополняется письмами ящика (None - без поиска копий)
+        executor (ProcessPoolExecutor): Общий пул процессов обработки (см. decode_eml_files)
+    """
+    # Письма ящика по возрастанию UID
+    if store is not None:
+        email_uids = store.uids(mailbox_name_canonical)
+    else:
+        email_uids = set()
+        for file in os.listdir(mailbox_folder_path):
+            email_uid, ext = os.path.splitext(file)
+            if ext == '.eml' and email_uid.isdigit():
+                email_uids.add(int(email_uid))
+    eml_files = [f'{email_uid}.eml' for email_uid in sorted(email_uids)]
+
+    # Обработанные письма отмечаются в журнале, повторный запуск продолжает с места остановки
+    decode_output_dir = os.path.join('txt', mailbox_folder_path)
+    os.makedirs(decode_output_dir, exist_ok=True)
+    decode_journal = CheckpointJournal(os.path.join(decode_output_dir, DECODE_JOURNAL),
+                                       {'txt': args.txt, 'html': args.html, 'files': args.files, 'sanitizer': args.sanitizer,
+                                        'index': args.index, 'store': args.store})
+
+    # Результаты писем, удаленных из ящика
+    current = set(eml_files)
+    removed = {entry['file'] for entry in decode_journal.entries} - current
+    if removed:
+        for file_name in removed:
+            for output_name in (f'{file_name}.txt', f'{file_name}.html', f'{file_name}.attachments.json'):
+                output_path = os.path.join(decode_output_dir, output_name)
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+        if search_index is not None:
+            search_index.remove(mailbox_name_canonical, [os.path.splitext(file_name)[0] for file_name in removed])
+        decode_journal.rewrite(entry for entry in decode_journal.entries if entry['file'] in current)
+        log(f'Удалены результаты {len(removed)} писем, которых нет в ящике {mailbox_name_canonical}')
+
+    # Копии писем, уже обработанных в других ящиках, не обрабатываются заново
+    digests = state.digests(mailbox_name_canonical) if decoded_copies is not None else {}
+    linked = 0
+    if digests and decoded_copies:
+        done = {entry['file']: entry['key'] for entry in decode_journal.entries}
+        stored_sizes = dict(store.sizes(mailbox_name_canonical)) if store is not None else None
+        for file_name in eml_files:
+            source = decoded_copies.get(digests.get(int(os.path.splitext(file_name)[0])))
+            if source is None:
+                continue
+            key = _source_key(file_name, mailbox_folder_path, stored_sizes)
+            if key is None or done.get(file_name) == key:
+                continue
+            if link_decoded(source, mailbox_name_canonical, mailbox_folder_path, decode_output_dir, file_name, search_index,
+                            store):
+                decode_journal.append({'file': file_name, 'key': key})
+                linked += 1
+
+    # Чтение EML файлов в пуле процессов
+    decoded = 0
+    for filepath, result, error in decode_eml_files(eml_files, input_dir=mailbox_folder_path,
+                                                    output_dir=decode_output_dir,
+                                                    workers=args.decode_workers, journal=decode_journal, executor=executor,
+                                                    txt=args.txt, html=args.html, files=args.files,
+                                                    sanitizer=args.sanitizer, attachment_store=attachment_store,
+                                                    store=store, mailbox_name=mailbox_name_canonical):
+        if error is not None:
+            print(f"Ошибка при обработке {filepath}: {error}")
+            continue
+        decoded += 1
+        if search_index is not None:
+            search_index.add(mailbox_name_canonical, os.path.splitext(filepath)[0],
+                             index_path(mailbox_folder_path, filepath, store), result)
+    decode_journal.close()
+    if search_index is not None:
+        search_index.commit()
+    metrics.clear_progress()
+    log(f'Ящик {mailbox_name_canonical}: обработано {decoded} новых или измененных писем из {len(eml_files)}'
+        + (f', копий из других ящиков: {linked}' if linked else ''))
+
+    # Обработанные письма ящика становятся источником результатов для их копий
+    if decoded_copies is not None:
+        for entry in decode_journal.entries:
+            digest = digests.get(int(os.path.splitext(entry['file'])[0]))
+            if digest is not None:
+                decoded_copies.setdefault(digest, (mailbox_name_canonical, decode_output_dir, entry['file']))
+
+    # HTML писем объединяется в порядке UID
+    letters = [f'{file_name}.html' for file_name in eml_files
+               if os.path.exists(os.path.join(decode_output_dir, f'{file_name}.html'))]
+    if letters:
+        merge_html_files_with_separators(decode_output_dir, letters, decode_output_dir, batch=args.batch, unwrap=False)
+
+
+# Сколько секунд держать IDLE до переоткрытия (серверы рвут IDLE через 30 минут)
+IDLE_TIMEOUT = 25 * 60
+
+# Максимальная пауза между попытками переподключения в режиме зеркалирования
+MIRROR_MAX_BACKOFF = 300
+
+
+def _imap_quote(value):
+    """Записывает строку аргумента IMAP в кавычках."""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class AsyncIMAPClient:
+    """
+    Минимальный асинхронный IMAP-клиент для режима зеркалирования.
+
+    Ответы сервера складываются так же, как в imaplib (строки и кортежи
+    с литералами, response() забирает нетегированные ответы), поэтому
+    parse_fetch_response и mailbox_status работают с ним без изменений.
+    Ошибки сообщаются исключениями imaplib.IMAP4.error и imaplib.IMAP4.abort.
+    """
 
-                typ, data = connection.uid('FETCH', email_uid, '(RFC822)')
-                email_content = data[0][1]
+    def __init__(self, host=IMAP_SERVER, port=IMAP_PORT, use_ssl=True, timeout=120):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.capabilities = ()
+        self.reader = None
+        self.writer = None
+        self._tag = 0
+        self._untagged = {}
 
-                # Parse the email message
-                msg = email.message_from_bytes(email_content)
+    async def connect(self):
+        context = ssl.create_default_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context), self.timeout)
+        greeting = await self._read_line()
+        if not greeting.startswith((b'* OK', b'* PREAUTH')):
+            raise imaplib.IMAP4.abort(f'unexpected greeting: {greeting!r}')
+        await self.capability()
 
-                # Save the email message in EML format
-                encoding = msg.get_content_charset() or 'utf-8'
-                with open(email_file_path, 'wb') as f:
-                    f.write(email_content)
-                    saved += 1
+    async def capability(self):
+        """Запрашивает возможности сервера (после входа их список может измениться, например появиться IDLE)."""
+        await self.command('CAPABILITY')
+        self.capabilities = tuple(self.response('CAPABILITY')[1][-1].decode().upper().split())
+        return self.capabilities
+
+    async def _read_line(self):
+        try:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            raise imaplib.IMAP4.abort(str(e))
+        if not line:
+            raise imaplib.IMAP4.abort('connection closed by the server')
+        return line
+
+    async def _read_response(self):
+        """Читает один ответ сервера вместе с литералами в формате imaplib."""
+        items = []
+        line = await self._read_line()
+        while True:
+            match = re.search(rb'\{(\d+)\}\r?\n$', line)
+            if match is None:
+                items.append(line.rstrip(b'\r\n'))
+                return items
+            try:
+                literal = await asyncio.wait_for(self.reader.readexactly(int(match.group(1))), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                raise imaplib.IMAP4.abort(str(e))
+            items.append((line.rstrip(b'\r\n'), literal))
+            line = await self._read_line()
+
+    def _store_untagged(self, items):
+        """Раскладывает нетегированный ответ по типам, как imaplib.untagged_responses."""
+        first = items[0][0] if isinstance(items[0], tuple) else items[0]
+        numeric = re.match(rb'\* (\d+) ([A-Z-]+)(?: (.*))?$', first, re.S)
+        if numeric is not None:
+            # "* 20 EXISTS", "* 1 FETCH (...)": imaplib хранит номер вместе с остатком строки
+            key, data = numeric.group(2), numeric.group(1) + (b' ' + numeric.group(3) if numeric.group(3) else b'')
+        else:
+            named = re.match(rb'\* ([A-Z-]+)(?: (.*))?$', first, re.S)
+            if named is None:
+                return
+            key, data = named.group(1), named.group(2) or b''
+            code = re.match(rb'\[([A-Z-]+)(?: ([^\]]*))?\]', data)
+            if code is not None:
+                self._untagged.setdefault(code.group(1).decode(), []).append(code.group(2) or b'')
+        first_item = (data, items[0][1]) if isinstance(items[0], tuple) else data
+        self._untagged.setdefault(key.decode(), []).extend([first_item] + items[1:])
+
+    def response(self, key):
+        """Забирает нетегированные ответы указанного типа (как imaplib.IMAP4.response)."""
+        return key, self._untagged.pop(key, [None])
+
+    async def command(self, name, *args):
+        """
+        Выполняет команду и ждет тегированного ответа.
+
+        Returns:
+            tuple: ('OK', строка завершения)
+        """
+        self._tag += 1
+        tag = f'M{self._tag:04d}'.encode()
+        parts = [tag, name.encode()] + [arg if isinstance(arg, bytes) else str(arg).encode() for arg in args if arg is not None]
+        self.writer.write(b' '.join(parts) + b'\r\n')
+        await self.writer.drain()
+        while True:
+            items = await self._read_response()
+            first = items[0][0] if isinstance(items[0], tuple) else items[0]
+            if first.startswith(tag + b' '):
+                result = first.split(b' ', 2)
+                if result[1] != b'OK':
+                    raise imaplib.IMAP4.error(f'{name} failed: {first.decode(errors="replace")}')
+                return 'OK', first
+            if first.startswith(b'* BYE'):
+                raise imaplib.IMAP4.abort(first.decode(errors='replace'))
+            if first.startswith(b'*'):
+                self._store_untagged(items)
+
+    async def login(self, username, password):
+        result = await self.command('LOGIN', _imap_quote(username), _imap_quote(password))
+        await self.capability()
+        return result
+
+    async def select(self, mailbox_name, readonly=True):
+        return await self.command('EXAMINE' if readonly else 'SELECT', imap_mailbox_name(mailbox_name))
+
+    async def uid(self, command, *args):
+        await self.command('UID', command, *args)
+        return 'OK', self._untagged.pop(command.upper(), [None])
+
+    async def noop(self):
+        return await self.command('NOOP')
+
+    async def idle(self, timeout=IDLE_TIMEOUT):
+        """
+        Ждет изменений в выбранном ящике командой IDLE.
+
+        Returns:
+            bool: True, если сервер сообщил о новых или удаленных письмах
+        """
+        self._tag += 1
+        tag = f'M{self._tag:04d}'.encode()
+        self.writer.write(tag + b' IDLE\r\n')
+        await self.writer.drain()
+        line = await self._read_line()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f'IDLE failed: {line!r}')
+
+        changed = False
+        deadline = time.monotonic() + timeout
+        while not changed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                # readline не теряет данные при отмене по таймауту
+                line = await asyncio.wait_for(self.reader.readline(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not line:
+                raise imaplib.IMAP4.abort('connection closed by the server')
+            changed = re.match(rb'\* \d+ (EXISTS|EXPUNGE|RECENT)', line) is not None
+
+        self.writer.write(b'DONE\r\n')
+        await self.writer.drain()
+        while True:
+            items = await self._read_response()
+            first = items[0][0] if isinstance(items[0], tuple) else items[0]
+            if first.startswith(tag + b' '):
+                return changed
+            if first.startswith(b'*'):
+                self._store_untagged(items)
+
+    async def logout(self):
+        try:
+            await asyncio.wait_for(self.command('LOGOUT'), 10)
+        except Exception:
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class _BlockingIMAPFacade:
+    """
+    Синхронный интерфейс imaplib поверх AsyncIMAPClient.
+
+    Позволяет запускать download_emails в рабочем потоке: команды
+    выполняются в цикле событий, а поток ждет их результата.
+    """
+
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+
+    def uid(self, command, *args):
+        return asyncio.run_coroutine_threadsafe(self.client.uid(command, *args), self.loop).result()
+
+
+async def mirror_mailbox(mailbox_name, mailbox_name_canonical, mailbox_folder_path, state, args,
+                         server=IMAP_SERVER, port=IMAP_PORT, use_ssl=True, store=None, postprocess=None):
+    """
+    Непрерывно зеркалирует один ящик: ждет новые письма через IDLE и скачивает только их.
+
+    Если сервер не поддерживает IDLE, ящик опрашивается командой NOOP раз
+    в args.poll_interval секунд. Письма, которые не удалось скачать,
+    запрашиваются снова при следующей проверке ящика. Оборванное
+    соединение (и любая другая ошибка ящика) переоткрывается с
+    экспоненциальной задержкой до MIRROR_MAX_BACKOFF секунд, не
+    останавливая остальные ящики.
+
+    Args:
+        mailbox_name (str): Имя ящика на сервере
+        mailbox_name_canonical (str): Каноническое имя ящика
+        mailbox_folder_path (str): Локальная папка ящика
+        state (SyncState): Индекс синхронизации
+        args (argparse.Namespace): Параметры командной строки
+        store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+        postprocess (callable): postprocess(mailbox_name_canonical, mailbox_folder_path) - обработка
+            ящика после каждой пачки новых писем; выполняется в рабочем потоке
+    """
+    loop = asyncio.get_running_loop()
+    backoff = 1
+    # Письма, которые не удалось скачать: поиск новых писем начинается не выше них
+    failed_uids = set()
+    uidvalidity = None
+    while True:
+        client = AsyncIMAPClient(server, port, use_ssl)
+        try:
+            await client.connect()
+            await client.login(args.username, args.password)
+            await client.select(mailbox_name, readonly=True)
+            status = mailbox_status(client)
+            state.open_mailbox(mailbox_name_canonical, status['UIDVALIDITY'], mailbox_folder_path, store)
+            if status['UIDVALIDITY'] != uidvalidity:
+                # UID прежней нумерации ничего не значат
+                failed_uids.clear()
+                uidvalidity = status['UIDVALIDITY']
+            backoff = 1
+
+            while True:
+                known_uids = state.uids(mailbox_name_canonical) - state.incomplete_uids(mailbox_name_canonical, args.fetch_mode)
+                first_uid = min(failed_uids, default=max(known_uids, default=0) + 1)
+                typ, data = await client.uid('SEARCH', None, f'UID {first_uid}:*')
+                new_uids = [email_uid.decode() for email_uid in (data[0] or b'').split() if int(email_uid) not in known_uids]
+                if new_uids:
+                    progress = {}
+                    try:
+                        saved, failed = await loop.run_in_executor(
+                            None, contextvars.copy_context().run, download_emails, _BlockingIMAPFacade(client, loop),
+                            mailbox_folder_path, mailbox_name_canonical, new_uids, args.fetch_batch, state, args.fetch_mode,
+                            store, args.dedup, args.stream_size * 1024 * 1024, progress)
+                    finally:
+                        # Несохраненные письма (в том числе не запрошенные из-за обрыва) запрашиваются снова
+                        failed_uids = {int(email_uid) for email_uid in new_uids if not progress.get(email_uid)}
+                    print(f'[{datetime.now():%H:%M:%S}] {mailbox_name_canonical}: saved {saved}, failed {failed}')
+                    if saved and postprocess is not None:
+                        try:
+                            await loop.run_in_executor(None, contextvars.copy_context().run, postprocess,
+                                                       mailbox_name_canonical, mailbox_folder_path)
+                        except Exception as e:
+                            print(f'Error: Failed to process new emails of mailbox {mailbox_name_canonical}: {e}')
+
+                if 'IDLE' in client.capabilities:
+                    await client.idle()
+                else:
+                    await asyncio.sleep(args.poll_interval)
+                    await client.noop()
+        except (imaplib.IMAP4.error, OSError, asyncio.TimeoutError) as e:
+            print(f'Mailbox {mailbox_name_canonical}: connection lost ({e}), reconnecting in {backoff}s..')
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MIRROR_MAX_BACKOFF)
+        except Exception as e:
+            # Ошибка одного ящика (например, занятый индекс синхронизации) не останавливает остальные
+            print(f'Error: Mailbox {mailbox_name_canonical} failed ({e}), retrying in {backoff}s..')
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MIRROR_MAX_BACKOFF)
+        finally:
+            client.close()
+
+
+async def mirror_account(mailboxes, state, args, server=IMAP_SERVER, port=IMAP_PORT, use_ssl=True, store=None, postprocess=None):
+    """
+    Зеркалирует несколько ящиков одновременно, по соединению на ящик.
+
+    Args:
+        mailboxes (list): Кортежи (mailbox_name, mailbox_name_canonical, mailbox_folder_path)
+        state (SyncState): Индекс синхронизации
+        args (argparse.Namespace): Параметры командной строки
+        store (PackStore): Упакованное хранилище писем (None - EML-файлы)
+        postprocess (callable): Обработка ящика после новых писем (см. mirror_mailbox)
+    """
+    await asyncio.gather(*(mirror_mailbox(mailbox_name, mailbox_name_canonical, mailbox_folder_path, state, args,
+                                          server, port, use_ssl, store, postprocess)
+                           for mailbox_name, mailbox_name_canonical, mailbox_folder_path in mailboxes))
+
+
+class AccountError(Exception):
+    """Аккаунт нельзя обработать: не удалось войти, получить список ящиков и т. п."""
+
+
+def build_parser():
+    """Создает разбор параметров командной строки для загрузки одного аккаунта."""
+    parser = argparse.ArgumentParser(description='Download all mailboxes and their contents from a Yandex email account',
+                                     epilog='Use "%(prog)s search USERNAME QUERY" to search downloaded emails '
+                                            'and "%(prog)s export USERNAME" to unpack the packed store to EML files; '
+                                            'use "%(prog)s batch CONFIG" to download several accounts')
+    parser.add_argument('username', type=str, help='Yandex email account username')
+    parser.add_argument('password', type=str, help='Yandex email account password')
+    parser.add_argument('--server', type=str, default=IMAP_SERVER, help=f'IMAP server (default: {IMAP_SERVER})')
+    parser.add_argument('--port', type=int, default=IMAP_PORT, help=f'IMAP server SSL port (default: {IMAP_PORT})')
+    parser.add_argument('-m', '--mbox', action='store_true', help='Convert downloaded mailboxes to Mbox format')
+    parser.add_argument('-s', '--sync', action='store_true', help='Delete local email files that are not on the server')
+    parser.add_argument('--dedup', action='store_true', help='Save an email found in several mailboxes once and link the other copies (by Message-ID, or by content hash)')
+    parser.add_argument('--verify', action='store_true', help='Check downloaded emails against the sizes reported by the server and download broken ones again')
+    parser.add_argument('-a', '--max-age', type=int, default=-1, help='Only download emails newer than (since) X days')
+    parser.add_argument('-e', '--exclude', type=str, nargs='+', help='List mailboxes to exclude from downloading')
+    parser.add_argument('-i', '--include', type=str, nargs='+', help='List mailboxes to include (only those specified will be downloaded)')
+    parser.add_argument('--batch', type=int, default=100, help='Batch size N mails')
+    parser.add_argument('--txt', action='store_true', help='Include mail txt')
+    parser.add_argument('--html', action='store_true', help='Include mail html')
+    parser.add_argument('--files', action='store_true', help='Include mail attachments')
+    parser.add_argument('--max-attachment-size', type=int, default=MAX_ATTACHMENT_SIZE_MB, help='Do not save attachments larger than N megabytes (0 - no limit)')
+    parser.add_argument('--unseen', action='store_true', help='Include unseen only')
+    parser.add_argument('--index', action='store_true', help='Add decoded emails to the full-text search index (see the search subcommand)')
+    parser.add_argument('--store', choices=('files', 'pack'), default='files', help='Keep emails as one EML file per email or in compressed pack files')
+    parser.add_argument('--compression', choices=sorted(PACK_CODECS), default=DEFAULT_PACK_CODEC, help='Compression of the packed store (default: zstd if installed, otherwise zlib)')
+    parser.add_argument('--fetch-batch', type=int, default=FETCH_BATCH_SIZE, help='Number of emails requested with a single UID FETCH command')
+    parser.add_argument('--stream-size', type=int, default=STREAM_MESSAGE_SIZE_MB, help='Download emails larger than N megabytes in parts straight to disk (0 - always whole)')
+    parser.add_argument('--sanitizer', choices=available_sanitizers(), default=None, help='HTML cleaning engine (default: lxml if installed, otherwise htmlparser)')
+    parser.add_argument('--decode-workers', type=int, default=None, help='Number of processes decoding downloaded emails (default: number of CPUs)')
+    parser.add_argument('--fetch-mode', choices=FETCH_MODES, default='full', help='Download whole emails (full), only their text and HTML parts without attachments (text) or only headers (headers)')
+    parser.add_argument('--incremental', action='store_true', help='Only ask the server for changes since the previous run (UIDNEXT/HIGHESTMODSEQ)')
+    parser.add_argument('--mirror', action='store_true', help='Keep running and download new emails as they arrive (IMAP IDLE)')
+    parser.add_argument('--poll-interval', type=int, default=60, help='Seconds between checks in --mirror mode when the server has no IDLE')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='Print every email and file as it is processed')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Print only errors and totals, no progress line')
+    parser.add_argument('--metrics-file', type=str, default=None, help='Write metrics to FILE while running: JSON lines, or a Prometheus textfile if FILE ends with .prom')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of parallel IMAP connections used for downloading')
+    parser.add_argument('--throttle', type=float, default=0.1, help='Minimum delay in seconds between IMAP commands of the workers')
+    return parser
+
+
+def _add_counters(summary, counters):
+    """Добавляет счетчики ящика к итогам аккаунта."""
+    for key in ('saved', 'linked', 'skipped', 'failed', 'removed', 'total'):
+        summary[key] += counters.get(key, 0)
+
+
+def open_connection(args, ssl_context=None):
+    """Открывает новое авторизованное соединение аккаунта взамен разорванного (с CONDSTORE для --incremental)."""
+    connection = connect_imap(args.username, args.password, args.server, args.port, ssl_context)
+    if args.incremental and 'CONDSTORE' in connection.capabilities and 'ENABLE' in connection.capabilities:
+        connection.enable('CONDSTORE')
+    return connection
+
+
+def close_connection(connection):
+    """Закрывает основное соединение аккаунта; ошибка закрытия только выводится как предупреждение."""
+    if connection is None:
+        return
+    log('Closing the connection..')
+    try:
+        connection.close()
+        connection.logout()
+    except Exception as e:
+        print(f'Warning: Failed to close the connection to the Yandex email account: {e}')
+
+
+def download_mailbox(connection, args, mailbox_name, mailbox_name_canonical, mailbox_folder_path, email_uids, state,
+                     store=None, ssl_context=None):
+    """
+    Скачивает письма ящика через основное соединение, переоткрывая его после обрыва.
+
+    После обрыва загрузка продолжается с первого не скачанного письма,
+    не более CONNECTION_RETRIES раз с экспоненциальной задержкой. Если
+    соединение восстановить не удалось, оставшиеся письма считаются не
+    скачанными, а обработка аккаунта продолжается.
+
+    Returns:
+        tuple: (connection, saved, failed) - соединение для следующих ящиков (None - разорвано),
+               количество сохраненных и не скачанных писем
+    """
+    progress = {}
+    for attempt in range(CONNECTION_RETRIES + 1):
+        try:
+            if connection is None:
+                connection = open_connection(args, ssl_context)
+                typ, data = connection.select(imap_mailbox_name(mailbox_name), readonly=True)
+                if typ != 'OK':
+                    raise imaplib.IMAP4.error(f'SELECT {mailbox_name} failed: {data}')
+            download_emails(connection, mailbox_folder_path, mailbox_name_canonical, email_uids, args.fetch_batch, state,
+                            args.fetch_mode, store, args.dedup, args.stream_size * 1024 * 1024, progress)
+            break
+        except (imaplib.IMAP4.abort, OSError) as e:
+            if connection is not None:
+                try:
+                    connection.shutdown()
+                except Exception:
+                    pass
+            connection = None
+            if attempt == CONNECTION_RETRIES:
+                for email_uid in email_uids:
+                    if email_uid not in progress:
+                        print(f'Error: Failed to download email with UID {email_uid} from mailbox {mailbox_name_canonical}')
+                print(str(e))
+                break
+            delay = 2 ** attempt
+            print(f'Connection lost ({e}), reconnecting in {delay}s..')
+            time.sleep(delay)
+
+    saved = sum(progress.values())
+    return connection, saved, len(email_uids) - saved
+
+
+def run_account(args, ssl_context=None, decode_executor=None):
+    """
+    Скачивает и обрабатывает выбранные ящики одного аккаунта.
+
+    Args:
+        args (argparse.Namespace): Параметры аккаунта (см. build_parser)
+        ssl_context (ssl.SSLContext): Общий SSL-контекст соединений (None - свой у каждого соединения)
+        decode_executor (ProcessPoolExecutor): Общий пул процессов обработки писем
+            (None - один пул на все ящики аккаунта)
+
+    Returns:
+        dict: Итоги аккаунта: username, server, mailboxes, saved, linked, skipped,
+              failed, removed, total и seconds
+
+    Raises:
+        AccountError: Аккаунт нельзя обработать
+    """
+    # Индексы, хранилище и пулы аккаунта закрываются и тогда, когда аккаунт завершился ошибкой
+    with ExitStack() as resources:
+        return _run_account(args, ssl_context, decode_executor, resources)
+
+
+def _run_account(args, ssl_context, decode_executor, resources):
+    """Тело run_account: открытые ресурсы аккаунта регистрируются в resources (ExitStack)."""
+    started = time.monotonic()
+    summary = {'username': args.username, 'server': args.server, 'mailboxes': 0,
+               'saved': 0, 'linked': 0, 'skipped': 0, 'failed': 0, 'removed': 0, 'total': 0}
+
+    # Connect to the IMAP server over SSL
+    imap_server = args.server
+    imap_port = args.port
+    log(f'Connecting to {imap_server}:{imap_port}...')
+    try:
+        connection = imaplib.IMAP4_SSL(imap_server, imap_port, ssl_context=ssl_context)
+    except Exception as e:
+        raise AccountError(f'Failed to connect to {imap_server}:{imap_port}: {e}') from e
+
+    # Login to the Yandex email account
+    log(f'Logging in as {args.username}..')
+    try:
+        connection.login(args.username, args.password)
+    except Exception as e:
+        connection.shutdown()
+        raise AccountError(f'Failed to login to the Yandex email account: {e}') from e
+
+    # Ask CONDSTORE servers to report HIGHESTMODSEQ for --incremental
+    if args.incremental and 'CONDSTORE' in connection.capabilities and 'ENABLE' in connection.capabilities:
+        try:
+            connection.enable('CONDSTORE')
+        except Exception as e:
+            print(f'Warning: Failed to enable CONDSTORE: {e}')
+
+    # Get the list of mailboxes
+    log('Listing account mailboxes..\n')
+    try:
+        connection.select()
+        typ, data = connection.list()
+    except Exception as e:
+        connection.shutdown()
+        raise AccountError(f'Failed to get the list of mailboxes: {e}') from e
+
+    # Create local account folder
+    local_folder_name = args.username
+    os.makedirs(local_folder_name, exist_ok=True)
+
+    # Local index of downloaded emails
+    state = SyncState(local_folder_name)
+    resources.callback(state.close)
+    store = PackStore(local_folder_name, args.compression) if args.store == 'pack' else None
+    if store is not None:
+        resources.callback(store.close)
+
+    # Worker pool with extra connections for the parallel mode
+    pool = None
+    if args.workers > 1:
+        log(f'Starting {args.workers} download workers..\n')
+        pool = IMAPConnectionPool(args.username, args.password, args.workers, throttle=args.throttle,
+                                  server=imap_server, port=imap_port, ssl_context=ssl_context)
+        resources.callback(pool.close)
+    queued_mailboxes = []
+    selected_mailboxes = []
+
+    # Download all mailboxes and their contents locally
+    for mailbox in data:
+        # Mailbox name
+        mailbox_name = mailbox.decode('utf-8').split(' "|" ')[-1].replace('"', '').replace('/', '_')
+        mailbox_name_canonical = mailbox_name.replace('|', '/')
+
+        if args.include is not None and mailbox_name_canonical not in args.include:
+            continue
+        if args.exclude is not None and mailbox_name_canonical in args.exclude:
+            continue
+
+        # Mailbox server path
+        mailbox_path = mailbox_name.split('|')
+
+        # Determine local mailbox folder path
+        mailbox_folder_path = local_folder_name
+        for folder in mailbox_path:
+            mailbox_folder_path = os.path.join(mailbox_folder_path, folder)
+
+        # Create necessary directories recursively
+        os.makedirs(mailbox_folder_path, exist_ok=True)
+
+        # Files left half-written by an interrupted run
+        remove_partial_files(mailbox_folder_path)
+        selected_mailboxes.append((mailbox_name, mailbox_name_canonical, mailbox_folder_path))
+        
+        # Move emails downloaded as EML files into the packed store
+        if store is not None:
+            moved = store.import_folder(mailbox_name_canonical, mailbox_folder_path)
+            if moved:
+                log(f'Moved {moved} EML files of mailbox {mailbox_name_canonical} into the packed store')
+
+        # Select mailbox
+        try:
+            if connection is None:
+                # The connection was lost while downloading the previous mailbox
+                connection = open_connection(args, ssl_context)
+            connection.select(imap_mailbox_name(mailbox_name), readonly=True)
+            status = mailbox_status(connection)
+
+            previous = state.mailbox_info(mailbox_name_canonical)
+            known_uids = state.open_mailbox(mailbox_name_canonical, status['UIDVALIDITY'], mailbox_folder_path, store)
+            refetch = state.incomplete_uids(mailbox_name_canonical, args.fetch_mode)
+            if args.verify:
+                broken = verify_mailbox(connection, state, mailbox_name_canonical, mailbox_folder_path, store)
+                if broken:
+                    log(f'  {len(broken)} emails of mailbox {mailbox_name_canonical} failed verification and will be downloaded again')
+                refetch |= broken
+            known_uids -= refetch
+            email_uids, server_uids = search_mailbox(connection, status, previous, known_uids, args, refetch)
+        except Exception as e:
+            print(f'Error: Failed to select mailbox {mailbox_name_canonical}')
+            print(str(e))
+            if isinstance(e, (imaplib.IMAP4.abort, OSError)):
+                connection = None
+            continue
+
+        # Initialize counters
+        saved = 0
+        skipped = 0
+        failed = 0
+        total = 0
+
+        # Download mailbox contents
+        log(f'Downloading contents of mailbox {mailbox_name_canonical}..')
+
+        to_fetch = []
+
+        for email_uid in email_uids:
+            total += 1
+
+            try:
+                # Decode email UID
+                email_uid = email_uid.decode()
+
+                # Check if the email has already been downloaded
+                if int(email_uid) in known_uids:
+                    skipped += 1
+                    continue
+
+                to_fetch.append(email_uid)
             except Exception as e:
                 print(f'Error: Failed to download email with UID {email_uid} from mailbox {mailbox_name_canonical}')
                 print(str(e))
                 failed += 1
                 continue
 
-        if args.sync:
-            for file in os.listdir(mailbox_folder_path):
-                if file.endswith(".eml"):
-                    email_uid = os.path.splitext(file)[0]
-                    email_file_path = os.path.join(mailbox_folder_path, file)
-                    if email_uid.encode() not in email_uids:
-                        os.remove(email_file_path)
-                        removed += 1
-
-        print(f'  Saved: {saved}\n  Skipped: {skipped}\n  Failed: {failed}\n  Removed: {removed}\n  Total: {total}')
-
-        # Convert to MBOX format if specified
-        if args.mbox:
-            print('Creating Mbox file..\n')
-            convert_to_mbox(mailbox_folder_path)
+        counters = {'saved': saved, 'skipped': skipped, 'failed': failed, 'total': total, 'linked': 0}
+
+        # Emails already downloaded into other mailboxes are linked instead of fetched
+        if args.dedup and to_fetch and args.fetch_mode == 'full':
+            try:
+                counters['linked'], to_fetch = link_duplicates(connection, mailbox_folder_path, mailbox_name_canonical, to_fetch,
+                                                               args.fetch_batch, state, store)
+            except Exception as e:
+                print(f'Error: Failed to look for copies of emails from mailbox {mailbox_name_canonical}')
+                print(str(e))
+                if isinstance(e, (imaplib.IMAP4.abort, OSError)):
+                    connection = None
+
+        metrics.start_phase('download', len(to_fetch))
+
+        if pool is None:
+            connection, chunk_saved, chunk_failed = download_mailbox(connection, args, mailbox_name, mailbox_name_canonical, mailbox_folder_path,
+                                                                     to_fetch, state, store, ssl_context)
+            counters['saved'] += chunk_saved
+            counters['failed'] += chunk_failed
+            counters['removed'] = finish_mailbox(mailbox_folder_path, mailbox_name_canonical, server_uids, status, counters, args, state, store)
+            _add_counters(summary, counters)
         else:
-            print('')
+            # Split large mailboxes into UID chunks shared between the workers
+            jobs = []
+            for start in range(0, len(to_fetch), WORKER_CHUNK_SIZE):
+                chunk = to_fetch[start:start + WORKER_CHUNK_SIZE]
+                # A retry after a dropped connection skips the emails already in progress
+                progress = {}
+                jobs.append((chunk, progress, pool.submit(mailbox_name, download_emails, mailbox_folder_path, mailbox_name_canonical, chunk, args.fetch_batch, state, args.fetch_mode, store, args.dedup,
+                                                           args.stream_size * 1024 * 1024, progress)))
+            queued_mailboxes.append((mailbox_name_canonical, mailbox_folder_path, server_uids, status, counters, jobs))
+            log(f'  Queued: {len(to_fetch)} emails in {len(jobs)} chunks\n')
+
+    # The main connection is idle while the workers download, and the server would drop it (autologout)
+    if queued_mailboxes:
+        close_connection(connection)
+        connection = None
+
+    # Wait for the workers and summarize mailboxes in the original order
+    for mailbox_name_canonical, mailbox_folder_path, server_uids, status, counters, jobs in queued_mailboxes:
+        for chunk, progress, job in jobs:
+            try:
+                job.result()
+            except Exception as e:
+                for email_uid in chunk:
+                    if email_uid not in progress:
+                        print(f'Error: Failed to download email with UID {email_uid} from mailbox {mailbox_name_canonical}')
+                print(str(e))
+            # Emails saved before the connection was lost count too, even if the chunk failed later
+            chunk_saved = sum(progress.values())
+            counters['saved'] += chunk_saved
+            counters['failed'] += len(chunk) - chunk_saved
+        log(f'Finished mailbox {mailbox_name_canonical}:')
+        counters['removed'] = finish_mailbox(mailbox_folder_path, mailbox_name_canonical, server_uids, status, counters, args, state, store)
+        _add_counters(summary, counters)
+
+    if pool is not None:
+        pool.close()
 
     # Close the connection to the Yandex email account
-    print('Closing the connection..')
-    try:
-        connection.close()
-        connection.logout()
-    except Exception as e:
-        print('Error: Failed to close the connection to the Yandex email account')
-        print(str(e))
-        exit()
+    close_connection(connection)
 
-    print('All mailboxes and their contents have been downloaded successfully!')
+    log('All mailboxes and their contents have been downloaded successfully!')
 
-    for filepath in os.listdir(mailbox_folder_path):
-        # Чтение EML файла
-        process_eml_file(filepath, input_dir=mailbox_folder_path, output_dir=os.path.join('txt', mailbox_folder_path))
-    
+    # Общее для всех ящиков хранилище вложений
+    attachment_store = AttachmentStore(os.path.join('txt', local_folder_name, '_attachments'),
+                                       max_size=args.max_attachment_size * 1024 * 1024)
 
-    merge_html_files_with_separators(os.path.join('txt', mailbox_folder_path),
-                                    os.listdir(os.path.join('txt', mailbox_folder_path)), 
-                                    os.path.join('txt', mailbox_folder_path),
-                                    batch=args.batch)
-        
-    print('All mailboxes and their contents have been decoded successfully!')
\ No newline at end of file
+    # Полнотекстовый индекс пополняется по мере обработки писем
+    search_index = SearchIndex(local_folder_name) if args.index else None
+    if search_index is not None:
+        resources.callback(search_index.close)
+
+    # Обработанные письма по SHA-256: копии в следующих ящиках получают ссылки на результаты
+    decoded_copies = {} if args.dedup else None
+
+    # Один пул процессов обработки на все ящики; процессы запускаются при первой пачке писем
+    if decode_executor is None and args.decode_workers != 1:
+        decode_executor = decode_pool(args.decode_workers or os.cpu_count() or 1)
+        resources.callback(decode_executor.shutdown)
+
+    # Ящики обрабатываются по одному: при зеркалировании обработка идет из рабочих потоков
+    postprocess_lock = threading.Lock()
+
+    def postprocess(mailbox_name_canonical, mailbox_folder_path):
+        with postprocess_lock:
+            postprocess_mailbox(mailbox_name_canonical, mailbox_folder_path, args, store, attachment_store, search_index,
+                                state, decoded_copies, decode_executor)
+
+    # Обработка и объединение писем всех выбранных ящиков
+    for mailbox_name, mailbox_name_canonical, mailbox_folder_path in selected_mailboxes:
+        postprocess(mailbox_name_canonical, mailbox_folder_path)
+
+    log('All mailboxes and their contents have been decoded successfully!')
+
+    # Keep the mailboxes mirrored until interrupted; every batch of new emails is decoded, merged and indexed
+    if args.mirror:
+        print('Mirroring mailboxes, press Ctrl+C to stop..')
+        try:
+            asyncio.run(mirror_account(selected_mailboxes, state, args, imap_server, imap_port, store=store,
+                                       postprocess=postprocess))
+        except KeyboardInterrupt:
+            print('Mirroring stopped')
+
+    summary['mailboxes'] = len(selected_mailboxes)
+    summary['seconds'] = round(time.monotonic() - started, 1)
+    return summary
+
+
+# Ограничения одновременных IMAP-соединений пакетного запуска по умолчанию
+BATCH_MAX_CONNECTIONS = 8
+BATCH_MAX_CONNECTIONS_PER_HOST = 4
+
+# Параметры командной строки, которые в пакетном запуске задаются для всего запуска
+_BATCH_GLOBAL_OPTIONS = ('help', 'verbose', 'quiet', 'metrics_file', 'mirror')
+
+# Ключи файла настроек пакетного запуска
+_BATCH_CONFIG_KEYS = ('max_connections', 'max_connections_per_host', 'decode_workers', 'defaults', 'accounts')
+
+
+class ConnectionLimiter:
+    """
+    Ограничивает число одновременных IMAP-соединений: всего и к каждому серверу.
+
+    Аккаунт резервирует все свои соединения (основное и рабочие) разом
+    перед запуском, поэтому аккаунты, удерживающие часть соединений,
+    не могут заблокировать друг друга.
+
+    Args:
+        max_connections (int): Наибольшее число соединений всего
+        max_per_host (int): Наибольшее число соединений к одному серверу
+    """
+
+    def __init__(self, max_connections=BATCH_MAX_CONNECTIONS, max_per_host=BATCH_MAX_CONNECTIONS_PER_HOST):
+        self.max_connections = max(1, max_connections)
+        self.max_per_host = max(1, min(max_per_host, self.max_connections))
+        self._condition = threading.Condition()
+        self._total = 0
+        self._hosts = {}
+
+    @contextmanager
+    def reserve(self, host, count):
+        """Ждет, пока к серверу host можно открыть count соединений, и удерживает их до конца блока with."""
+        count = min(count, self.max_per_host)
+        with self._condition:
+            self._condition.wait_for(lambda: self._total + count <= self.max_connections
+                                     and self._hosts.get(host, 0) + count <= self.max_per_host)
+            self._total += count
+            self._hosts[host] = self._hosts.get(host, 0) + count
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._total -= count
+                self._hosts[host] -= count
+                self._condition.notify_all()
+
+
+def _account_argv(entry, options):
+    """
+    Превращает параметры аккаунта из файла настроек в аргументы командной строки.
+
+    Args:
+        entry (dict): Параметры аккаунта, например {"fetch_mode": "text", "include": ["INBOX"], "sync": true}
+        options (dict): Имя параметра -> длинный ключ командной строки
+
+    Returns:
+        list: Аргументы для build_parser().parse_args (без имени пользователя и пароля)
+
+    Raises:
+        ValueError: Неизвестный параметр
+    """
+    argv = []
+    for key, value in entry.items():
+        key = key.replace('-', '_')
+        if key in ('username', 'password', 'password_env'):
+            continue
+        if key not in options or key in _BATCH_GLOBAL_OPTIONS:
+            raise ValueError(f'Unknown account option: {key}')
+        if value is None or value is False:
+            continue
+        argv.append(options[key])
+        if isinstance(value, list):
+            argv.extend(str(item) for item in value)
+        elif value is not True:
+            argv.append(str(value))
+    return argv
+
+
+def print_batch_report(results):
+    """Печатает сводную таблицу пакетного запуска и возвращает итоги по всем аккаунтам."""
+    keys = ('mailboxes', 'saved', 'linked', 'skipped', 'failed', 'removed', 'total')
+    totals = {key: sum(result.get(key, 0) for result in results) for key in keys}
+    print(f'{"Account":<32} {"Server":<24} {"Boxes":>6} {"Saved":>8} {"Linked":>8} {"Skipped":>8} {"Failed":>7} '
+          f'{"Removed":>8} {"Time":>8}  Status')
+    for result in results:
+        status = 'error: ' + result['error'] if result.get('error') else 'incomplete' if result['failed'] else 'ok'
+        print(f'{result["username"]:<32} {result["server"]:<24} {result["mailboxes"]:>6} {result["saved"]:>8} '
+              f'{result["linked"]:>8} {result["skipped"]:>8} {result["failed"]:>7} {result["removed"]:>8} '
+              f'{result["seconds"]:>7.1f}s  {status}')
+    print(f'{"Total: " + str(len(results)) + " accounts":<57} {totals["mailboxes"]:>6} {totals["saved"]:>8} '
+          f'{totals["linked"]:>8} {totals["skipped"]:>8} {totals["failed"]:>7} {totals["removed"]:>8}')
+    return totals
+
+
+def batch_command(argv):
+    """
+    Подкоманда batch: загрузка нескольких аккаунтов из файла настроек в одном процессе.
+
+        python3 yandex_mail_downloader.py batch <config.json> [--report FILE]
+
+    Файл настроек (JSON):
+
+        {
+            "max_connections": 8,
+            "max_connections_per_host": 4,
+            "decode_workers": 4,
+            "defaults": {"html": true, "sync": true},
+            "accounts": [
+                {"username": "user@yandex.ru", "password_env": "USER_PASSWORD", "workers": 2},
+                {"username": "box@example.com", "password": "...", "server": "imap.example.com", "include": ["INBOX"]}
+            ]
+        }
+
+    Параметры аккаунта - те же, что в командной строке (fetch_mode или
+    fetch-mode), defaults применяются ко всем аккаунтам. Аккаунты
+    обрабатываются параллельно в пределах общего числа соединений и
+    числа соединений к одному серверу, с общими SSL-контекстом и пулом
+    процессов обработки писем.
+
+    Returns:
+        int: Код завершения: 0, если все аккаунты обработаны, иначе 1
+    """
+    parser = argparse.ArgumentParser(prog='yandex_mail_downloader.py batch',
+                                     description='Download several accounts listed in a JSON config file in one process')
+    parser.add_argument('config', type=str, help='JSON file with the accounts and their options')
+    parser.add_argument('--report', type=str, default=None, help='Write the summary report as JSON to FILE')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='Print every email and file as it is processed')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Print only errors and totals, no progress line')
+    parser.add_argument('--metrics-file', type=str, default=None, help='Write metrics to FILE while running: JSON lines, or a Prometheus textfile if FILE ends with .prom')
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    unknown = set(config) - set(_BATCH_CONFIG_KEYS)
+    if unknown:
+        parser.error(f'unknown config keys: {", ".join(sorted(unknown))}')
+
+    # Output level and metrics export
+    set_verbosity(QUIET if args.quiet else NORMAL + args.verbose)
+    metrics.export_path = args.metrics_file
+
+    # Параметры всех аккаунтов разбираются заранее, чтобы ошибка в настройках нашлась до загрузки
+    account_parser = build_parser()
+    options = {action.dest: action.option_strings[-1] for action in account_parser._actions if action.option_strings}
+    limiter = ConnectionLimiter(config.get('max_connections', BATCH_MAX_CONNECTIONS),
+                                config.get('max_connections_per_host', BATCH_MAX_CONNECTIONS_PER_HOST))
+    accounts = []
+    for entry in config.get('accounts', []):
+        entry = dict(config.get('defaults', {}), **entry)
+        if not entry.get('username'):
+            parser.error('every account needs a username')
+        password = entry.get('password')
+        if password is None and entry.get('password_env'):
+            password = os.environ.get(entry['password_env'])
+        if password is None:
+            parser.error(f'no password for account {entry["username"]} (set password or password_env)')
+        try:
+            account_argv = _account_argv(entry, options)
+        except ValueError as e:
+            parser.error(f'account {entry["username"]}: {e}')
+        account_parser.prog = f'{parser.prog}: account {entry["username"]}'
+        account_args = account_parser.parse_args(account_argv + ['--', entry['username'], password])
+
+        # Аккаунт не может держать больше соединений, чем разрешено к одному серверу
+        if account_args.workers > 1 and account_args.workers + 1 > limiter.max_per_host:
+            workers = limiter.max_per_host - 1
+            account_args.workers = workers if workers > 1 else 1
+            log(f'Account {account_args.username}: workers limited to {account_args.workers} by the connection caps')
+        accounts.append(account_args)
+
+    ssl_context = ssl.create_default_context()
+
+    def run(account_args):
+        connections = 1 + (account_args.workers if account_args.workers > 1 else 0)
+        with limiter.reserve(account_args.server, connections):
+            started = time.monotonic()
+            try:
+                with metrics.account(account_args.username):
+                    return run_account(account_args, ssl_context, decode_executor)
+            except Exception as e:
+                print(f'Error: Account {account_args.username} failed: {e}')
+                return {'username': account_args.username, 'server': account_args.server, 'mailboxes': 0,
+                        'saved': 0, 'linked': 0, 'skipped': 0, 'failed': 0, 'removed': 0, 'total': 0,
+                        'seconds': round(time.monotonic() - started, 1), 'error': str(e)}
+
+    started = time.monotonic()
+    decode_workers = config.get('decode_workers') or os.cpu_count() or 1
+    with decode_pool(decode_workers) as decode_executor, \
+            ThreadPoolExecutor(max_workers=limiter.max_connections) as executor:
+        results = list(executor.map(run, accounts))
+
+    # Final metrics and the consolidated report
+    metrics.clear_progress()
+    if metrics.export_path:
+        metrics.export()
+    log('Timing:\n' + '\n'.join(metrics.summary()))
+    print('')
+    totals = print_batch_report(results)
+    if args.report:
+        atomic_write(args.report, json.dumps({'accounts': results, 'totals': totals,
+                                              'seconds': round(time.monotonic() - started, 1)},
+                                             ensure_ascii=False, indent=2), encoding='utf-8')
+        print(f'Report written to {args.report}')
+    return 1 if any(result.get('error') or result['failed'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    # Subcommands that work with already downloaded mail
+    if sys.argv[1:2] == ['search']:
+        search_command(sys.argv[2:])
+        sys.exit()
+    if sys.argv[1:2] == ['export']:
+        export_command(sys.argv[2:])
+        sys.exit()
+    if sys.argv[1:2] == ['batch']:
+        sys.exit(batch_command(sys.argv[2:]))
+
+    # Parse command line arguments
+    args = build_parser().parse_args()
+
+    # Output level and metrics export
+    set_verbosity(QUIET if args.quiet else NORMAL + args.verbose)
+    metrics.export_path = args.metrics_file
+
+    try:
+        run_account(args)
+    except AccountError as e:
+        print(f'Error: {e}')
+        exit()
+
+    # Final metrics: the last snapshot is exported and the timings are summarized
+    metrics.clear_progress()
+    if metrics.export_path:
+        metrics.export()
+    log('Timing:\n' + '\n'.join(metrics.summary()))
\ No newline at end of file